@@ -0,0 +1,2 @@
+# Тесты скорости операций с картой и стоимости кадра без окна на экране.
+# Запуск из корня репозитория: python -m benchmarks --help
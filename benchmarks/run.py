@@ -0,0 +1,421 @@
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from math import ceil
+from types import SimpleNamespace
+
+# корень репозитория: модули игры и её ресурсы лежат там
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# размеры карт по умолчанию (в блоках)
+DEFAULT_SIZES = [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6]
+# файл эталонных результатов
+DEFAULT_BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+# файл результатов текущего запуска
+DEFAULT_OUTPUT = os.path.join(ROOT, 'benchmark_results.json')
+# разница меньше этой (секунд) считается шумом, а не замедлением
+NOISE_FLOOR = 0.0002
+
+
+# Функция запуска Panda3D без окна на экране. Аргументы:
+#  window_type - 'offscreen' (рисуем во внеэкранный буфер) или 'none'
+def startPanda(window_type):
+    os.chdir(ROOT)
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+
+    from panda3d.core import loadPrcFileData
+    loadPrcFileData('', 'window-type %s' % window_type)
+    loadPrcFileData('', 'audio-library-name null')
+    loadPrcFileData('', 'sync-video false')
+
+    from direct.showbase.ShowBase import ShowBase
+    base = ShowBase()
+    # без окна у ShowBase нет камеры - создаём для неё узел
+    if base.camera is None:
+        base.camera = base.render.attachNewNode('camera')
+    return base
+
+
+# Функция замера времени одного вызова func (секунд)
+def timeOnce(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+# Функция замера медианы времени count вызовов func (секунд)
+def timeMedian(func, count):
+    times = []
+    for i in range(count):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+# Функция построения вложенного списка для createMap
+# ровно из size блоков (куб со стороной ceil(size^(1/3)))
+def makeMatrix(size):
+    side = ceil(round(size ** (1 / 3), 6))
+    left = size
+    matrix = []
+    for z in range(side):
+        layer = []
+        for y in range(side):
+            row = []
+            for x in range(side):
+                row.append('W' if left > 0 else '-')
+                left -= 1
+            layer.append(row)
+        matrix.append(layer)
+    return matrix, side
+
+
+# Класс набора замеров
+class Benchmark():
+    # Конструктор. Аргументы:
+    #  base - запущенный ShowBase
+    #  repeat - количество повторов для замеров одиночных операций
+    def __init__(self, base, repeat):
+        from mapmanager import MapManager
+        from controller import Controller
+        from editor import Editor
+        from scheduler import scheduler
+
+        self.base = base
+        self.repeat = repeat
+        self.results = dict()
+
+        self.map_manager = MapManager(collisions=False)
+        self.controller = Controller(self.map_manager)
+        self.editor = Editor(self.map_manager)
+        # задачи редактора и контроллера вызываем вручную
+        taskMgr.remove('camera-task')
+        taskMgr.remove('test_block-task')
+        scheduler.removeTick(self.controller.simulate)
+        self.scheduler = scheduler
+
+    # Метод записи результата name для размера size
+    def record(self, name, size, value):
+        self.results.setdefault(name, dict())[str(size)] = value
+        if name.endswith('Bytes'):
+            print('  %-22s %10s  %10.1f bytes' % (name, size, value))
+        else:
+            print('  %-22s %10s  %10.3f ms' % (name, size, value * 1000))
+
+    # Метод замеров генераторов карт фиксированного размера
+    def runFixed(self):
+        manager = self.map_manager
+        self.record('generateRandomMap', 'fixed',
+                    timeOnce(manager.generateRandomMap))
+        self.record('basicMap', 'fixed', timeOnce(manager.basicMap))
+        manager.clearAll()
+
+        # инструменты области на кубе 64x64x64 (с перестройкой чанков)
+        size = '64x64x64'
+        low, high = (0, 0, 0), (63, 63, 63)
+
+        def withRebuild(func, *args):
+            func(*args)
+            if manager.renderer:
+                manager.renderer.updateChunks()
+        self.record('regionFill', size, timeOnce(
+            withRebuild, manager.fillBox, low, high, (1, 1, 1, 1)))
+        self.record('regionReplaceColor', size, timeOnce(
+            withRebuild, manager.replaceColor, low, high, (1, 1, 1, 1),
+            (1, 0, 0, 1)))
+        clipboard = manager.copyRegion(low, high)
+        self.record('regionCopy', size, timeOnce(
+            manager.copyRegion, low, high))
+        self.record('clipboardBytes', size, clipboard.getBytes() / 64 ** 3)
+        self.record('regionPaste', size, timeOnce(
+            withRebuild, manager.pasteRegion, clipboard, (64, 0, 0)))
+        self.record('regionClear', size, timeOnce(
+            withRebuild, manager.removeBox, low, high))
+        manager.clearAll()
+
+        # генерация ландшафта 256x256x64 массивами (без добавления в карту)
+        from terrain import TerrainGenerator
+        generator = TerrainGenerator(seed=0)
+        self.record('terrainGenerate', '256x256x64', timeOnce(
+            generator.generate, (-128, -128, -32), (256, 256, 64)))
+
+        # цена замера участка выключенным профилировщиком на один вызов
+        from profiler import profiled
+        count = 100000
+
+        def plain():
+            pass
+        wrapped = profiled(plain)
+        self.record('profiledCallDisabled', 'fixed', max(0.0, (
+            timeOnce(lambda: [wrapped() for i in range(count)]) -
+            timeOnce(lambda: [plain() for i in range(count)])) / count))
+
+    # Метод замера создания блоков: время и память на один блок
+    def runBlocks(self, size):
+        from block import Block
+        tracemalloc.start()
+        start = time.perf_counter()
+        blocks = [Block((i, 0, 0), 1, with_node=False)
+                  for i in range(size)]
+        elapsed = time.perf_counter() - start
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del blocks
+        self.record('blockConstruct', size, elapsed / size)
+        # память - в байтах, а не в секундах
+        self.record('blockBytes', size, memory / size)
+
+    # Метод замеров для карты из size блоков
+    def runSize(self, size, tmpdir):
+        manager = self.map_manager
+        matrix, side = makeMatrix(size)
+        colors = {'W': (1, 1, 1, 1), '-': None}
+
+        self.runBlocks(size)
+
+        # память, которую занимает карта (хранилище чанков, индексы,
+        # освещение): без журнала отмены, на один блок
+        with manager.history.pause():
+            tracemalloc.start()
+            manager.createMap(colors, matrix, (0, 0, 0))
+            memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+        self.record('mapBytes', size, memory / size)
+        self.record('storeBytes', size, manager.store.getBytes() / size)
+
+        # построение карты и её геометрии
+        self.record('createMap', size,
+                    timeOnce(manager.createMap, colors, matrix, (0, 0, 0)))
+        if manager.hasLighting():
+            # расчёт освещения всей новой карты
+            self.record('lightingBuild', size,
+                        timeOnce(manager.renderer.updateLighting))
+            stats = manager.renderer.lighting.getStats()
+            self.record('lightingBytes', size, stats['bytes'] / size)
+        if manager.renderer:
+            # замеряем полную перестройку всех чанков за один вызов
+            # (иначе чанки перестраиваются планировщиком по кадрам)
+            manager.renderer.dirty.update(manager.renderer.chunks)
+            self.record('chunkRebuild', size,
+                        timeOnce(manager.renderer.updateChunks))
+
+        # сохранение и загрузка
+        filename = os.path.join(tmpdir, 'map_%d.dat' % size)
+        self.record('saveMap', size, timeOnce(manager.saveMap, filename))
+        self.record('loadMap', size, timeOnce(manager.loadMap, filename))
+        self.record('mapFileBytes', size, os.path.getsize(filename) / size)
+        if manager.renderer:
+            manager.renderer.updateChunks()
+
+        # выделение и удаление блоков
+        def sampleKeys(count):
+            return [manager.getBlock(voxel).getKey()
+                    for voxel in random.sample(list(manager.blocks), count)]
+        keys = sampleKeys(min(self.repeat, size))
+        self.record('selectBlock', size, timeMedian(
+            lambda: manager.selectBlock(keys.pop()), len(keys)))
+        keys = sampleKeys(min(self.repeat, size - 1))
+
+        def selectAndDelete():
+            manager.selectBlock(keys.pop())
+            manager.deleteSelectedBlock()
+        self.record('deleteSelectedBlock', size,
+                    timeMedian(selectAndDelete, len(keys)))
+        # карта связана с файлом - сохраняются только правки
+        self.record('saveEdits', size, timeOnce(manager.saveMap, filename))
+
+        # запросы по области: куб 8x8x8 и шар радиуса 4 внутри карты,
+        # верх столбца и соседи вокселя (со смещением Y, как в createMap)
+        def randomPoint():
+            return (random.randrange(side), -random.randrange(side),
+                    random.randrange(side))
+
+        def boxQuery():
+            x, y, z = randomPoint()
+            manager.blocksInBox((x, y - 7, z), (x + 7, y, z + 7))
+        self.record('blocksInBox', size, timeMedian(boxQuery, self.repeat))
+        self.record('blocksInSphere', size, timeMedian(
+            lambda: manager.blocksInSphere(randomPoint(), 4), self.repeat))
+        self.record('columnTop', size, timeMedian(
+            lambda: manager.columnTop(*randomPoint()[:2]), self.repeat))
+        self.record('neighbors', size, timeMedian(
+            lambda: manager.neighbors(randomPoint(), True), self.repeat))
+        self.record('occupancyBytes', size,
+                    manager.occupancy.getBytes() / size)
+
+        # такт выделения блоков редактором: камера над картой смотрит вниз
+        camera = self.base.camera
+        camera.setPos(side / 2, -side / 2, side + 5)
+        camera.lookAt(side / 2 + 0.3, -side / 2 - 0.2, 0)
+        task = SimpleNamespace(cont=None)
+        editor = self.editor
+
+        # выделение ищется заново (как после движения камеры)
+        def pickAgain():
+            editor.pick_state = None
+            editor.testBlocksSelection(task)
+        self.record('editorSelectionTick', size,
+                    timeMedian(pickAgain, self.repeat))
+        # камера и карта не менялись - выделение берётся прежнее
+        self.record('editorSelectionCached', size, timeMedian(
+            lambda: editor.testBlocksSelection(task), self.repeat))
+
+        # пересчёт освещения после добавления и удаления одного блока
+        # над картой (его тень падает на верх карты)
+        if manager.hasLighting():
+            lighting = manager.renderer
+            tops = [(random.randrange(side), -random.randrange(side),
+                     side + 2) for i in range(self.repeat)]
+
+            def addAndRemove():
+                position = tops.pop()
+                manager.addBlock(position)
+                lighting.updateLighting()
+                manager.removeBlocks([position])
+                lighting.updateLighting()
+            self.record('lightingEdit', size,
+                        timeMedian(addAndRemove, len(tops)))
+            manager.renderer.updateChunks()
+
+        # такт контроллера в режиме хождения: идём вперёд по верху карты
+        self.controller.setEditMode(False)
+        camera.setPos(side / 2, -side / 2, side + 2)
+        self.controller.setKey('w', 1)
+        step = self.scheduler.timestep.step
+        self.record('controllerTick', size, timeMedian(
+            lambda: self.controller.simulate(step), self.repeat))
+        self.controller.setKey('w', 0)
+        self.controller.setEditMode(True)
+
+        # один кадр: задачи и отрисовка
+        camera.setPos(side / 2, -side * 2, side)
+        camera.lookAt(side / 2, -side / 2, side / 2)
+        # отложенные перестройки чанков после удалений выполняем заранее
+        if manager.renderer:
+            manager.renderer.updateChunks()
+        self.record('frame', size, timeMedian(taskMgr.step, self.repeat))
+        if manager.renderer:
+            # кадр, когда перестройки ждут все чанки: перестраивается
+            # только то, что помещается в бюджет планировщика
+            manager.renderer.dirty.update(manager.renderer.chunks)
+            self.record('frameWithRebuilds', size, timeOnce(taskMgr.step))
+            manager.renderer.updateChunks()
+
+        # память хранилища после сжатия неиспользуемых чанков
+        # (первый вызов только сбрасывает отметки обращений)
+        manager.store.compressIdle()
+        manager.store.compressIdle()
+        self.record('storeIdleBytes', size, manager.store.getBytes() / size)
+
+        manager.clearAll()
+        os.remove(filename)
+
+
+# Функция сравнения результатов с эталоном. Аргументы:
+#  results, baseline - словари вида {замер: {размер: значение}}
+#                      (секунды, у замеров памяти *Bytes - байты)
+#  tolerance - допустимое относительное замедление (0.25 = на 25%)
+# Возвращает список строк с описанием замедлений
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, sizes in sorted(results.items()):
+        # для замеров памяти нет шумового порога, и пишутся они в байтах
+        if name.endswith('Bytes'):
+            noise, unit, scale = 0, 'bytes', 1
+        else:
+            noise, unit, scale = NOISE_FLOOR, 'ms', 1000
+        for size, value in sizes.items():
+            expected = baseline.get(name, dict()).get(size)
+            if not expected:
+                continue
+            ratio = value / expected
+            status = 'ok'
+            if ratio > 1 + tolerance and value - expected > noise:
+                status = 'REGRESSION'
+                regressions.append('%s[%s]: %.3f %s -> %.3f %s (x%.2f)' % (
+                    name, size, expected * scale, unit, value * scale, unit,
+                    ratio))
+            print('  %-22s %10s  x%.2f  %s' % (name, size, ratio, status))
+    return regressions
+
+
+# Функция разбора аргументов командной строки
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks',
+        description='Headless benchmarks of map operations and frame cost.')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=DEFAULT_SIZES,
+                        help='map sizes in blocks (default: 1e3 .. 1e6)')
+    parser.add_argument('--window-type', default='offscreen',
+                        choices=['offscreen', 'none'])
+    parser.add_argument('--repeat', type=int, default=50,
+                        help='samples for per-operation timings')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT,
+                        help='where to write JSON results')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help='stored JSON results to compare against')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store these results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown against the baseline')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    random.seed(0)
+    base = startPanda(args.window_type)
+
+    bench = Benchmark(base, args.repeat)
+    print('fixed-size maps')
+    bench.runFixed()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for size in args.sizes:
+            print('map of %d blocks' % size)
+            bench.runSize(size, tmpdir)
+
+    import panda3d
+    report = {'meta': {'python': platform.python_version(),
+                       'panda3d': panda3d.__version__,
+                       'platform': platform.platform(),
+                       'window_type': args.window_type,
+                       'sizes': args.sizes,
+                       'repeat': args.repeat},
+              'results': bench.results}
+    with open(args.output, 'w') as fout:
+        json.dump(report, fout, indent=2, sort_keys=True)
+    print('results written to', args.output)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as fout:
+            json.dump(report, fout, indent=2, sort_keys=True)
+        print('baseline written to', args.baseline)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print('no baseline at', args.baseline,
+              '- run with --save-baseline to create one')
+        return 0
+
+    with open(args.baseline) as fin:
+        baseline = json.load(fin)
+    print('comparison with', args.baseline)
+    regressions = compare(bench.results, baseline['results'], args.tolerance)
+    if regressions:
+        print('\nPERFORMANCE REGRESSIONS (tolerance %d%%):' %
+              (args.tolerance * 100), file=sys.stderr)
+        for line in regressions:
+            print('  ' + line, file=sys.stderr)
+        return 1
+    print('no regressions')
+    return 0
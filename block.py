@@ -1,88 +1,132 @@
-from panda3d.core import Texture, TextureStage
+from panda3d.core import TextureStage
 from panda3d.core import BitMask32
 from panda3d.core import TransparencyAttrib
+from panda3d.core import LPoint3f
 
+from materials import loadMaterialTexture
+from palette import palette
+from chunkrenderer import packKey
 
-# Класс элемента строительного блока
+
+# Класс элемента строительного блока. Карта хранит блоки номерами
+# палитры в массивах чанков, а объекты блоков создаются по запросу
+# (узел Panda3D - только у блоков карты без отрисовщика чанков)
 class Block():
-    # свойство класса - текущий индекс объекта
-    current_index = 0
+    # атрибуты блока (без словаря __dict__ у каждого объекта)
+    __slots__ = ('key', 'position', 'index', 'block')
+
+    # общие для всех блоков образцы модели: с геометрией столкновения
+    # и без неё (загружаются один раз и подключаются к узлам блоков)
+    prototypes = dict()
+    # общая текстура блоков и её слой
+    texture = None
+    texture_stage = None
+
+    # Метод класса получения образца модели блока
+    @classmethod
+    def getPrototype(cls, with_collision):
+        prototype = cls.prototypes.get(with_collision)
+        if prototype is None:
+            # общие текстура и её слой
+            if cls.texture is None:
+                cls.texture = loader.loadTexture('block.png')
+                cls.texture_stage = TextureStage.getDefault()
+            # загружаем модель блока один раз
+            prototype = loader.loadModel('block')
+            # устанавливаем текстуру на модель
+            prototype.setTexture(cls.texture_stage, cls.texture)
+            # устанавливаем учёт прозрачности цвета
+            prototype.setTransparency(TransparencyAttrib.MAlpha)
+
+            # вместе с моделью загружается и геометрия столкновения
+            # ищем узел геометрии столкновения
+            collisionNodePath = prototype.find("*")
+            if with_collision:
+                # устанавливаем такую же маску ДО как и у луча выделения
+                collisionNodePath.node().setIntoCollideMask(BitMask32.bit(1))
+            else:
+                # столкновения не нужны (выделение лучом по сетке)
+                collisionNodePath.removeNode()
+            cls.prototypes[with_collision] = prototype
+        return prototype
 
     # Конструктор блока. Аргументы:
     #  position - позиция блока на сцене
-    #  color - цвет заливки
-    def __init__(self, position=(0, 0, 0), color=(1, 1, 1, 1)):
-        # получаем уникальный ключ объекта - текущий индекс
-        self.key = str(Block.current_index)
-        # увеличиваем индекс
-        Block.current_index += 1
-        # флаг выделенного блока
-        self.selected = False
-        # загружаем модель блока
-        self.block = loader.loadModel('block')
-        # и текстуру к ней
-        tex = loader.loadTexture('block.png')
-        # устанавливаем текстуру на модель
-        self.block.setTexture(tex)
-        # устанавливаем учёт прозрачности цвета
-        self.block.setTransparency(TransparencyAttrib.MAlpha)
-        # перемещение модели в рендер, смена родителя
-        self.block.reparentTo(render)
+    #  index - номер элемента палитры мира (цвет и материал)
+    #  with_node - создавать ли отдельный узел Panda3D для блока
+    #              (без узла блок отрисовывается чанками ChunkRenderer)
+    #  with_collision - оставлять ли в узле геометрию столкновения
+    #  parent - родительский узел (None - render)
+    def __init__(self, position=(0, 0, 0), index=1,
+                 with_node=True, with_collision=True, parent=None):
+        # позиция блока
+        self.position = (position[0], position[1], position[2])
+        # ключ блока - упакованные координаты его вокселя: блок в том же
+        # вокселе, созданный заново, получает тот же ключ
+        self.key = packKey(self.position)
+        # номер палитры: цвет блока (выделение рисуется отдельной рамкой
+        # SelectionBox) и его материал
+        self.index = index
+
+        # если узел не нужен - блок хранит только данные
+        if not with_node:
+            self.block = None
+            return
+
+        # создаём узел блока в рендере
+        self.block = (parent or render).attachNewNode('block')
+        # и подключаем к нему общую модель (без копирования геометрии)
+        Block.getPrototype(with_collision).instanceTo(self.block)
         # устанавливаем позицию модели
         self.block.setPos(position)
-        # устанавливаем цвет модели
-        self.color = color
-        self.block.setColor(self.color)
-
-        # настраиваем объект для определения выделения
-        # вместе с моделью загружается и геометрия столкновения
-        # ищем узел геометрии столкновения
-        collisionNode = self.block.find("*").node()
-        # устанавливаем такую же маску ДО как и у луча выделения
-        collisionNode.setIntoCollideMask(BitMask32.bit(1))
+        # устанавливаем цвет и материал модели
+        self.updateNode()
         # устанавливаем тег, чтобы потом определить что именно мы выделили
-        collisionNode.setTag('key', self.key)
+        if with_collision:
+            self.block.setTag('key', str(self.key))
 
     # Метод получения ключа блока
     def getKey(self):
         return self.key
 
+    # Метод получения номера палитры
+    def getIndex(self):
+        return self.index
+
     # Метод получения цвета
     def getColor(self):
-        return self.color
+        return palette.colors[self.index]
+
+    # Метод получения номера материала
+    def getMaterial(self):
+        return palette.materials[self.index]
+
+    # Метод обновления цвета и материала узла блока
+    # (после изменения элемента палитры)
+    def updateNode(self):
+        if not self.block:
+            return
+        self.block.setColor(self.getColor())
+        # материал, отличный от основного, - своя текстура
+        material = self.getMaterial()
+        if material:
+            self.block.setTexture(Block.texture_stage,
+                                  loadMaterialTexture(material), 1)
+        else:
+            self.block.clearTexture(Block.texture_stage)
 
     # Метод получения позиции блока
     def getPos(self):
-        return self.block.getPos()
+        return LPoint3f(*self.position)
 
-    # Метод получения узла с блоком
+    # Метод получения узла с блоком (None, если узла нет)
     def getNode(self):
         return self.block
 
-    # Метод установки выделения на блок
-    def setSelected(self, selected, color = (0, 0, 1, 1)):
-        # если изменился статус выделения
-        if self.selected != selected:
-            # сохраняем новый статус
-            self.selected = selected
-            if self.selected:
-                # устанавливаем цвет выделения
-                self.block.setColor(color)
-            else:
-                # устанавливаем оригинальный цвет
-                self.block.setColor(self.color)
-
-    # Метод обновления цвета блока
-    def updateColor(self, color):
-        self.block.setColor(color)
-
-    # Метод получения статуса выделения
-    def getSelected(self):
-        return self.selected
-
     # Метод удаления объекта блока из Panda3D
     def remove(self):
-        self.block.removeNode()
+        if self.block:
+            self.block.removeNode()
 
 
 if __name__ == '__main__':
@@ -94,10 +138,10 @@ if __name__ == '__main__':
         def __init__(self):
             ShowBase.__init__(self)
 
-            b1 = Block((0,10,0), (0.5,1,0.5,0.2))
-            b2 = Block((1,10,0), (1,1,0.5,1))
-            b3 = Block((0,10,2), (0.5,1,1,1))
-            b4 = Block((-2,15,-2), (1,0.5,1,1))
+            b1 = Block((0,10,0), palette.indexOf((0.5,1,0.5,0.2)))
+            b2 = Block((1,10,0), palette.indexOf((1,1,0.5,1)))
+            b3 = Block((0,10,2), palette.indexOf((0.5,1,1,1)))
+            b4 = Block((-2,15,-2), palette.indexOf((1,0.5,1,1)))
 
     app = MyApp()
     app.run()
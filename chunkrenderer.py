@@ -0,0 +1,832 @@
+from panda3d.core import GeomVertexFormat, GeomVertexArrayFormat
+from panda3d.core import GeomVertexData, GeomTriangles, Geom, GeomNode
+from panda3d.core import InternalName, RenderState, TransparencyAttrib
+from panda3d.core import CollisionNode, CollisionBox, BitMask32, Point3
+from panda3d.core import LODNode, PandaNode, BoundingVolume
+import numpy as np
+
+from materials import MaterialAtlas
+from palette import palette
+from profiler import profiled
+from scheduler import scheduler
+
+# размер чанка (куба из CHUNK_SIZE^3 блоков)
+CHUNK_SIZE = 16
+
+# направления граней блока: нормаль грани
+FACE_NORMALS = np.array([(1, 0, 0), (-1, 0, 0),
+                         (0, 1, 0), (0, -1, 0),
+                         (0, 0, 1), (0, 0, -1)], dtype=np.int32)
+
+# формат вершины чанка: позиция, нормаль, цвет, текстурные координаты,
+# номер материала (клетка атласа материалов)
+VERTEX_DTYPE = np.dtype([('vertex', np.float32, 3),
+                         ('normal', np.float32, 3),
+                         ('color', np.float32, 4),
+                         ('texcoord', np.float32, 2),
+                         ('material', np.float32)])
+
+# имя колонки номера материала в формате вершин
+MATERIAL_COLUMN = InternalName.make('material')
+
+# затенение угла грани соседними блоками (ambient occlusion):
+# индекс - количество открытых соседей угла (0 - угол в щели)
+AO_SHADES = np.array([0.55, 0.7, 0.85, 1.0], dtype=np.float32)
+
+
+# Функция построения углов грани с нормалью normal
+# (против часовой стрелки, если смотреть снаружи блока)
+def getFaceCorners(normal):
+    axis = int(np.nonzero(normal)[0][0])
+    sign = normal[axis]
+    u = (axis + 1) % 3
+    v = (axis + 2) % 3
+    corners = []
+    uvs = []
+    for a, b in [(-1, -1), (1, -1), (1, 1), (-1, 1)]:
+        corner = [0.0, 0.0, 0.0]
+        corner[axis] = 0.5 * sign
+        corner[u] = 0.5 * a
+        corner[v] = 0.5 * b
+        corners.append(corner)
+        uvs.append(((a + 1) // 2, (b + 1) // 2))
+    # для отрицательной нормали меняем порядок обхода
+    if sign < 0:
+        corners.reverse()
+        uvs.reverse()
+    return (np.array(corners, dtype=np.float32),
+            np.array(uvs, dtype=np.float32))
+
+# углы и текстурные координаты для всех шести граней
+FACE_CORNERS = [getFaceCorners(normal) for normal in FACE_NORMALS]
+
+# индексы двух треугольников грани
+QUAD_INDICES = np.array([0, 1, 2, 0, 2, 3], dtype=np.uint32)
+
+# уровни детализации по умолчанию: (расстояние от камеры до центра чанка,
+# начиная с которого он рисуется укрупнёнными вокселями, размер
+# крупного вокселя в блоках)
+LOD_LEVELS = ((96, 2), (192, 4))
+
+
+# Функция получения ключа чанка для вокселя
+def chunkOf(voxel):
+    return (voxel[0] // CHUNK_SIZE,
+            voxel[1] // CHUNK_SIZE,
+            voxel[2] // CHUNK_SIZE)
+
+
+# Функция группировки номеров строк массива по ключам.
+# Аргументы:
+#  keys - массив (n, 3) целочисленных ключей
+# Возвращает словарь: ключ (кортеж) - массив номеров строк
+def groupRows(keys):
+    if not len(keys):
+        return dict()
+    packed, inverse = np.unique(packKeys(keys), return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.searchsorted(inverse[order], np.arange(len(packed) + 1))
+    first = order[bounds[:-1]]
+    return {tuple(key): order[bounds[i]:bounds[i + 1]]
+            for i, key in enumerate(keys[first].tolist())}
+
+
+# Функция упаковки целочисленных координат (n, 3) в массив int64
+# (по 21 бит на ось), чтобы сортировать и сравнивать их как числа
+def packKeys(keys):
+    keys = np.asarray(keys, dtype=np.int64) + (1 << 20)
+    return (keys[:, 0] << 42) | (keys[:, 1] << 21) | keys[:, 2]
+
+
+# Функция упаковки координат одного вокселя в число (как packKeys)
+def packKey(voxel):
+    return (((voxel[0] + (1 << 20)) << 42) | ((voxel[1] + (1 << 20)) << 21) |
+            (voxel[2] + (1 << 20)))
+
+
+# Функция распаковки числа packKey обратно в координаты вокселя
+def unpackKey(key):
+    mask = (1 << 21) - 1
+    return (((key >> 42) & mask) - (1 << 20),
+            ((key >> 21) & mask) - (1 << 20),
+            (key & mask) - (1 << 20))
+
+
+# Функция построения формата вершин Panda3D для VERTEX_DTYPE
+def makeVertexFormat():
+    array = GeomVertexArrayFormat()
+    array.addColumn(InternalName.getVertex(), 3,
+                    Geom.NT_float32, Geom.C_point)
+    array.addColumn(InternalName.getNormal(), 3,
+                    Geom.NT_float32, Geom.C_normal)
+    array.addColumn(InternalName.getColor(), 4,
+                    Geom.NT_float32, Geom.C_color)
+    array.addColumn(InternalName.getTexcoord(), 2,
+                    Geom.NT_float32, Geom.C_texcoord)
+    array.addColumn(MATERIAL_COLUMN, 1, Geom.NT_float32, Geom.C_other)
+    return GeomVertexFormat.registerFormat(GeomVertexFormat(array))
+
+
+# Функция жадного объединения граней в одном слое. Аргументы:
+#  layer - двумерный массив номеров цветов граней (0 - грани нет)
+# Возвращает список прямоугольников (i, j, высота, ширина, номер цвета).
+def greedyLayer(layer):
+    layer = layer.copy()
+    rows, cols = layer.shape
+    quads = []
+    for i in range(rows):
+        row = layer[i]
+        j = 0
+        while j < cols:
+            color = row[j]
+            if not color:
+                j += 1
+                continue
+            # расширяем прямоугольник вдоль строки
+            width = 1
+            while j + width < cols and row[j + width] == color:
+                width += 1
+            # и вниз, пока строки полностью совпадают
+            height = 1
+            while (i + height < rows and
+                   (layer[i + height, j:j + width] == color).all()):
+                height += 1
+            # помечаем покрытые грани как обработанные
+            layer[i:i + height, j:j + width] = 0
+            quads.append((i, j, height, width, color))
+            j += width
+    return quads
+
+
+# Функция построения массивов вершин одного чанка. Аргументы:
+#  origin - координаты угла чанка (минимальный воксель)
+#  positions - массив (n, 3) целочисленных координат блоков чанка
+#  colors - массив (n, 4) цветов блоков
+#  border - массив (m, 3) координат непрозрачных блоков соседних чанков,
+#           прилегающих к границе чанка
+#  greedy - объединять ли соседние грани одного цвета и материала
+#           в большие квадраты
+#  materials - массив (n,) номеров материалов блоков (None - все 0)
+#  shading - освещение чанка (результат LightEngine.getShading,
+#            None - цвета вершин без освещения и затенения)
+# Возвращает (вершины, индексы непрозрачных, индексы прозрачных граней,
+# число граней до объединения).
+# Функция не использует Panda3D и может выполняться в любом потоке.
+def buildChunkArrays(origin, positions, colors, border, greedy=False,
+                     materials=None, shading=None):
+    origin = np.asarray(origin, dtype=np.int32)
+    positions = np.asarray(positions, dtype=np.int32).reshape(-1, 3)
+    colors = np.asarray(colors, dtype=np.float32).reshape(-1, 4)
+    if materials is None:
+        materials = np.zeros(len(positions), dtype=np.float32)
+
+    # плотная сетка непрозрачных блоков с рамкой в один блок
+    solid = np.zeros((CHUNK_SIZE + 2,) * 3, dtype=bool)
+    opaque = colors[:, 3] >= 1.0
+    local = positions - origin + 1
+    solid[tuple(local[opaque].T)] = True
+    if len(border):
+        border_local = np.asarray(border, dtype=np.int32) - origin + 1
+        solid[tuple(border_local.T)] = True
+
+    # номера пар (цвет, материал) блоков (для объединения граней)
+    looks = np.empty((len(colors), 5), dtype=np.float32)
+    looks[:, :4] = colors
+    looks[:, 4] = materials
+    if greedy and len(colors):
+        palette, color_ids = np.unique(looks, axis=0, return_inverse=True)
+        color_ids = color_ids.reshape(-1)
+    else:
+        palette, color_ids = looks, np.arange(len(colors))
+
+    faces = 0
+    vertex_parts = []
+    for face in range(6):
+        # грань видна, если соседний блок отсутствует или прозрачный
+        neighbour = local + FACE_NORMALS[face]
+        visible = ~solid[tuple(neighbour.T)]
+        count = int(visible.sum())
+        if not count:
+            continue
+        faces += count
+        ids = color_ids[visible]
+        shades = (None if shading is None else
+                  getFaceShades(face, local[visible], *shading))
+        if greedy:
+            merge_ids = ids
+            if shades is not None:
+                # объединяются только одинаково освещённые грани
+                # без перепада затенения между углами
+                keys = np.empty((count, 2), dtype=np.float64)
+                keys[:, 0] = ids
+                keys[:, 1] = np.where((shades == shades[:, :1]).all(axis=1),
+                                      shades[:, 0], -1 - np.arange(count))
+                _, first, merge_ids = np.unique(keys, axis=0,
+                                                return_index=True,
+                                                return_inverse=True)
+                merge_ids = merge_ids.reshape(-1)
+            starts, sizes, groups = greedyFaces(face, local[visible] - 1,
+                                                merge_ids)
+            starts += origin
+            if shades is not None:
+                shades = shades[first[groups]]
+                groups = first[groups]
+                ids = ids[groups]
+            else:
+                ids = groups
+        else:
+            starts = positions[visible]
+            sizes = np.ones((count, 2), dtype=np.float32)
+        vertex_parts.append(makeQuads(face, starts, sizes, palette[ids, :4],
+                                      palette[ids, 4], shades))
+
+    if not vertex_parts:
+        empty = np.empty(0, dtype=np.uint32)
+        return np.empty(0, dtype=VERTEX_DTYPE), empty, empty, 0
+
+    vertices = np.concatenate(vertex_parts)
+    transparent = vertices['color'][::4, 3] < 1.0
+    # индексы треугольников для каждой грани
+    quads = np.arange(len(transparent), dtype=np.uint32)
+    indices = (quads[:, None] * 4 + QUAD_INDICES[None]).reshape(-1, 6)
+    return (vertices,
+            indices[~transparent].reshape(-1),
+            indices[transparent].reshape(-1),
+            faces)
+
+
+# Функция укрупнения вокселей чанка: блоки группируются в кубы
+# factor^3, цвет куба - средний цвет его блоков, материал - материал
+# первого из них. Аргументы:
+#  origin - координаты угла чанка
+#  positions, colors, materials - блоки чанка (materials может быть None)
+#  factor - размер крупного вокселя в блоках
+# Возвращает (координаты крупных вокселей относительно угла чанка,
+# их цвета, их материалы)
+def downsampleChunk(origin, positions, colors, factor, materials=None):
+    cells = (np.asarray(positions, dtype=np.int32) - origin) // factor
+    _, first, inverse = np.unique(packKeys(cells), return_index=True,
+                                  return_inverse=True)
+    counts = np.bincount(inverse, minlength=len(first))[:, None]
+    sums = np.zeros((len(first), 4), dtype=np.float64)
+    np.add.at(sums, inverse, colors)
+    if materials is None:
+        cell_materials = np.zeros(len(first), dtype=np.float32)
+    else:
+        cell_materials = np.asarray(materials)[first]
+    return cells[first], (sums / counts).astype(np.float32), cell_materials
+
+
+# Функция построения укрупнённой геометрии чанка (для дальних чанков).
+# Аргументы как у buildChunkArrays, factor - размер крупного вокселя.
+# Грани на границе чанка не отсекаются. Результат - как у buildChunkArrays
+def buildLodArrays(origin, positions, colors, factor, greedy=False,
+                   materials=None):
+    origin = np.asarray(origin, dtype=np.int32)
+    cells, cell_colors, cell_materials = downsampleChunk(
+        origin, positions, colors, factor, materials)
+    vertices, opaque, transparent, faces = buildChunkArrays(
+        np.zeros(3, dtype=np.int32), cells, cell_colors,
+        np.empty((0, 3), dtype=np.int32), greedy, cell_materials)
+    # крупный воксель c занимает блоки от origin + factor * c
+    # до origin + factor * (c + 1) - 1
+    vertices['vertex'] = (vertices['vertex'] * factor + origin +
+                          (factor - 1) / 2)
+    return vertices, opaque, transparent, faces
+
+
+# Функция построения геометрии всех уровней детализации чанка.
+# levels - уровни детализации (как LOD_LEVELS).
+# Возвращает список результатов buildLodArrays
+def buildChunkLods(origin, positions, colors, levels, greedy=False,
+                   materials=None):
+    return [buildLodArrays(origin, positions, colors, factor, greedy,
+                           materials)
+            for distance, factor in levels]
+
+
+# Функция жадного объединения видимых граней одного направления.
+# Аргументы:
+#  face - номер направления грани
+#  local - координаты блоков с видимой гранью внутри чанка
+#  color_ids - номера цветов этих блоков
+# Возвращает (начальные блоки, размеры по осям u и v, номера цветов).
+def greedyFaces(face, local, color_ids):
+    axis = int(np.nonzero(FACE_NORMALS[face])[0][0])
+    u = (axis + 1) % 3
+    v = (axis + 2) % 3
+    # сетка граней в осях (axis, u, v); 0 - грани нет
+    grid = np.zeros((CHUNK_SIZE,) * 3, dtype=np.int32)
+    grid[local[:, axis], local[:, u], local[:, v]] = color_ids + 1
+
+    starts, sizes, ids = [], [], []
+    for layer in np.unique(local[:, axis]):
+        for i, j, height, width, color in greedyLayer(grid[layer]):
+            start = [0, 0, 0]
+            start[axis] = layer
+            start[u] = i
+            start[v] = j
+            starts.append(start)
+            sizes.append((height, width))
+            ids.append(color - 1)
+    return (np.array(starts, dtype=np.int32),
+            np.array(sizes, dtype=np.float32),
+            np.array(ids, dtype=np.int64))
+
+
+# Функция расчёта яркости углов видимых граней одного направления:
+# освещённость, сглаженная по вокселям перед углом, и затенение
+# угла соседними блоками. Аргументы:
+#  face - номер направления грани
+#  local - координаты блоков в сетке чанка с рамкой (n, 3)
+#  solid - непрозрачные воксели чанка с рамкой
+#  brightness - яркость вокселей чанка с рамкой
+# Возвращает массив (n, 4) яркости углов в порядке FACE_CORNERS
+def getFaceShades(face, local, solid, brightness):
+    axis = int(np.nonzero(FACE_NORMALS[face])[0][0])
+    u = (axis + 1) % 3
+    v = (axis + 2) % 3
+    corners = FACE_CORNERS[face][0]
+    # воксель перед гранью
+    front = local + FACE_NORMALS[face]
+    front_light = brightness[tuple(front.T)]
+
+    shades = np.empty((len(local), 4), dtype=np.float32)
+    for corner in range(4):
+        step_u = np.zeros(3, dtype=np.int32)
+        step_v = np.zeros(3, dtype=np.int32)
+        step_u[u] = 1 if corners[corner, u] > 0 else -1
+        step_v[v] = 1 if corners[corner, v] > 0 else -1
+        # два соседа по сторонам угла и сосед по диагонали
+        side_u = tuple((front + step_u).T)
+        side_v = tuple((front + step_v).T)
+        diagonal = tuple((front + step_u + step_v).T)
+        solid_u = solid[side_u]
+        solid_v = solid[side_v]
+        # диагональ за двумя непрозрачными соседями не видна
+        solid_d = solid[diagonal] | (solid_u & solid_v)
+        occlusion = np.where(solid_u & solid_v, 0,
+                             3 - solid_u - solid_v - solid[diagonal])
+        light = (front_light + np.where(solid_u, 0, brightness[side_u]) +
+                 np.where(solid_v, 0, brightness[side_v]) +
+                 np.where(solid_d, 0, brightness[diagonal]))
+        count = 4 - solid_u.astype(np.int32) - solid_v - solid_d
+        shades[:, corner] = light / count * AO_SHADES[occlusion]
+    return shades
+
+
+# Функция построения вершин прямоугольников граней. Аргументы:
+#  face - номер направления грани
+#  starts - массив (n, 3) блоков, с которых начинается прямоугольник
+#  sizes - массив (n, 2) размеров прямоугольников по осям u и v (в блоках)
+#  colors - массив (n, 4) цветов прямоугольников
+#  materials - массив (n,) номеров материалов прямоугольников
+#  shades - массив (n, 4) яркости углов (None - без освещения)
+def makeQuads(face, starts, sizes, colors, materials, shades=None):
+    axis = int(np.nonzero(FACE_NORMALS[face])[0][0])
+    u = (axis + 1) % 3
+    v = (axis + 2) % 3
+    corners, uvs = FACE_CORNERS[face]
+
+    # растягиваем углы единичной грани на размер прямоугольника
+    scale = np.ones((len(starts), 3), dtype=np.float32)
+    scale[:, u] = sizes[:, 0]
+    scale[:, v] = sizes[:, 1]
+
+    verts = np.empty((len(starts), 4), dtype=VERTEX_DTYPE)
+    verts['vertex'] = (starts[:, None, :] +
+                       (corners[None] + 0.5) * scale[:, None, :] - 0.5)
+    verts['vertex'][:, :, axis] = (starts[:, None, axis] +
+                                   corners[None, :, axis])
+    verts['normal'] = FACE_NORMALS[face]
+    verts['color'] = colors[:, None, :]
+    if shades is not None:
+        verts['color'][:, :, :3] *= shades[:, :, None]
+    # текстура повторяется на каждом блоке прямоугольника
+    verts['texcoord'] = uvs[None] * sizes[:, None, :]
+    verts['material'] = materials[:, None]
+    return verts.reshape(-1)
+
+
+# Класс отрисовки карты чанками: один GeomVertexData на чанк.
+# Изменённые чанки перестраиваются постепенно, в пределах бюджета кадра
+# планировщика (updateChunks перестраивает все сразу)
+class ChunkRenderer():
+    # формат вершин, общий для всех чанков
+    vertex_format = None
+
+    # Конструктор. Аргументы:
+    #  map_manager - менеджер карты, блоки которого отрисовываются
+    #                (его хранилище чанков store уже создано)
+    #  collisions - создавать ли геометрию столкновения для чанков
+    #  lod_levels - уровни детализации дальних чанков
+    #               (как LOD_LEVELS, пустой - без укрупнения)
+    def __init__(self, map_manager, collisions=True, lod_levels=LOD_LEVELS):
+        self.map_manager = map_manager
+        self.collisions = collisions
+        self.lod_levels = tuple(lod_levels)
+
+        if ChunkRenderer.vertex_format is None:
+            ChunkRenderer.vertex_format = makeVertexFormat()
+
+        # корневой узел всех чанков
+        self.root = render.attachNewNode('chunks')
+        # общий атлас текстур всех материалов
+        self.atlas = MaterialAtlas()
+        self.atlas.apply(self.root)
+
+        # словарь непустых чанков хранилища карты (ChunkStore.chunks):
+        # отрисовщик читает только его ключи
+        self.chunks = map_manager.store.chunks
+        # словарь узлов чанков: ключ чанка - узел
+        self.nodes = dict()
+        # множество чанков, требующих перестройки
+        self.dirty = set()
+        # статистика последней сборки: ключ чанка -
+        #   (треугольников до объединения граней, треугольников после)
+        self.triangles = dict()
+        # режим жадного объединения граней
+        self.greedy = False
+        # множество чанков, блоки которых добавлялись или удалялись
+        self.edited = set()
+        # счётчик приостановок перестройки (пакетные изменения карты)
+        self.suspended = 0
+        # освещение вокселей (LightEngine, None - без освещения)
+        self.lighting = None
+
+        # состояние для прозрачных граней
+        self.transparent_state = RenderState.make(
+            TransparencyAttrib.make(TransparencyAttrib.MAlpha))
+
+        # перестройка изменённых чанков - фоновые работы планировщика
+        # в пределах бюджета кадра, ближние к камере - первыми
+        self.jobs = scheduler.createQueue('chunk-rebuild',
+                                          self.rebuildDirty)
+        # задача постановки изменённых чанков в очередь
+        # (до задачи планировщика)
+        taskMgr.add(self.updateTask, 'chunk-update-task', sort=44)
+
+    # Метод пометки чанков, затронутых изменением вокселя voxel
+    def blockChanged(self, voxel):
+        self.updateLight(np.array([voxel], dtype=np.int64))
+        key = chunkOf(voxel)
+        self.dirty.add(key)
+        # если воксель на границе чанка - перестраиваем и соседей
+        # (по граням, рёбрам и углам - от них зависит затенение углов)
+        steps = []
+        for axis in range(3):
+            local = voxel[axis] % CHUNK_SIZE
+            steps.append((0, -1) if local == 0 else
+                         (0, 1) if local == CHUNK_SIZE - 1 else (0,))
+        for dx in steps[0]:
+            for dy in steps[1]:
+                for dz in steps[2]:
+                    neighbour = (key[0] + dx, key[1] + dy, key[2] + dz)
+                    if neighbour in self.chunks:
+                        self.dirty.add(neighbour)
+
+    # Метод добавления вокселя voxel
+    def blockAdded(self, voxel):
+        self.edited.add(chunkOf(voxel))
+        self.blockChanged(voxel)
+
+    # Метод удаления вокселя voxel
+    def blockRemoved(self, voxel):
+        self.edited.add(chunkOf(voxel))
+        self.blockChanged(voxel)
+
+    # Метод добавления множества вокселей за один проход. Аргументы:
+    #  positions - массив (n, 3) координат вокселей
+    #  opaque - массив (n,) непрозрачности блоков (None - по блокам карты)
+    def blocksAdded(self, positions, opaque=None):
+        self.edited.update(groupRows(positions // CHUNK_SIZE))
+        self.updateLight(positions, opaque)
+        self.markDirty(positions)
+
+    # Метод удаления множества вокселей positions за один проход
+    def blocksRemoved(self, positions):
+        self.edited.update(groupRows(positions // CHUNK_SIZE))
+        self.updateLight(positions, False)
+        self.markDirty(positions)
+
+    # Метод пометки вокселей, у которых изменился цвет
+    # (аргументы как у blocksAdded; opaque - новая непрозрачность,
+    # None - она не изменилась)
+    def blocksChanged(self, positions, opaque=None):
+        for key in groupRows(positions // CHUNK_SIZE):
+            self.edited.add(key)
+        if opaque is not None:
+            self.updateLight(positions, opaque)
+        self.markDirty(positions)
+
+    # Метод передачи освещению непрозрачности вокселей positions
+    # (opaque - массив непрозрачности, None - по блокам карты)
+    def updateLight(self, positions, opaque=None):
+        if self.lighting is None:
+            return
+        if opaque is not None:
+            self.lighting.setSolid(positions, opaque)
+            return
+        indices = self.map_manager.store.getMany(positions)
+        opaque = palette.getColors(indices)[:, 3] >= 1.0
+        self.lighting.setSolid(positions, opaque)
+
+    # Метод пересчёта накопленных изменений освещения
+    # и пометки чанков, у которых оно изменилось
+    def updateLighting(self):
+        if self.lighting is None:
+            return
+        positions, removed = self.lighting.update()
+        if len(positions):
+            self.markDirty(positions)
+        # воксели чанков без хранимой освещённости освещены иначе
+        for key in removed:
+            for offset in np.ndindex(3, 3, 3):
+                neighbour = (key[0] + offset[0] - 1, key[1] + offset[1] - 1,
+                             key[2] + offset[2] - 1)
+                if neighbour in self.chunks:
+                    self.dirty.add(neighbour)
+
+    # Метод пометки для перестройки чанков с вокселями positions
+    # и соседних чанков, к границе которых эти воксели прилегают
+    # (по граням, рёбрам и углам - от них зависит затенение углов граней)
+    def markDirty(self, positions):
+        chunks = positions // CHUNK_SIZE
+        local = positions % CHUNK_SIZE
+        # для каждой оси: воксели у нижней и у верхней границы чанка
+        edges = [(local[:, axis] == 0, local[:, axis] == CHUNK_SIZE - 1)
+                 for axis in range(3)]
+        keys = [chunks]
+        for offset in np.ndindex(3, 3, 3):
+            if offset == (1, 1, 1):
+                continue
+            near = np.ones(len(positions), dtype=bool)
+            for axis, step in enumerate(offset):
+                if step != 1:
+                    near &= edges[axis][step // 2]
+            neighbours = chunks[near]
+            neighbours += np.array(offset) - 1
+            keys.append(neighbours)
+        keys = np.concatenate(keys)
+        _, first = np.unique(packKeys(keys), return_index=True)
+        for key in map(tuple, keys[first].tolist()):
+            # опустевшему чанку нужно убрать прежнюю геометрию
+            if key in self.chunks or key in self.nodes:
+                self.dirty.add(key)
+
+    # Метод приостановки перестройки чанков
+    def suspend(self):
+        self.suspended += 1
+
+    # Метод возобновления перестройки чанков: после последнего
+    # возобновления изменённые чанки перестраиваются работами планировщика
+    def resume(self):
+        self.suspended -= 1
+
+    # Метод удаления всех чанков
+    def clear(self):
+        for node in self.nodes.values():
+            node.removeNode()
+        self.nodes.clear()
+        self.dirty.clear()
+        self.jobs.clear()
+        self.triangles.clear()
+        self.edited.clear()
+        if self.lighting is not None:
+            self.lighting.clear()
+
+    # Задача постановки изменённых чанков в очередь перестройки (раз в кадр)
+    def updateTask(self, task):
+        if not self.suspended:
+            self.updateLighting()
+            self.queueDirty()
+        return task.cont
+
+    # Метод постановки изменённых чанков в очередь перестройки
+    def queueDirty(self):
+        half = (CHUNK_SIZE - 1) / 2
+        for key in self.dirty:
+            if key not in self.jobs:
+                self.jobs.submit(key, (key[0] * CHUNK_SIZE + half,
+                                       key[1] * CHUNK_SIZE + half,
+                                       key[2] * CHUNK_SIZE + half))
+
+    # Работа планировщика: перестройка чанка key, если он ещё изменён
+    def rebuildDirty(self, key):
+        if key in self.dirty:
+            self.dirty.discard(key)
+            self.rebuildChunk(key)
+
+    # Метод немедленной перестройки всех изменённых чанков
+    def updateChunks(self):
+        self.updateLighting()
+        self.jobs.clear()
+        while self.dirty:
+            self.rebuildChunk(self.dirty.pop())
+
+    # Метод сбора непрозрачных блоков соседних чанков,
+    # прилегающих к границе чанка
+    def getBorderSolids(self, positions):
+        border = []
+        for axis in range(3):
+            local = positions[:, axis] % CHUNK_SIZE
+            for edge, step in ((0, -1), (CHUNK_SIZE - 1, 1)):
+                neighbours = positions[local == edge]
+                neighbours[:, axis] += step
+                border.append(neighbours)
+        border = np.concatenate(border).astype(np.int32)
+        indices = self.map_manager.store.getMany(border)
+        return border[palette.getColors(indices)[:, 3] >= 1.0]
+
+    # Метод перестройки геометрии чанка key
+    @profiled
+    def rebuildChunk(self, key):
+        positions, indices = self.map_manager.store.getChunk(key)
+        if not len(positions):
+            self.removeChunk(key)
+            return
+
+        # цвета и материалы - по номерам палитры блоков
+        colors = palette.getColors(indices).astype(np.float32)
+        materials = palette.getMaterials(indices).astype(np.float32)
+        origin = np.array(key, dtype=np.int32) * CHUNK_SIZE
+        border = self.getBorderSolids(positions)
+        shading = (self.lighting.getShading(key)
+                   if self.lighting is not None else None)
+
+        self.setChunkMesh(key, buildChunkArrays(
+            origin, positions, colors, border, self.greedy, materials,
+            shading),
+            lods=buildChunkLods(origin, positions, colors,
+                                self.lod_levels, self.greedy, materials))
+
+    # Метод установки готовой геометрии чанка key. Аргументы:
+    #  mesh - результат buildChunkArrays (может быть построен в другом потоке,
+    #         None - чанк будет построен перестройкой)
+    #  positions - массив (n, 3) координат блоков чанка
+    #              (если чанк добавляется целиком)
+    #  lods - результат buildChunkLods для текущих уровней детализации
+    #         (None - строятся здесь по блокам чанка)
+    def setChunkMesh(self, key, mesh, positions=None, lods=None):
+        if positions is not None:
+            self.dirty.discard(key)
+            if self.lighting is not None:
+                self.updateLight(np.asarray(positions,
+                                            dtype=np.int64).reshape(-1, 3))
+                # готовая геометрия построена без освещения
+                self.dirty.add(key)
+        if mesh is None:
+            self.dirty.add(key)
+            return
+
+        # удаляем старый узел чанка
+        node = self.nodes.pop(key, None)
+        if node is not None:
+            node.removeNode()
+        self.triangles.pop(key, None)
+
+        vertices, opaque, transparent, faces = mesh
+        if not len(vertices):
+            return
+
+        if not self.lod_levels:
+            node = self.root.attachNewNode(
+                self.makeGeomNode(key, vertices, opaque, transparent))
+        else:
+            if lods is None:
+                positions, colors, materials = (
+                    self.map_manager.getChunkArrays(key))
+                lods = buildChunkLods(
+                    np.array(key, dtype=np.int32) * CHUNK_SIZE, positions,
+                    colors, self.lod_levels, self.greedy, materials)
+            node = self.root.attachNewNode(PandaNode('chunk_%d_%d_%d' % key))
+            node.node().setBoundsType(BoundingVolume.BT_box)
+            node.attachNewNode(self.makeLodNode(key, mesh, lods))
+        if self.collisions:
+            node.attachNewNode(self.makeCollisionNode(key, vertices))
+        self.nodes[key] = node
+        self.triangles[key] = (faces * 2,
+                               (len(opaque) + len(transparent)) // 3)
+
+    # Метод удаления геометрии чанка key
+    # (блоки чанка удаляет из хранилища менеджер карты)
+    def removeChunk(self, key):
+        node = self.nodes.pop(key, None)
+        if node is not None:
+            node.removeNode()
+        self.triangles.pop(key, None)
+        self.dirty.discard(key)
+        self.jobs.cancel(key)
+        self.edited.discard(key)
+        if self.lighting is not None:
+            self.lighting.removeChunk(key)
+
+    # Метод создания узла уровней детализации чанка: вблизи рисуется
+    # полная геометрия mesh, дальше - укрупнённые lods.
+    # Переключение по расстоянию выполняет сам Panda3D при отсечении
+    def makeLodNode(self, key, mesh, lods):
+        lod_node = LODNode('chunk_lod_%d_%d_%d' % key)
+        lod_node.setBoundsType(BoundingVolume.BT_box)
+        # расстояние считается до центра чанка
+        lod_node.setCenter(Point3(*[k * CHUNK_SIZE + (CHUNK_SIZE - 1) / 2
+                                    for k in key]))
+        distances = [0] + [distance for distance, factor in self.lod_levels]
+        distances.append(float('inf'))
+        for level, (vertices, opaque, transparent, faces) in enumerate(
+                [mesh] + list(lods)):
+            lod_node.addSwitch(distances[level + 1], distances[level])
+            lod_node.addChild(self.makeGeomNode(key, vertices, opaque,
+                                                transparent, level))
+        return lod_node
+
+    # Метод создания узла геометрии чанка из массивов вершин и индексов
+    # (level - номер уровня детализации, только для имени узла)
+    def makeGeomNode(self, key, vertices, opaque, transparent, level=0):
+        vdata = GeomVertexData('chunk', ChunkRenderer.vertex_format,
+                               Geom.UH_static)
+        vdata.uncleanSetNumRows(len(vertices))
+        if len(vertices):
+            memoryview(vdata.modifyArray(0)).cast('B')[:] = vertices.tobytes()
+
+        geom_node = GeomNode('chunk_%d_%d_%d' % key +
+                             ('_lod%d' % level if level else ''))
+        # границы - параллелепипед: для кубов он точнее сферы
+        geom_node.setBoundsType(BoundingVolume.BT_box)
+        for indices, state in ((opaque, RenderState.makeEmpty()),
+                               (transparent, self.transparent_state)):
+            if not len(indices):
+                continue
+            triangles = GeomTriangles(Geom.UH_static)
+            triangles.setIndexType(Geom.NT_uint32)
+            handle = triangles.modifyVertices()
+            handle.uncleanSetNumRows(len(indices))
+            memoryview(handle).cast('B')[:] = indices.tobytes()
+            geom = Geom(vdata)
+            geom.setBoundsType(BoundingVolume.BT_box)
+            geom.addPrimitive(triangles)
+            geom_node.addGeom(geom, state)
+        return geom_node
+
+    # Метод создания узла столкновений чанка:
+    # по одной коробке на каждый блок, у которого есть видимые грани
+    def makeCollisionNode(self, key, vertices):
+        collision_node = CollisionNode('chunk_collision_%d_%d_%d' % key)
+        # центр блока - центр его видимой грани минус половина нормали
+        quads = vertices['vertex'].reshape(-1, 4, 3)
+        normals = vertices['normal'][::4]
+        centers = quads.mean(axis=1) - normals * 0.5
+        for voxel in np.unique(np.rint(centers).astype(np.int32), axis=0):
+            collision_node.addSolid(
+                CollisionBox(Point3(*voxel), 0.5, 0.5, 0.5))
+        # такая же маска ДО, как у блоков
+        collision_node.setIntoCollideMask(BitMask32.bit(1))
+        return collision_node
+
+    # Метод установки уровней детализации (как LOD_LEVELS,
+    # пустой - все чанки рисуются полностью)
+    def setLodLevels(self, levels):
+        levels = tuple(levels)
+        if self.lod_levels != levels:
+            self.lod_levels = levels
+            # перестраиваем все чанки с новыми уровнями
+            self.dirty.update(self.chunks)
+
+    # Метод установки освещения вокселей (LightEngine, None - без
+    # освещения): освещение заполняется по всем блокам карты
+    def setLighting(self, lighting):
+        self.lighting = lighting
+        if lighting is not None:
+            lighting.clear()
+            self.updateLight(self.map_manager.store.getBlocks()[0])
+        # перестраиваем все чанки с новым освещением
+        self.dirty.update(self.chunks)
+
+    # Метод включения/выключения жадного объединения граней
+    def setGreedy(self, greedy):
+        if self.greedy != greedy:
+            self.greedy = greedy
+            # перестраиваем все чанки в новом режиме
+            self.dirty.update(self.chunks)
+
+    # Метод получения общего числа треугольников
+    def getTriangleCount(self):
+        return sum(after for before, after in self.triangles.values())
+
+    # Метод получения статистики треугольников по чанкам
+    # (до и после объединения граней) и общих сумм
+    def getStats(self):
+        before = sum(item[0] for item in self.triangles.values())
+        after = sum(item[1] for item in self.triangles.values())
+        return {'greedy': self.greedy,
+                'chunks': dict(self.triangles),
+                'triangles_before': before,
+                'triangles_after': after}
+
+    # Метод вывода статистики треугольников по чанкам
+    def printStats(self):
+        stats = self.getStats()
+        print('greedy meshing:', 'on' if stats['greedy'] else 'off')
+        for key, (before, after) in sorted(stats['chunks'].items()):
+            print('  chunk', key, 'triangles', before, '->', after)
+        print('total triangles', stats['triangles_before'],
+              '->', stats['triangles_after'])
@@ -0,0 +1,273 @@
+import sys
+import numpy as np
+
+from chunkrenderer import CHUNK_SIZE, groupRows
+
+# количество вокселей чанка
+CHUNK_VOLUME = CHUNK_SIZE ** 3
+# форма плотного массива чанка
+CHUNK_SHAPE = (CHUNK_SIZE,) * 3
+# локальные координаты (CHUNK_VOLUME, 3) вокселей чанка
+# в порядке плоского массива [x][y][z]
+CHUNK_CELLS = np.indices(CHUNK_SHAPE).reshape(3, -1).T.astype(np.int32)
+
+
+# Функция получения наименьшего типа массива для номеров палитры
+# не больше largest
+def gridType(largest):
+    return np.uint8 if largest < 1 << 8 else np.uint16
+
+
+# Функция кодирования длинами серий плотного массива чанка grid
+# (номера палитры, индексы - [x][y][z]). Воксели обходятся слоями по z:
+# слои ландшафта и построек чаще всего однородны.
+# Возвращает bytes: длины серий, затем номера серий (uint16)
+def encodeRuns(grid):
+    values = np.ascontiguousarray(grid.transpose(2, 1, 0)).reshape(-1)
+    starts = np.concatenate(
+        ([0], np.flatnonzero(values[1:] != values[:-1]) + 1))
+    lengths = np.diff(np.append(starts, len(values)))
+    return (lengths.astype('<u2').tobytes() +
+            values[starts].astype('<u2').tobytes())
+
+
+# Функция декодирования чанка, закодированного encodeRuns
+# (data - bytes или буфер). Возвращает плотный массив номеров палитры
+# наименьшего типа, индексы - [x][y][z]
+def decodeRuns(data):
+    runs = np.frombuffer(data, dtype='<u2').reshape(2, -1)
+    values = runs[1].astype(gridType(int(runs[1].max())))
+    grid = np.repeat(values, runs[0]).reshape(CHUNK_SHAPE)
+    return np.ascontiguousarray(grid.transpose(2, 1, 0))
+
+
+# Класс хранилища вокселей карты по чанкам: номер палитры каждого
+# вокселя (0 - пусто). Пустые чанки не хранятся, однородные хранятся
+# одним числом, остальные - плотным массивом uint8 (uint16, если номера
+# не помещаются в байт). Чанки, которые долго не менялись, сжимаются
+# кодированием длин серий и распаковываются при обращении
+class ChunkStore():
+    # Конструктор
+    def __init__(self):
+        # словарь непустых чанков: ключ чанка - содержимое:
+        #  int - однородный чанк (у всех вокселей один номер),
+        #  массив CHUNK_SHAPE - номера вокселей, индексы - [x][y][z],
+        #  bytes - чанк, сжатый encodeRuns
+        # (словарь не пересоздаётся: отрисовщик чанков читает его ключи)
+        self.chunks = dict()
+        # количество блоков по чанкам
+        self.counts = dict()
+        # общее количество блоков
+        self.count = 0
+        # чанки, к которым обращались после последнего сжатия
+        self.touched = set()
+
+    # Метод удаления всех вокселей
+    def clear(self):
+        self.chunks.clear()
+        self.counts.clear()
+        self.touched.clear()
+        self.count = 0
+
+    # Метод получения количества блоков
+    def __len__(self):
+        return self.count
+
+    # Метод получения номера палитры вокселя voxel (0 - пусто)
+    def get(self, voxel):
+        key = (voxel[0] // CHUNK_SIZE, voxel[1] // CHUNK_SIZE,
+               voxel[2] // CHUNK_SIZE)
+        data = self.chunks.get(key)
+        if data is None:
+            return 0
+        if type(data) is int:
+            return data
+        if type(data) is bytes:
+            data = self.expand(key)
+        return int(data[voxel[0] % CHUNK_SIZE, voxel[1] % CHUNK_SIZE,
+                        voxel[2] % CHUNK_SIZE])
+
+    # Метод получения массива (n,) uint32 номеров палитры
+    # вокселей positions (массив (n, 3))
+    def getMany(self, positions):
+        positions = np.asarray(positions, dtype=np.int64).reshape(-1, 3)
+        result = np.zeros(len(positions), dtype=np.uint32)
+        for key, rows in groupRows(positions // CHUNK_SIZE).items():
+            data = self.chunks.get(key)
+            if data is None:
+                continue
+            if type(data) is int:
+                result[rows] = data
+                continue
+            # сжатый чанк распаковывается только для чтения
+            if type(data) is bytes:
+                data = decodeRuns(data)
+            local = positions[rows] % CHUNK_SIZE
+            result[rows] = data[local[:, 0], local[:, 1], local[:, 2]]
+        return result
+
+    # Метод получения плотного массива чанка key без изменения
+    # его хранения (None - чанк пуст)
+    def readGrid(self, key):
+        data = self.chunks.get(key)
+        if data is None:
+            return None
+        if type(data) is int:
+            return np.full(CHUNK_SHAPE, data, dtype=gridType(data))
+        if type(data) is bytes:
+            return decodeRuns(data)
+        return data
+
+    # Метод перевода чанка key в плотный массив, в который
+    # помещается номер largest (пустой чанк создаётся).
+    # Возвращает массив чанка
+    def expand(self, key, largest=0):
+        grid = self.readGrid(key)
+        if grid is None:
+            grid = np.zeros(CHUNK_SHAPE, dtype=gridType(largest))
+            self.counts[key] = 0
+        elif grid.dtype.itemsize < np.dtype(gridType(largest)).itemsize:
+            grid = grid.astype(gridType(largest))
+        self.chunks[key] = grid
+        self.touched.add(key)
+        return grid
+
+    # Метод учёта изменения количества блоков чанка key на delta
+    # (опустевший чанк удаляется)
+    def addCount(self, key, delta):
+        count = self.counts[key] + delta
+        self.count += delta
+        if count:
+            self.counts[key] = count
+        else:
+            del self.chunks[key]
+            del self.counts[key]
+            self.touched.discard(key)
+
+    # Метод установки номера палитры index вокселя voxel (0 - удалить).
+    # Возвращает прежний номер
+    def set(self, voxel, index):
+        key = (voxel[0] // CHUNK_SIZE, voxel[1] // CHUNK_SIZE,
+               voxel[2] // CHUNK_SIZE)
+        if not index and key not in self.chunks:
+            return 0
+        grid = self.expand(key, index)
+        local = (voxel[0] % CHUNK_SIZE, voxel[1] % CHUNK_SIZE,
+                 voxel[2] % CHUNK_SIZE)
+        old = int(grid[local])
+        grid[local] = index
+        self.addCount(key, (index != 0) - (old != 0))
+        return old
+
+    # Метод установки номеров палитры вокселей за один проход. Аргументы:
+    #  positions - массив (n, 3) координат (без повторов)
+    #  indices - массив (n,) номеров или один номер (0 - удалить)
+    # Чанки, созданные этим вызовом (загрузка карты, заливка области),
+    # сразу уплотняются. Возвращает массив (n,) uint32 прежних номеров
+    def setMany(self, positions, indices):
+        positions = np.asarray(positions, dtype=np.int64).reshape(-1, 3)
+        indices = np.broadcast_to(np.asarray(indices, dtype=np.uint32),
+                                  (len(positions),))
+        old = np.zeros(len(positions), dtype=np.uint32)
+        for key, rows in groupRows(positions // CHUNK_SIZE).items():
+            values = indices[rows]
+            largest = int(values.max())
+            created = key not in self.chunks
+            if created and not largest:
+                continue
+            grid = self.expand(key, largest)
+            local = positions[rows] % CHUNK_SIZE
+            cells = (local[:, 0], local[:, 1], local[:, 2])
+            old[rows] = grid[cells]
+            grid[cells] = values
+            self.addCount(key, int(np.count_nonzero(values)) -
+                          int(np.count_nonzero(old[rows])))
+            # целиком заполненный одним номером чанк - одно число
+            if key in self.counts and (created or
+                                       self.counts[key] == CHUNK_VOLUME):
+                self.pack(key, grid, encode=created)
+        return old
+
+    # Метод получения блоков чанка key.
+    # Возвращает (координаты (n, 3) int32, номера палитры (n,) uint32)
+    def getChunk(self, key):
+        grid = self.readGrid(key)
+        if grid is None:
+            return (np.empty((0, 3), dtype=np.int32),
+                    np.empty(0, dtype=np.uint32))
+        origin = np.array(key, dtype=np.int32) * CHUNK_SIZE
+        flat = grid.reshape(-1)
+        cells = np.flatnonzero(flat)
+        return CHUNK_CELLS[cells] + origin, flat[cells].astype(np.uint32)
+
+    # Метод удаления чанка key
+    def removeChunk(self, key):
+        if key in self.chunks:
+            self.addCount(key, -self.counts[key])
+
+    # Метод получения всех блоков.
+    # Возвращает (координаты (n, 3) int32, номера палитры (n,) uint32)
+    def getBlocks(self):
+        parts = [self.getChunk(key) for key in self.chunks]
+        if not parts:
+            return (np.empty((0, 3), dtype=np.int32),
+                    np.empty(0, dtype=np.uint32))
+        return (np.concatenate([part[0] for part in parts]),
+                np.concatenate([part[1] for part in parts]))
+
+    # Метод поиска блоков с номером палитры index.
+    # Возвращает массив (n, 3) int32 их координат
+    def find(self, index):
+        parts = []
+        for key, data in self.chunks.items():
+            if type(data) is int and data != index:
+                continue
+            grid = self.readGrid(key)
+            cells = np.flatnonzero(grid.reshape(-1) == index)
+            if len(cells):
+                parts.append(CHUNK_CELLS[cells] +
+                             np.array(key, dtype=np.int32) * CHUNK_SIZE)
+        if not parts:
+            return np.empty((0, 3), dtype=np.int32)
+        return np.concatenate(parts)
+
+    # Метод уплотнения плотного массива grid чанка key: однородный чанк
+    # становится числом, остальные (при encode) кодируются длинами серий,
+    # если так меньше. Возвращает True, если чанк уплотнён
+    def pack(self, key, grid, encode=True):
+        first = int(grid.flat[0])
+        if self.counts[key] == CHUNK_VOLUME and (grid == first).all():
+            self.chunks[key] = first
+            return True
+        if not encode:
+            return False
+        data = encodeRuns(grid)
+        if len(data) >= grid.nbytes:
+            return False
+        self.chunks[key] = data
+        return True
+
+    # Метод сжатия чанков, к которым не обращались после прошлого вызова.
+    # Возвращает количество сжатых чанков
+    def compressIdle(self):
+        packed = 0
+        for key, data in list(self.chunks.items()):
+            if key not in self.touched and isinstance(data, np.ndarray):
+                packed += self.pack(key, data)
+        self.touched.clear()
+        return packed
+
+    # Метод получения объёма памяти содержимого чанков (байт)
+    def getBytes(self):
+        return sum(sys.getsizeof(data) for data in self.chunks.values())
+
+    # Метод получения статистики хранения: количество однородных,
+    # плотных и сжатых чанков, объём памяти и байт на блок
+    def getStats(self):
+        kinds = {int: 'uniform', bytes: 'compressed'}
+        stats = {'uniform': 0, 'dense': 0, 'compressed': 0}
+        for data in self.chunks.values():
+            stats[kinds.get(type(data), 'dense')] += 1
+        stats['bytes'] = self.getBytes()
+        stats['bytes_per_block'] = stats['bytes'] / max(self.count, 1)
+        return stats
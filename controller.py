@@ -1,34 +1,50 @@
 from direct.showbase.ShowBase import ShowBase
 from panda3d.core import CollisionTraverser, CollisionHandlerQueue
 from panda3d.core import CollisionNode, CollisionSphere, BitMask32
+from panda3d.core import GraphicsWindow
+from math import sin, cos, radians
+from physics import VoxelBody
+from profiler import profiled
+from scheduler import scheduler
 
 # Класс контроллера мышки и клавиатуры
 class Controller():
-    # Конструктор
-    def __init__(self):
+    # Конструктор. Аргументы:
+    #  map_manager - менеджер карты; если задан, в режиме хождения
+    #                столкновения считаются по сетке вокселей карты,
+    #                иначе - обходчиком столкновений по всей сцене
+    def __init__(self, map_manager=None):
+        self.map_manager = map_manager
         # значение шага перемещения клавиатурой
         self.key_step = 0.2
         # значение шага поворота мышкой
         self.mouse_step = 0.2
 
-        # координаты центра экрана
-        self.x_center = base.win.getXSize()//2
-        self.y_center = base.win.getYSize()//2
-        # перемещаем указатель мышки в центр экрана
-        base.win.movePointer(0, self.x_center, self.y_center)
+        # есть ли окно с указателем мышки
+        # (при запуске без окна, например в тестах скорости, его нет)
+        self.has_pointer = isinstance(base.win, GraphicsWindow)
+        if self.has_pointer:
+            # координаты центра экрана
+            self.x_center = base.win.getXSize()//2
+            self.y_center = base.win.getYSize()//2
+            # перемещаем указатель мышки в центр экрана
+            base.win.movePointer(0, self.x_center, self.y_center)
         # отключаем стандартное управление мышкой
         base.disableMouse()
-        # устанавливаем поле зрения объектива
-        base.camLens.setFov(80)
-        # устанавливаем ближайшую границу отрисовки
-        base.camLens.setNear(0.2)
+        if base.camLens:
+            # устанавливаем поле зрения объектива
+            base.camLens.setFov(80)
+            # устанавливаем ближайшую границу отрисовки
+            base.camLens.setNear(0.2)
 
         # устанавливаем текущие значения ориентации камеры
         self.heading = 0
         self.pitch = 0
 
-        # запускаем задачу контроля камеры
-        taskMgr.doMethodLater(0.02, self.controlCamera, "camera-task")
+        # запускаем задачу поворота камеры мышкой (раз в кадр),
+        # а перемещение камеры выполняется тактами планировщика
+        taskMgr.add(self.controlCamera, "camera-task")
+        scheduler.addTick(self.simulate)
         # регистрируем на нажатие клавиши "Esc"
         # событие закрытия приложения
         base.accept("escape", base.userExit)
@@ -45,6 +61,14 @@ class Controller():
             # регистрируем событие на отжатие клавиши
             base.accept(key+'-up', self.setKey, [key, 0])
 
+        # высота уступа, на который игрок поднимается без прыжка (один блок)
+        self.step_height = 1.0
+        # тело игрока для столкновений по сетке вокселей
+        self.body = None
+        if self.map_manager is not None:
+            self.body = VoxelBody(self.map_manager.isOccupied,
+                                  step_height=self.step_height)
+
         # создание обходчика столкновений
         self.traverser = CollisionTraverser()
         # очередь обработки столкновений
@@ -97,13 +121,18 @@ class Controller():
             self.ground = False
             # поднимаем высоко камеру, чтобы избежать наложений
             base.camera.setZ(20)
+            # начинаем моделирование заново
+            scheduler.resetTicks()
 
     # Метод установки состояния клавиши
     def setKey(self, key, value):
         self.keys[key] = value
 
-    # Метод управления положением и ориентацией камеры
-    def controlCamera(self, task):
+    # Метод одного такта перемещения камеры. Аргументы:
+    #  step - длина такта, секунд (шаги перемещения и падения
+    #         рассчитаны на такт TICK_STEP)
+    @profiled
+    def simulate(self, step):
         # если установлен режим редактирования
         if self.edit_mode:
             # рассчитываем смещения положения камеры по осям X Y Z
@@ -113,6 +142,12 @@ class Controller():
 
             # смещаем позицию камеры относительно предыдущего положения камеры
             base.camera.setPos(base.camera, move_x, move_y, move_z)
+        # если установлен режим хождения со столкновениями по сетке
+        elif self.body:
+            # рассчитываем смещения положения камеры по осям X Y
+            move_x = self.key_step * (self.keys['d'] - self.keys['a'])
+            move_y = self.key_step * (self.keys['w'] - self.keys['s'])
+            self.walkStep(move_x, move_y)
         # если установлен режим хождения
         else:
             # предыдущая позиция камеры
@@ -161,6 +196,13 @@ class Controller():
                 # ускоряем падение
                 self.fall_speed += self.fall_acceleration
 
+    # Метод поворота камеры мышкой (раз в кадр)
+    @profiled
+    def controlCamera(self, task):
+        # если нет окна с указателем мышки - поворачивать нечем
+        if not self.has_pointer:
+            return task.cont
+
         # получаем новое положение курсора мышки
         new_mouse_pos = base.win.getPointer(0)
         new_x = new_mouse_pos.getX()
@@ -175,9 +217,43 @@ class Controller():
             base.camera.setHpr(self.heading, self.pitch, 0)
 
         # сообщаем о необходимости повторного запуска задачи
-        return task.again
+        return task.cont
+
+    # Метод одного шага хождения по сетке вокселей. Аргументы:
+    #  move_x, move_y - смещения вправо и вперёд относительно камеры
+    def walkStep(self, move_x, move_y):
+        position = base.camera.getPos()
+        # переводим смещения в систему координат мира (без наклона)
+        heading = radians(self.heading)
+        dx = move_x * cos(heading) - move_y * sin(heading)
+        dy = move_x * sin(heading) + move_y * cos(heading)
+        # двигаемся по горизонтали с учётом столкновений
+        position = self.body.moveHorizontal(position, dx, dy, self.ground)
+
+        # если нажат пробел и есть касание земли
+        if self.keys['space'] and self.ground:
+            # прыгаем вверх - сильно уменьшаем скорость падения
+            self.fall_speed = -self.jump_power
+
+        # опускаем камеру под действием гравитации
+        position, blocked = self.body.moveAxis(position, 2, -self.fall_speed)
+        # при ударе о потолок прыжок прекращается
+        if blocked and self.fall_speed < 0:
+            self.fall_speed = 0
+
+        # флаг касания земли
+        self.ground = self.body.isOnGround(position)
+        if self.ground:
+            # сбрасываем скорость падения
+            self.fall_speed = 0
+        else:
+            # ускоряем падение
+            self.fall_speed += self.fall_acceleration
+
+        base.camera.setPos(*position)
 
     # Метод проверки столкновений с объектами
+    @profiled
     def collisionTest(self):
         # запускаем обходчик на проверку
         self.traverser.traverse(base.render)
@@ -0,0 +1,264 @@
+import os
+import struct
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+import mapformat
+from chunkrenderer import packKeys
+from profiler import profiled
+
+# Формат журнала правок карты (все числа little-endian):
+#  заголовок LOG_HEADER: сигнатура LOG_MAGIC и версия формата
+#  далее пачки записей: заголовок BATCH_HEADER (количество записей,
+#  CRC32 данных пачки) и записи OP_DTYPE. Записи задают итоговое
+#  состояние вокселя (блок с цветом и материалом или пусто), поэтому
+#  повторное применение журнала к карте ничего не портит.
+#  Пачка, оборванная при сбое, при чтении отбрасывается.
+#  В версии 1 у записей не было материала (OP_DTYPE_V1)
+LOG_MAGIC = b'VXLG'
+LOG_VERSION = 2
+LOG_HEADER = '<4sH'
+LOG_HEADER_SIZE = struct.calcsize(LOG_HEADER)
+BATCH_HEADER = '<II'
+BATCH_HEADER_SIZE = struct.calcsize(BATCH_HEADER)
+
+# операции: блок добавлен (или перекрашен), блок удалён
+OP_ADD = 1
+OP_DELETE = 2
+OP_DTYPE = np.dtype([('op', 'u1'), ('pos', '<i4', 3), ('rgba', 'u1', 4),
+                     ('material', 'u1')])
+OP_DTYPE_V1 = np.dtype([('op', 'u1'), ('pos', '<i4', 3), ('rgba', 'u1', 4)])
+
+
+# Функция получения имени журнала для файла карты
+def logPath(filename):
+    return filename + '.log'
+
+
+# Функция получения имени журнала, который сейчас сворачивается в карту
+def compactingLogPath(filename):
+    return filename + '.log.old'
+
+
+# Функция перевода цветов (n, 4) от 0 до 1 в байты RGBA
+def colorsToRGBA(colors):
+    colors = np.asarray(colors, dtype=np.float32).reshape(-1, 4)
+    return np.clip(np.rint(colors * 255), 0, 255).astype(np.uint8)
+
+
+# Функция чтения записей журнала.
+# Возвращает массив OP_DTYPE (пустой, если журнала нет)
+def readLog(path):
+    if not os.path.exists(path):
+        return np.empty(0, dtype=OP_DTYPE)
+    with open(path, 'rb') as fin:
+        data = fin.read()
+    if len(data) < LOG_HEADER_SIZE:
+        return np.empty(0, dtype=OP_DTYPE)
+    magic, version = struct.unpack_from(LOG_HEADER, data)
+    if magic != LOG_MAGIC:
+        raise ValueError('%s is not a map edit log' % path)
+    if version > LOG_VERSION:
+        raise ValueError('unsupported edit log version %d' % version)
+    dtype = OP_DTYPE if version >= 2 else OP_DTYPE_V1
+
+    batches = []
+    offset = LOG_HEADER_SIZE
+    while offset + BATCH_HEADER_SIZE <= len(data):
+        count, crc = struct.unpack_from(BATCH_HEADER, data, offset)
+        start = offset + BATCH_HEADER_SIZE
+        end = start + count * dtype.itemsize
+        # оборванная или испорченная пачка - конец журнала
+        if end > len(data) or zlib.crc32(data[start:end]) != crc:
+            break
+        batches.append(np.frombuffer(data, dtype=dtype, count=count,
+                                     offset=start))
+        offset = end
+    if not batches:
+        return np.empty(0, dtype=OP_DTYPE)
+    ops = np.concatenate(batches)
+    if dtype is not OP_DTYPE:
+        converted = np.zeros(len(ops), dtype=OP_DTYPE)
+        for name in dtype.names:
+            converted[name] = ops[name]
+        ops = converted
+    return ops
+
+
+# Функция применения записей журнала к блокам карты. Аргументы:
+#  positions, colors, materials - блоки карты
+#  ops - записи журнала (по порядку)
+# Для каждого вокселя остаётся последнее состояние.
+# Возвращает (координаты (n, 3) int32, цвета (n, 4) float32,
+# материалы (n,) uint8)
+def applyOps(positions, colors, materials, ops):
+    positions = np.asarray(positions, dtype=np.int32).reshape(-1, 3)
+    materials = np.asarray(materials, dtype=np.uint8).reshape(-1)
+    if not len(ops):
+        return positions, np.asarray(colors, dtype=np.float32), materials
+    all_positions = np.concatenate([positions, ops['pos']])
+    rgba = np.concatenate([colorsToRGBA(colors), ops['rgba']])
+    all_materials = np.concatenate([materials, ops['material']])
+    filled = np.concatenate([np.ones(len(positions), dtype=bool),
+                             ops['op'] == OP_ADD])
+    # последнее вхождение каждого вокселя
+    keys = packKeys(all_positions)[::-1]
+    _, last = np.unique(keys, return_index=True)
+    last = len(keys) - 1 - last
+    last = last[filled[last]]
+    return (all_positions[last], rgba[last].astype(np.float32) / 255,
+            all_materials[last])
+
+
+# Функция загрузки снимка карты (пустая карта, если файла нет).
+# Возвращает (координаты, цвета, материалы)
+def loadSnapshot(filename):
+    if os.path.exists(filename):
+        return mapformat.loadMapFile(filename)
+    return (np.empty((0, 3), dtype=np.int32),
+            np.empty((0, 4), dtype=np.float32),
+            np.empty(0, dtype=np.uint8))
+
+
+# Функция загрузки карты вместе с журналами правок
+# (снимок карты, затем сворачиваемый журнал, затем текущий).
+# Возвращает (координаты, цвета, материалы)
+@profiled
+def loadMapWithLog(filename):
+    blocks = loadSnapshot(filename)
+    for path in (compactingLogPath(filename), logPath(filename)):
+        blocks = applyOps(*blocks, readLog(path))
+    return blocks
+
+
+# Класс журнала правок карты: изменения дописываются в конец файла
+# рядом с картой пачками раз в flush_interval секунд (с fsync),
+# а разросшийся журнал в фоне сворачивается в новый снимок карты.
+# Сохранение стоит O(правок), а при сбое теряется не больше одной пачки
+class EditLog():
+    # Конструктор. Аргументы:
+    #  filename - имя файла карты (снимка)
+    #  flush_interval - период записи пачек, секунд
+    #  compact_size - размер журнала, после которого он сворачивается (байт)
+    def __init__(self, filename, flush_interval=0.5,
+                 compact_size=4 * 1024 * 1024):
+        self.filename = filename
+        self.path = logPath(filename)
+        self.flush_interval = flush_interval
+        self.compact_size = compact_size
+
+        # записи, ещё не отданные на запись
+        self.pending = []
+        # запись пачек и поворот журнала - в одном фоновом потоке
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # поток сворачивания журнала (None - не выполняется)
+        self.compaction = None
+        self.openLog()
+
+        taskMgr.doMethodLater(flush_interval, self.flushTask,
+                              'edit-log-task')
+
+    # Метод открытия текущего журнала на дозапись
+    def openLog(self):
+        self.file = open(self.path, 'ab')
+        self.size = self.file.tell()
+        if not self.size:
+            self.file.write(struct.pack(LOG_HEADER, LOG_MAGIC, LOG_VERSION))
+            self.size = LOG_HEADER_SIZE
+
+    # Метод записи изменений. Аргументы:
+    #  positions - координаты (n, 3) изменённых вокселей
+    #  colors - новые цвета (n, 4) или None для удалённых блоков
+    #  materials - новые материалы (n,) (None - материал 0)
+    def append(self, positions, colors=None, materials=None):
+        positions = np.asarray(positions).reshape(-1, 3)
+        if not len(positions):
+            return
+        ops = np.zeros(len(positions), dtype=OP_DTYPE)
+        ops['pos'] = positions
+        if colors is None:
+            ops['op'] = OP_DELETE
+        else:
+            ops['op'] = OP_ADD
+            ops['rgba'] = colorsToRGBA(colors)
+            if materials is not None:
+                ops['material'] = materials
+        self.pending.append(ops.tobytes())
+
+    # Задача записи накопленных изменений
+    def flushTask(self, task):
+        self.flush()
+        return task.again
+
+    # Метод отдачи накопленных изменений на запись.
+    # wait - дождаться записи на диск
+    def flush(self, wait=False):
+        future = None
+        if self.pending:
+            data = b''.join(self.pending)
+            self.pending = []
+            future = self.executor.submit(self.writeBatch, data)
+        if wait:
+            if future is None:
+                future = self.executor.submit(lambda: None)
+            future.result()
+
+    # Метод записи пачки (выполняется в фоновом потоке)
+    @profiled
+    def writeBatch(self, data):
+        self.file.write(struct.pack(BATCH_HEADER,
+                                    len(data) // OP_DTYPE.itemsize,
+                                    zlib.crc32(data)))
+        self.file.write(data)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.size += BATCH_HEADER_SIZE + len(data)
+        if self.size > self.compact_size:
+            self.rotate()
+
+    # Метод поворота журнала: текущий журнал отдаётся на сворачивание,
+    # а записи продолжаются в новый (выполняется в фоновом потоке)
+    def rotate(self):
+        # предыдущее сворачивание ещё не закончено
+        if self.compaction is not None and self.compaction.is_alive():
+            return
+        # журнал, который не удалось свернуть, не затирается:
+        # сначала сворачивается он, а текущий журнал продолжает расти
+        if not os.path.exists(compactingLogPath(self.filename)):
+            self.file.close()
+            os.replace(self.path, compactingLogPath(self.filename))
+            self.openLog()
+        self.compaction = threading.Thread(target=self.compact,
+                                           name='edit-log-compaction')
+        self.compaction.start()
+
+    # Метод сворачивания журнала в снимок карты (в отдельном потоке).
+    # При ошибке журнал остаётся и сворачивается при следующем повороте
+    @profiled
+    def compact(self):
+        old_path = compactingLogPath(self.filename)
+        try:
+            blocks = applyOps(*loadSnapshot(self.filename),
+                              readLog(old_path))
+            # пишем во временный файл и подменяем, чтобы не испортить карту
+            mapformat.saveMapFile(self.filename + '.tmp', *blocks)
+            os.replace(self.filename + '.tmp', self.filename)
+            os.remove(old_path)
+        except Exception as error:
+            print('edit log compaction failed:', error)
+
+    # Метод ожидания окончания сворачивания журнала
+    def waitCompaction(self):
+        if self.compaction is not None:
+            self.compaction.join()
+            self.compaction = None
+
+    # Метод закрытия журнала (всё накопленное записывается)
+    def close(self):
+        taskMgr.remove('edit-log-task')
+        self.flush(wait=True)
+        self.executor.shutdown(wait=True)
+        self.waitCompaction()
+        self.file.close()
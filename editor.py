@@ -1,9 +1,8 @@
 from direct.showbase.DirectObject import DirectObject
-from panda3d.core import CollisionTraverser, CollisionNode
-from panda3d.core import CollisionHandlerQueue, CollisionRay
-from panda3d.core import BitMask32
 from panda3d.core import LPoint3f
-from mapmanager import MapManager
+from mapmanager import MapManager, getRandomColor
+from profiler import profiled
+from selection import SelectionBox
 
 
 # Класс редактора блоков
@@ -16,36 +15,30 @@ class Editor(DirectObject):
         # режим редактирования
         self.edit_mode = True
 
-        # создание обходчика столкновений
-        self.traverser = CollisionTraverser()
-        # очередь обработки столкновений
-        self.collisQueue = CollisionHandlerQueue()
-        # узел для луча столкновений
-        collisionNode = CollisionNode('centerRay')
-        # устанавливаем маску проверки столкновений ОТ
-        collisionNode.setFromCollideMask(BitMask32.bit(1))
-        # сбрасываем маску проверки столкновений ДО
-        collisionNode.setIntoCollideMask(BitMask32.allOff())
-        # создаём луч
-        self.collisRay = CollisionRay()
-        # и прикрепляем к созданному ранее узлу
-        collisionNode.addSolid(self.collisRay)
-        # закрепляем узел на камере
-        collisCamNode = base.camera.attachNewNode(collisionNode)
-        # уведомляем обходчик о новом «объекте ОТ»
-        self.traverser.addCollider(collisCamNode, self.collisQueue)
-        # визуализируем столкновения (раскомментировать/закоментировать)
-        #self.traverser.showCollisions(base.render)
+        # наибольшее расстояние выделения блоков
+        self.pick_distance = 100
         # позиция для добавления нового блока
         self.new_position = None
         # ключ выделенного блока
         self.selected_key = None
-        # узел выделенного блока
-        self.selected_node = None
+        # выделенный блок
+        self.selected_block = None
+        # условия последнего выделения: (положение камеры, версия карты);
+        # пока они не изменились, луч заново не проверяется
+        self.pick_state = None
+        # количество кадров с повторно использованным
+        # и с заново найденным выделением
+        self.pick_hits = 0
+        self.pick_misses = 0
+        # углы области для инструментов (воксели, не больше двух)
+        self.corners = []
+        # рамка отмеченной области
+        self.region_box = SelectionBox((1, 0.6, 0, 1))
+        # буфер обмена (regions.Clipboard, None - пусто)
+        self.clipboard = None
 
-        # запускаем задачу проверки выделения блоков
-        taskMgr.doMethodLater(0.02, self.testBlocksSelection,
-                              "test_block-task")
+        # запускаем задачу проверки выделения блоков (раз в кадр)
+        taskMgr.add(self.testBlocksSelection, "test_block-task")
 
         # регистрируем на нажатие левой кнопки мыши
         # событие добавления блока
@@ -54,6 +47,18 @@ class Editor(DirectObject):
         # событие удаления блока
         self.accept('mouse3', self.delBlock)
 
+        # инструменты области: углы отмечаются блоком под прицелом
+        self.accept('r', self.markCorner)
+        self.accept('f', self.fillRegion)
+        self.accept('h', self.fillRegion, [True])
+        self.accept('g', self.fillSphere)
+        self.accept('x', self.clearRegion)
+        self.accept('t', self.replaceColor)
+        self.accept('c', self.copyRegion)
+        self.accept('v', self.pasteRegion)
+        # перекраска элемента палитры (всех блоков этого цвета)
+        self.accept('p', self.recolorEntry)
+
     #метод установки режима редактирования
     def setEditMode(self, mode):
         self.edit_mode = mode
@@ -61,19 +66,26 @@ class Editor(DirectObject):
             # сбрасываем выделение
             self.resetSelectedBlock()
             # запускаем задачу проверки выделения блоков
-            taskMgr.doMethodLater(0.02, self.testBlocksSelection,
-                                  "test_block-task")
+            taskMgr.add(self.testBlocksSelection, "test_block-task")
         else:
             # удаляем задачу проверки выделения блоков
             taskMgr.remove("test_block-task")
             # снимаем выделение со всех блоков
             self.map_manager.deselectAllBlocks()
+            # и отметку области
+            self.resetCorners()
 
     # Метод сброса свойств выделенного блока
     def resetSelectedBlock(self):
         self.new_position = None
         self.selected_key = None
-        self.selected_node = None
+        self.selected_block = None
+        # при следующей проверке выделение ищется заново
+        self.pick_state = None
+
+    # Метод получения статистики проверок выделения
+    def getPickStats(self):
+        return {'hits': self.pick_hits, 'misses': self.pick_misses}
 
     # Метод добавления блока
     def addBlock(self):
@@ -91,42 +103,141 @@ class Editor(DirectObject):
         # сбрасываем выделение
         self.resetSelectedBlock()
 
+    # Метод получения вокселя выделенного блока (или None)
+    def getSelectedVoxel(self):
+        block = self.map_manager.getBlockByKey(self.selected_key)
+        if block is None:
+            return None
+        return block.position
+
+    # Метод отметки угла области блоком под прицелом
+    # (третий угол начинает новую область)
+    def markCorner(self):
+        voxel = self.getSelectedVoxel()
+        if not self.edit_mode or voxel is None:
+            return
+        if len(self.corners) == 2:
+            self.corners = []
+        self.corners.append(voxel)
+        self.region_box.showRegion(self.corners[0], self.corners[-1])
+
+    # Метод сброса отметки области
+    def resetCorners(self):
+        self.corners = []
+        self.region_box.hide()
+
+    # Метод получения углов отмеченной области (или None)
+    def getRegion(self):
+        if not self.edit_mode or len(self.corners) < 2:
+            print('Mark two corners of the region first')
+            return None
+        return self.corners[0], self.corners[1]
+
+    # Метод заполнения области текущим цветом
+    # (hollow - только стенки)
+    def fillRegion(self, hollow=False):
+        region = self.getRegion()
+        if region:
+            count = self.map_manager.fillBox(*region, hollow=hollow)
+            print('Region filled:', count, 'blocks')
+            self.resetSelectedBlock()
+
+    # Метод заполнения шара с центром в первом углу области,
+    # проходящего через второй угол
+    def fillSphere(self):
+        region = self.getRegion()
+        if region:
+            center, edge = region
+            radius = sum((a - b) ** 2 for a, b in zip(center, edge)) ** 0.5
+            count = self.map_manager.fillSphere(center, radius)
+            print('Sphere filled:', count, 'blocks')
+            self.resetSelectedBlock()
+
+    # Метод удаления всех блоков области
+    def clearRegion(self):
+        region = self.getRegion()
+        if region:
+            count = self.map_manager.removeBox(*region)
+            print('Region cleared:', count, 'blocks')
+            self.resetSelectedBlock()
+
+    # Метод замены в области цвета блока под прицелом на текущий цвет
+    def replaceColor(self):
+        region = self.getRegion()
+        block = self.map_manager.getBlockByKey(self.selected_key)
+        if region and block:
+            count = self.map_manager.replaceColor(*region, block.getColor())
+            print('Color replaced:', count, 'blocks')
+            self.resetSelectedBlock()
+
+    # Метод копирования области в буфер обмена
+    def copyRegion(self):
+        region = self.getRegion()
+        if region:
+            self.clipboard = self.map_manager.copyRegion(*region)
+            print('Copied:', self.clipboard.count, 'blocks')
+
+    # Метод вставки буфера обмена в позицию для нового блока
+    def pasteRegion(self):
+        if self.edit_mode and self.clipboard and self.new_position:
+            count = self.map_manager.pasteRegion(self.clipboard,
+                                                 self.new_position)
+            print('Pasted:', count, 'blocks')
+            self.resetSelectedBlock()
+
+    # Метод перекраски элемента палитры блока под прицелом текущим цветом
+    # (случайным, если текущий цвет не задан)
+    def recolorEntry(self):
+        block = self.map_manager.getBlockByKey(self.selected_key)
+        if self.edit_mode and block:
+            color = self.map_manager.color or getRandomColor()
+            count = self.map_manager.setPaletteColor(block.getIndex(), color)
+            print('Palette entry', block.getIndex(), 'recolored:',
+                  count, 'blocks')
+
     # Метод проверки проверки выделения блоков
+    @profiled
     def testBlocksSelection(self, task):
-        # устанавливаем позицию луча столкновений в центр экрана
-        self.collisRay.setFromLens(base.camNode, 0, 0)
-        # запускаем обходчик на проверку
-        self.traverser.traverse(base.render)
-
-        # если обходчик обнаружил какие-то столкновения
-        if self.collisQueue.getNumEntries() > 0:
-            # сортируем их, чтобы получить ближайшее
-            self.collisQueue.sortEntries()
-            # получаем описание ближайшего столкновения
-            collisionEntry = self.collisQueue.getEntry(0)
-            # получаем узел с «объектом ДО» и ключ выделенного блока
-            key = collisionEntry.getIntoNodePath().getTag('key')
-
-            # если найден новый блок
-            if key != self.selected_key:
+        # если ни камера, ни карта не изменились - выделение прежнее
+        state = (base.camera.getMat(base.render),
+                 self.map_manager.revision)
+        if state == self.pick_state:
+            self.pick_hits += 1
+            return task.cont
+        self.pick_misses += 1
+
+        # луч из камеры через центр экрана
+        origin = base.camera.getPos(base.render)
+        direction = base.render.getRelativeVector(base.camera, (0, 1, 0))
+        # ищем первый блок на луче по сетке вокселей
+        hit = self.map_manager.raycast(origin, direction, self.pick_distance)
+
+        # если луч попал в блок
+        if hit:
+            # воксель блока и нормаль грани, в которую попал луч
+            voxel, normal = hit[0], hit[1]
+            # получаем ключ выделенного блока
+            key = self.map_manager.getBlock(voxel).getKey()
+
+            # если найден новый блок (или блок в том же вокселе
+            # пересоздан и выделение с него снято)
+            if (key != self.selected_key or
+                    self.map_manager.selected_block is None):
                 # обновляем ключ выделенного блока
                 self.selected_key = key
                 # выделяем новый блок
-                self.selected_node = self.map_manager.selectBlock(key)
-
-            # если есть выделенный блок
-            if self.selected_node:
-                # координаты выделенного блока
-                selected_position = self.selected_node.getPos()
-                # вектор нормали к поверхности на выделенном блоке
-                normal = collisionEntry.getSurfaceNormal(self.selected_node)
-                # позиция для добавления нового блока
-                self.new_position = selected_position + normal
+                self.selected_block = self.map_manager.selectBlock(key)
+
+            # позиция для добавления нового блока
+            self.new_position = (voxel[0] + normal[0],
+                                 voxel[1] + normal[1],
+                                 voxel[2] + normal[2])
         else:
             # снимаем выделение со всех блоков
             self.map_manager.deselectAllBlocks()
             # сбрасываем выделение
             self.resetSelectedBlock()
+        self.pick_state = state
 
         # сообщаем о необходимости повторного запуска задачи
-        return task.again
+        return task.cont
@@ -0,0 +1,187 @@
+import struct
+import zlib
+from collections import deque
+from contextlib import contextmanager
+import numpy as np
+
+from chunkrenderer import packKeys
+
+# записи с таким количеством вокселей и больше сжимаются
+COMPRESS_THRESHOLD = 64
+# примерный расход памяти на служебные данные одной записи, байт
+RECORD_OVERHEAD = 120
+
+
+# Класс записи журнала изменений: для каждого изменённого вокселя -
+# координаты и номера цвета палитры до и после (0 - блока нет).
+# Данные хранятся упакованными в bytes: координаты отсортированы
+# и записаны разностями соседних, поэтому заливки сжимаются в разы
+class EditRecord():
+    __slots__ = ('count', 'compressed', 'data')
+
+    # Конструктор. Аргументы:
+    #  positions - массив (n, 3) координат вокселей (без повторов)
+    #  old, new - массивы номеров цветов до и после изменения
+    def __init__(self, positions, old, new):
+        self.count = len(positions)
+        if self.count == 1:
+            # одиночная правка (самый частый случай) - без сортировки
+            self.compressed = False
+            self.data = struct.pack('<3i2I', *positions[0], old[0], new[0])
+            return
+        order = np.argsort(packKeys(positions), kind='stable')
+        positions = np.asarray(positions, dtype=np.int32)[order]
+        deltas = np.diff(positions, axis=0, prepend=np.zeros((1, 3),
+                                                            dtype=np.int32))
+        data = (deltas.astype('<i4').tobytes() +
+                np.asarray(old, dtype='<u4')[order].tobytes() +
+                np.asarray(new, dtype='<u4')[order].tobytes())
+        self.compressed = self.count >= COMPRESS_THRESHOLD
+        self.data = zlib.compress(data, 1) if self.compressed else data
+
+    # Метод распаковки записи.
+    # Возвращает (координаты (n, 3) int32, номера до, номера после)
+    def unpack(self):
+        data = zlib.decompress(self.data) if self.compressed else self.data
+        n = self.count
+        deltas = np.frombuffer(data, dtype='<i4', count=n * 3).reshape(n, 3)
+        old = np.frombuffer(data, dtype='<u4', count=n, offset=n * 12)
+        new = np.frombuffer(data, dtype='<u4', count=n, offset=n * 16)
+        return np.cumsum(deltas, axis=0, dtype=np.int32), old, new
+
+    # Метод получения занимаемой памяти (байт)
+    def getSize(self):
+        return len(self.data) + RECORD_OVERHEAD
+
+
+# Функция объединения изменений в чистую разницу: для вокселя,
+# изменённого несколько раз, берётся первое старое и последнее новое
+# значение, а воксели, вернувшиеся к исходному значению, отбрасываются.
+# Аргументы - списки массивов координат, старых и новых номеров
+def mergeEdits(positions, old, new):
+    positions = np.concatenate(positions)
+    old = np.concatenate(old)
+    new = np.concatenate(new)
+    keys = packKeys(positions)
+    _, first = np.unique(keys, return_index=True)
+    _, last = np.unique(keys[::-1], return_index=True)
+    last = len(keys) - 1 - last
+    old = old[first]
+    new = new[last]
+    changed = old != new
+    return positions[first][changed], old[changed], new[changed]
+
+
+# Класс журнала отмены и повтора изменений карты.
+# Записи хранятся в кольцевом буфере: при превышении предела памяти
+# или количества записей удаляются самые старые
+class EditHistory():
+    # Конструктор. Аргументы:
+    #  memory_limit - предел памяти всех записей (байт)
+    #  max_records - наибольшее количество записей отмены
+    def __init__(self, memory_limit=16 * 1024 * 1024, max_records=1000):
+        self.memory_limit = memory_limit
+        self.max_records = max_records
+        # записи для отмены (последняя - самая новая) и для повтора
+        self.undo_records = deque()
+        self.redo_records = []
+        # память, занятая записями
+        self.memory = 0
+        # изменения текущей группы (пакета) и глубина вложенности групп
+        self.group = None
+        self.depth = 0
+        # счётчик приостановок записи (во время отмены и повтора)
+        self.paused = 0
+
+    # Метод записи изменений. Аргументы:
+    #  positions - координаты (n, 3) изменённых вокселей
+    #  old, new - номера цветов до и после (0 - блока нет)
+    def record(self, positions, old, new):
+        if self.paused:
+            return
+        positions = np.asarray(positions, dtype=np.int32).reshape(-1, 3)
+        if not len(positions):
+            return
+        # номер может быть задан одним числом для всех вокселей
+        count = len(positions)
+        old = np.broadcast_to(np.asarray(old, dtype=np.uint32), (count,))
+        new = np.broadcast_to(np.asarray(new, dtype=np.uint32), (count,))
+        if self.group is not None:
+            self.group.append((positions, old, new))
+        elif count == 1:
+            if old[0] != new[0]:
+                self.push(positions, old, new)
+        else:
+            self.push(*mergeEdits([positions], [old], [new]))
+
+    # Метод начала группы: все изменения до парного end()
+    # сохраняются одной записью
+    def begin(self):
+        self.depth += 1
+        if self.depth == 1:
+            self.group = []
+
+    # Метод завершения группы
+    def end(self):
+        self.depth -= 1
+        if self.depth == 0:
+            group = self.group
+            self.group = None
+            if group:
+                self.push(*mergeEdits(*zip(*group)))
+
+    # Метод приостановки записи (внутри блока with)
+    @contextmanager
+    def pause(self):
+        self.paused += 1
+        try:
+            yield self
+        finally:
+            self.paused -= 1
+
+    # Метод добавления записи в журнал (журнал повтора очищается)
+    def push(self, positions, old, new):
+        if not len(positions):
+            return
+        record = EditRecord(positions, old, new)
+        for redo in self.redo_records:
+            self.memory -= redo.getSize()
+        self.redo_records.clear()
+        self.undo_records.append(record)
+        self.memory += record.getSize()
+        # удаляем самые старые записи
+        while self.undo_records and (
+                self.memory > self.memory_limit or
+                len(self.undo_records) > self.max_records):
+            self.memory -= self.undo_records.popleft().getSize()
+
+    # Метод отмены последней записи.
+    # Возвращает (координаты, номера цветов, которые нужно восстановить)
+    # или None, если отменять нечего
+    def undo(self):
+        if not self.undo_records:
+            return None
+        record = self.undo_records.pop()
+        self.redo_records.append(record)
+        positions, old, new = record.unpack()
+        return positions, old
+
+    # Метод повтора последней отменённой записи.
+    # Возвращает (координаты, номера цветов) или None
+    def redo(self):
+        if not self.redo_records:
+            return None
+        record = self.redo_records.pop()
+        self.undo_records.append(record)
+        positions, old, new = record.unpack()
+        return positions, new
+
+    # Метод очистки журнала
+    def clear(self):
+        self.undo_records.clear()
+        self.redo_records.clear()
+        self.memory = 0
+
+    # Метод получения количества записей отмены и повтора
+    def getCounts(self):
+        return len(self.undo_records), len(self.redo_records)
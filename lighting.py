@@ -0,0 +1,363 @@
+import numpy as np
+
+from chunkrenderer import CHUNK_SIZE, groupRows
+
+# наибольший уровень освещённости (прямой солнечный свет)
+MAX_LIGHT = 15
+# высота столбца без непрозрачных блоков (солнце светит до самого низа)
+NO_HEIGHT = -(1 << 30)
+# яркость уровней освещённости: каждый уровень темнее предыдущего
+# в LIGHT_FALLOFF раз, но не темнее AMBIENT (чтобы в пещерах было
+# видно, что редактируешь)
+LIGHT_FALLOFF = 0.8
+AMBIENT = 0.15
+BRIGHTNESS = (AMBIENT + (1 - AMBIENT) * LIGHT_FALLOFF **
+              (MAX_LIGHT - np.arange(MAX_LIGHT + 1))).astype(np.float32)
+
+# соседи вокселя по граням
+NEIGHBOURS = ((1, 0, 0), (-1, 0, 0), (0, 1, 0),
+              (0, -1, 0), (0, 0, 1), (0, 0, -1))
+
+
+# Функция распространения света в параллелепипеде (поиск в ширину
+# сразу по всему фронту: за шаг свет проходит один воксель
+# и ослабевает на 1). Аргументы:
+#  solid - массив непрозрачных вокселей
+#  fixed - массив вокселей, освещённость которых не пересчитывается
+#          (граница области и воксели вне хранимых чанков)
+#  light - массив uint8 освещённости (значения fixed - окончательные)
+#  sun - массив вокселей под открытым небом (освещённость MAX_LIGHT)
+# Возвращает новый массив освещённости
+def propagateLight(solid, fixed, light, sun):
+    blocked = fixed | solid
+    sources = np.where(sun, MAX_LIGHT, 0).astype(np.uint8)
+    light = np.where(blocked, np.where(solid, 0, light), sources)
+    light = light.astype(np.uint8)
+    spread = np.empty_like(light)
+    for step in range(MAX_LIGHT):
+        # наибольшая освещённость соседей по граням
+        spread[0] = 0
+        spread[1:] = light[:-1]
+        np.maximum(spread[:-1], light[1:], out=spread[:-1])
+        np.maximum(spread[:, 1:], light[:, :-1], out=spread[:, 1:])
+        np.maximum(spread[:, :-1], light[:, 1:], out=spread[:, :-1])
+        np.maximum(spread[:, :, 1:], light[:, :, :-1], out=spread[:, :, 1:])
+        np.maximum(spread[:, :, :-1], light[:, :, 1:], out=spread[:, :, :-1])
+        np.subtract(spread, 1, out=spread, where=spread > 0)
+        np.maximum(spread, sources, out=spread)
+        np.copyto(spread, light, where=blocked)
+        if np.array_equal(spread, light):
+            break
+        light, spread = spread, light
+    return light
+
+
+# Функция объединения пересекающихся параллелепипедов.
+# boxes - список пар углов (low, high) включительно
+def mergeBoxes(boxes):
+    merged = []
+    for low, high in boxes:
+        joined = True
+        while joined:
+            joined = False
+            for i, (other_low, other_high) in enumerate(merged):
+                if (low <= other_high).all() and (other_low <= high).all():
+                    low = np.minimum(low, other_low)
+                    high = np.maximum(high, other_high)
+                    del merged[i]
+                    joined = True
+                    break
+        merged.append((low, high))
+    return merged
+
+
+# Класс освещения вокселей: солнечный свет столбцами сверху
+# и его распространение в стороны с ослаблением на каждом шаге.
+# Освещённость хранится массивом uint8 на чанк для чанков
+# с непрозрачными блоками и их соседей по граням; в остальных
+# вокселях она определяется только солнцем (MAX_LIGHT над самым
+# верхним блоком столбца, 0 - под ним).
+# Изменения накапливаются и пересчитываются методом update только
+# в пределах досягаемости света от изменённых вокселей
+class LightEngine():
+    # Конструктор
+    def __init__(self):
+        # словарь: ключ чанка - массив непрозрачных вокселей чанка
+        # (только чанки, в которых они есть)
+        self.solid = dict()
+        # словарь: ключ чанка - массив освещённости чанка
+        self.light = dict()
+        # словарь: ключ чанка - количество чанков с непрозрачными
+        # вокселями среди него самого и его соседей по граням
+        self.refs = dict()
+        # словарь: ключ столбца чанков (x, y) - номера z его чанков
+        # с непрозрачными вокселями
+        self.columns = dict()
+        # словарь: ключ столбца чанков - массив (CHUNK_SIZE, CHUNK_SIZE)
+        # высот самых верхних непрозрачных вокселей
+        self.heights = dict()
+        # высоты столбцов до изменений, ещё не пересчитанных update
+        self.old_heights = dict()
+        # параллелепипеды изменённых вокселей (low, high), ждущие пересчёта
+        self.pending = []
+        # чанки, освещённость которых перестала храниться
+        self.removed = set()
+
+    # Метод удаления всего освещения
+    def clear(self):
+        self.__init__()
+
+    # Метод установки непрозрачности вокселей. Аргументы:
+    #  positions - массив (n, 3) координат вокселей
+    #  opaque - массив (n,) непрозрачности (False - воксель пуст
+    #           или пропускает свет)
+    # Освещённость пересчитывается при следующем вызове update
+    def setSolid(self, positions, opaque):
+        positions = np.asarray(positions, dtype=np.int64).reshape(-1, 3)
+        if not len(positions):
+            return
+        opaque = np.broadcast_to(np.asarray(opaque, dtype=bool),
+                                 (len(positions),))
+        low = positions.min(axis=0)
+        high = positions.max(axis=0)
+
+        columns = set()
+        for key, rows in groupRows(positions // CHUNK_SIZE).items():
+            solid = self.solid.get(key)
+            if solid is None:
+                if not opaque[rows].any():
+                    continue
+                solid = np.zeros((CHUNK_SIZE,) * 3, dtype=bool)
+                self.solid[key] = solid
+                self.columns.setdefault(key[:2], set()).add(key[2])
+                self.addRefs(key, 1)
+            local = positions[rows] - np.array(key) * CHUNK_SIZE
+            solid[tuple(local.T)] = opaque[rows]
+            if not solid.any():
+                del self.solid[key]
+                self.columns[key[:2]].discard(key[2])
+                self.addRefs(key, -1)
+            columns.add(key[:2])
+
+        # воксели, которые оказались под открытым небом или ушли в тень
+        for column in columns:
+            changed = self.updateHeights(column)
+            if changed is not None:
+                low = np.minimum(low, changed[0])
+                high = np.maximum(high, changed[1])
+        self.pending.append((low, high))
+
+    # Метод удаления всех непрозрачных вокселей чанка key
+    def removeChunk(self, key):
+        solid = self.solid.get(key)
+        if solid is not None:
+            self.setSolid(np.argwhere(solid) + np.array(key) * CHUNK_SIZE,
+                          False)
+
+    # Метод учёта появления (step=1) или исчезновения (step=-1)
+    # непрозрачных вокселей в чанке key: освещённость хранится
+    # для него и его соседей, пока в ком-то из них есть такие воксели
+    def addRefs(self, key, step):
+        for offset in ((0, 0, 0),) + NEIGHBOURS:
+            other = (key[0] + offset[0], key[1] + offset[1],
+                     key[2] + offset[2])
+            refs = self.refs.get(other, 0) + step
+            origin = np.array(other) * CHUNK_SIZE
+            if refs:
+                self.refs[other] = refs
+            else:
+                del self.refs[other]
+            if refs and other not in self.light:
+                # начинаем с освещения одним солнцем
+                solid, light, stored, sun = self.gather(
+                    origin, (CHUNK_SIZE,) * 3)
+                self.light[other] = light
+                self.removed.discard(other)
+            elif not refs:
+                del self.light[other]
+                self.removed.add(other)
+            else:
+                continue
+            # освещённость чанка целиком меняет способ расчёта
+            self.pending.append((origin, origin + CHUNK_SIZE - 1))
+
+    # Метод пересчёта высот столбца чанков column.
+    # Возвращает углы (low, high) вокселей, у которых изменилось
+    # освещение солнцем, или None
+    def updateHeights(self, column):
+        heights = np.full((CHUNK_SIZE, CHUNK_SIZE), NO_HEIGHT, dtype=np.int64)
+        levels = self.columns.get(column)
+        for z in sorted(levels or (), reverse=True):
+            solid = self.solid[column + (z,)]
+            top = CHUNK_SIZE - 1 - solid[:, :, ::-1].argmax(axis=2)
+            heights = np.where((heights == NO_HEIGHT) & solid.any(axis=2),
+                               z * CHUNK_SIZE + top, heights)
+        if not levels:
+            self.columns.pop(column, None)
+
+        old = self.heights.get(column)
+        if old is None:
+            old = np.full_like(heights, NO_HEIGHT)
+        if levels:
+            self.heights[column] = heights
+        else:
+            self.heights.pop(column, None)
+
+        changed = old != heights
+        if not changed.any():
+            return None
+        self.old_heights.setdefault(column, old)
+        x, y = np.nonzero(changed)
+        origin = np.array(column) * CHUNK_SIZE
+        return (np.array([origin[0] + x.min(), origin[1] + y.min(),
+                          np.minimum(old, heights)[changed].min() + 1]),
+                np.array([origin[0] + x.max(), origin[1] + y.max(),
+                          np.maximum(old, heights)[changed].max()]))
+
+    # Метод перебора чанков, пересекающих параллелепипед от low
+    # размера shape. Возвращает (ключ чанка, срезы в параллелепипеде,
+    # срезы в чанке)
+    def overlaps(self, low, shape):
+        low = [int(value) for value in low]
+        high = [low[axis] + int(shape[axis]) for axis in range(3)]
+        # по каждой оси: номер чанка и срезы в параллелепипеде и в чанке
+        spans = []
+        for axis in range(3):
+            span = []
+            for index in range(low[axis] // CHUNK_SIZE,
+                               (high[axis] - 1) // CHUNK_SIZE + 1):
+                origin = index * CHUNK_SIZE
+                start = max(low[axis], origin)
+                end = min(high[axis], origin + CHUNK_SIZE)
+                span.append((index, slice(start - low[axis], end - low[axis]),
+                             slice(start - origin, end - origin)))
+            spans.append(span)
+        for x, box_x, chunk_x in spans[0]:
+            for y, box_y, chunk_y in spans[1]:
+                for z, box_z, chunk_z in spans[2]:
+                    yield ((x, y, z), (box_x, box_y, box_z),
+                           (chunk_x, chunk_y, chunk_z))
+
+    # Метод сбора высот столбцов вокселей для прямоугольника от low
+    # размера shape (old - высоты до изменений, ждущих пересчёта)
+    def gatherHeights(self, low, shape, old=False):
+        heights = np.full(shape, NO_HEIGHT, dtype=np.int64)
+        first = np.asarray(low) // CHUNK_SIZE
+        last = (np.asarray(low) + shape - 1) // CHUNK_SIZE
+        for x in range(first[0], last[0] + 1):
+            for y in range(first[1], last[1] + 1):
+                column = (x, y)
+                source = (self.old_heights.get(column) if old and
+                          column in self.old_heights else
+                          self.heights.get(column))
+                if source is None:
+                    continue
+                origin = np.array(column) * CHUNK_SIZE
+                start = np.maximum(low, origin)
+                end = np.minimum(np.asarray(low) + shape,
+                                 origin + CHUNK_SIZE)
+                heights[start[0] - low[0]:end[0] - low[0],
+                        start[1] - low[1]:end[1] - low[1]] = source[
+                    start[0] - origin[0]:end[0] - origin[0],
+                    start[1] - origin[1]:end[1] - origin[1]]
+        return heights
+
+    # Метод сбора состояния параллелепипеда от low размера shape.
+    # Возвращает массивы (непрозрачные воксели, освещённость,
+    # воксели хранимых чанков, воксели под открытым небом)
+    def gather(self, low, shape, old=False):
+        low = np.asarray(low, dtype=np.int64)
+        heights = self.gatherHeights(low[:2], shape[:2], old)
+        z = np.arange(low[2], low[2] + shape[2])
+        sun = z[None, None, :] > heights[:, :, None]
+        light = np.where(sun, MAX_LIGHT, 0).astype(np.uint8)
+        solid = np.zeros(shape, dtype=bool)
+        stored = np.zeros(shape, dtype=bool)
+        for key, box, chunk in self.overlaps(low, shape):
+            chunk_light = self.light.get(key)
+            if chunk_light is None:
+                continue
+            light[box] = chunk_light[chunk]
+            stored[box] = True
+            chunk_solid = self.solid.get(key)
+            if chunk_solid is not None:
+                solid[box] = chunk_solid[chunk]
+        return solid, light, stored, sun
+
+    # Метод пересчёта освещённости накопленных изменений.
+    # Возвращает (массив (n, 3) вокселей, освещённость которых
+    # изменилась, множество чанков, освещённость которых
+    # перестала храниться)
+    def update(self):
+        removed, self.removed = self.removed, set()
+        if not self.pending:
+            return np.empty((0, 3), dtype=np.int64), removed
+        # ниже самого нижнего хранимого чанка все воксели в тени
+        bottom = (min(key[2] for key in self.light) * CHUNK_SIZE
+                  if self.light else 0)
+        boxes = []
+        for low, high in self.pending:
+            low = np.array(low, dtype=np.int64)
+            high = np.array(high, dtype=np.int64)
+            low[2] = max(low[2], bottom)
+            if low[2] > high[2]:
+                continue
+            # свет доходит от изменённых вокселей не дальше MAX_LIGHT - 1,
+            # следующий слой вокселей - неизменная граница области
+            low -= MAX_LIGHT
+            high += MAX_LIGHT
+            low[2] = max(low[2], bottom - 1)
+            boxes.append((low, high))
+        changed = [self.relight(low, high) for low, high in mergeBoxes(boxes)]
+        self.pending = []
+        self.old_heights.clear()
+        if not changed:
+            return np.empty((0, 3), dtype=np.int64), removed
+        return np.concatenate(changed), removed
+
+    # Метод пересчёта освещённости внутри параллелепипеда от low
+    # до high (включительно; крайние воксели не меняются).
+    # Возвращает массив (n, 3) вокселей, освещённость которых изменилась
+    def relight(self, low, high):
+        shape = tuple((high - low + 1).tolist())
+        solid, light, stored, sun = self.gather(low, shape)
+        fixed = ~stored
+        for axis in range(3):
+            index = [slice(None)] * 3
+            for edge in (0, -1):
+                index[axis] = edge
+                fixed[tuple(index)] = True
+        new = propagateLight(solid, fixed, light, sun)
+
+        changed = new != light
+        # вне хранимых чанков освещённость меняет только солнце
+        if self.old_heights:
+            old_sun = self.gather(low, shape, old=True)[3]
+            changed |= ~stored & (old_sun != sun)
+
+        for key, box, chunk in self.overlaps(low, shape):
+            chunk_light = self.light.get(key)
+            if chunk_light is not None:
+                chunk_light[chunk] = new[box]
+        return np.argwhere(changed) + low
+
+    # Метод получения освещения чанка key для построения его геометрии.
+    # Возвращает массивы (непрозрачные воксели, яркость) для чанка
+    # с рамкой в один воксель (индекс - координата минус угол чанка плюс 1)
+    def getShading(self, key):
+        origin = np.array(key, dtype=np.int64) * CHUNK_SIZE
+        solid, light, stored, sun = self.gather(origin - 1,
+                                                (CHUNK_SIZE + 2,) * 3)
+        return solid, BRIGHTNESS[light]
+
+    # Метод получения уровня освещённости вокселя voxel
+    def getLight(self, voxel):
+        solid, light, stored, sun = self.gather(voxel, (1, 1, 1))
+        return int(light[0, 0, 0])
+
+    # Метод получения статистики освещения
+    def getStats(self):
+        return {'solid_chunks': len(self.solid),
+                'light_chunks': len(self.light),
+                'bytes': sum(array.nbytes for array in self.light.values()) +
+                         sum(array.nbytes for array in self.solid.values())}
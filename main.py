@@ -7,6 +7,10 @@ from panda3d.core import loadPrcFileData
 from mapmanager import MapManager
 from controller import Controller
 from editor import Editor
+from terrain import TerrainGenerator
+from materials import MATERIALS, getMaterialName
+from profiler import profiler, ProfilerOverlay
+from scheduler import scheduler
 
 # Настройка конфигурации приложения
 # Заголовок окна
@@ -31,14 +35,21 @@ class Game(ShowBase):
         self.edit_mode = True
 
         # создаём менеджер карты
-        self.map_manager = MapManager()
+        # (выделение и хождение работают по сетке вокселей,
+        # поэтому геометрия столкновения блокам не нужна)
+        self.map_manager = MapManager(collisions=False)
 
         # создаём контроллер мышки и клавиатуры
-        self.controller = Controller()
+        self.controller = Controller(self.map_manager)
 
         # создаём редактор
         self.editor = Editor(self.map_manager)
 
+        # панель профилировщика (скрыта, замеры выключены)
+        self.profiler_overlay = ProfilerOverlay()
+        # имя файлов выгрузки замеров (без расширения)
+        self.profile_name = "profile"
+
         # загружаем картинку курсора
         self.pointer = OnscreenImage(image='target.png',
                                      pos=(0, 0, 0), scale=0.08)
@@ -47,25 +58,53 @@ class Game(ShowBase):
 
         # имя файла для сохранения и загрузки карт
         self.file_name = "my_map.dat"
+        # папка для сохранения мира регионами
+        self.world_name = "my_world"
+        # зерно генератора ландшафта
+        self.terrain_seed = 0
 
         self.accept("f1", self.basicMap)
         self.accept("f2", self.generateRandomMap)
         self.accept("f3", self.saveMap)
         self.accept("f4", self.loadMap)
+        self.accept("f5", self.switchGreedyMeshing)
+        self.accept("f6", self.saveWorld)
+        self.accept("f7", self.streamWorld)
+        self.accept("f8", self.generateTerrain)
+        self.accept("control-z", self.undo)
+        self.accept("control-y", self.redo)
+        self.accept("m", self.nextMaterial)
+        self.accept("f9", self.switchProfiler)
+        self.accept("f10", self.exportProfile)
+        self.accept("f11", self.printStats)
+        self.accept("f12", self.switchLighting)
 
         print("'f1' - создать базовую карту")
         print("'f2' - создать случайную карту")
         print("'f3' - сохранить карту")
         print("'f4' - загрузить карту")
-
-        self.accept('1', self.changeColor, [(1, 0.5, 1, 1)])
-        self.accept('2', self.changeColor, [(0, 0.5, 1, 1)])
-        self.accept('3', self.changeColor, [(1, 1, 1, 1)])
-        self.accept('4', self.changeColor, [(0.5, 0.5, 0.5, 1)])
-        self.accept('5', self.changeColor, [(0.5, 0.5, 0, 1)])
-        self.accept('6', self.changeColor, [(1, 0.5, 0.5, 1)])
-        self.accept('7', self.changeColor, [(0.1, 0.5, 0.7, 1)])
-        self.accept('8', self.changeColor, [(0, 0, 1, 1)])
+        print("'f5' - вкл/выкл объединение граней чанков")
+        print("'f6' - сохранить мир регионами")
+        print("'f7' - загрузить мир регионами (потоково)")
+        print("'f8' - создать ландшафт")
+        print("'ctrl+z' - отменить изменение")
+        print("'ctrl+y' - повторить изменение")
+        print("'m' - следующий материал блоков")
+        print("'f9' - вкл/выкл профилировщик")
+        print("'f10' - выгрузить замеры профилировщика")
+        print("'f11' - статистика фоновых работ и выделения блоков")
+        print("'f12' - вкл/выкл освещение")
+        print("'r' - отметить угол области блоком под прицелом")
+        print("'f'/'h' - заполнить область / её стенки")
+        print("'g' - шар с центром в первом углу области")
+        print("'x' - удалить блоки области")
+        print("'t' - заменить в области цвет блока под прицелом")
+        print("'c'/'v' - копировать область / вставить у прицела")
+        print("'p' - перекрасить текущим цветом все блоки цвета блока под прицелом")
+
+        # цифры 1-8 выбирают первые элементы палитры мира
+        for index in range(1, 9):
+            self.accept(str(index), self.changeColor, [index])
         self.accept('9', self.changeColor, [(None)])
 
 
@@ -73,11 +112,11 @@ class Game(ShowBase):
 
         # генерируем случайный уровень
         self.generateRandomMap()
-    def changeColor(self, color):
-        if color is None:
-            color = (0, 0, 0)
+    def changeColor(self, index):
+        if index is None:
+            index = 0
         else:
-            self.map_manager.setColor(color)
+            self.map_manager.setColor(index)
 
 
     def basicMap(self):
@@ -92,6 +131,17 @@ class Game(ShowBase):
         self.map_manager.generateRandomMap()
         print('Random map generated')
 
+    def generateTerrain(self):
+        if not self.edit_mode:
+            self.controller.setEditMode(self.edit_mode)
+        generator = TerrainGenerator(seed=self.terrain_seed)
+        self.map_manager.generateTerrain(generator)
+        # поднимаем камеру над ландшафтом
+        base.camera.setZ(20)
+        print('Terrain generated, seed', self.terrain_seed)
+        # следующий ландшафт будет другим
+        self.terrain_seed += 1
+
     def saveMap(self):
         self.map_manager.saveMap(self.file_name)
         print('Map saved to "'+self.file_name+'"')
@@ -102,6 +152,58 @@ class Game(ShowBase):
         self.map_manager.loadMap(self.file_name)
         print('Map loaded from "'+self.file_name+'"')
 
+    def undo(self):
+        if self.map_manager.undo():
+            print('Undo')
+        else:
+            print('Nothing to undo')
+
+    def redo(self):
+        if self.map_manager.redo():
+            print('Redo')
+        else:
+            print('Nothing to redo')
+
+    def switchProfiler(self):
+        self.profiler_overlay.toggle()
+
+    def exportProfile(self):
+        profiler.exportJSON(self.profile_name + '.json')
+        profiler.exportCSV(self.profile_name + '.csv')
+        print('Profile exported to "'+self.profile_name+'.json" and "' +
+              self.profile_name+'.csv"')
+
+    def printStats(self):
+        scheduler.printStats()
+        stats = self.editor.getPickStats()
+        print('picking: hits', stats['hits'], 'misses', stats['misses'])
+
+    def nextMaterial(self):
+        material = (self.map_manager.material + 1) % len(MATERIALS)
+        self.map_manager.setMaterial(material)
+        print('Material:', getMaterialName(material))
+
+    def saveWorld(self):
+        self.map_manager.saveWorld(self.world_name)
+        print('World saved to "'+self.world_name+'"')
+
+    def streamWorld(self):
+        if not self.edit_mode:
+            self.controller.setEditMode(self.edit_mode)
+        self.map_manager.streamWorld(self.world_name, base.camera)
+        print('World streamed from "'+self.world_name+'"')
+
+    def switchLighting(self):
+        enabled = not self.map_manager.hasLighting()
+        self.map_manager.setLighting(enabled)
+        print('Lighting:', 'on' if enabled else 'off')
+
+    def switchGreedyMeshing(self):
+        renderer = self.map_manager.renderer
+        renderer.setGreedy(not renderer.greedy)
+        renderer.updateChunks()
+        renderer.printStats()
+
     # добавьте метод установки цвета
     # ...
         # если установлен режим редактирования
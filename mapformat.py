@@ -0,0 +1,249 @@
+import mmap
+import pickle
+import struct
+import numpy as np
+
+from profiler import profiled
+from chunkrenderer import CHUNK_SIZE, groupRows
+from chunkstore import CHUNK_SHAPE, CHUNK_CELLS, encodeRuns, decodeRuns
+
+# Формат файла карты (все числа little-endian):
+#  заголовок HEADER_FORMAT:
+#    сигнатура MAGIC, версия формата, флаги,
+#    количество блоков, количество цветов палитры
+#  палитра: количество цветов * 4 байта RGBA (uint8)
+#  материалы палитры: количество цветов * 1 байт (при флаге FLAG_MATERIALS,
+#    с версии 2; без флага у всех блоков материал 0)
+#  версия 3 - блоки по чанкам:
+#    количество чанков (uint32), затем для каждого чанка
+#    заголовок CHUNK_FORMAT (ключ чанка, количество серий)
+#    и чанк, закодированный длинами серий (chunkstore.encodeRuns):
+#    номер серии 0 - пусто, i - цвет палитры i - 1
+#  версии 1 и 2 (пишутся для редких разбросанных блоков, если так меньше):
+#    координаты X, Y, Z: три массива int16 по количеству блоков
+#    индексы цветов: массив uint8 (или uint16 при флаге FLAG_WIDE_INDEX)
+MAGIC = b'VXMP'
+VERSION = 3
+HEADER_FORMAT = '<4sHHII'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+# версия формата для блоков, записанных столбцами координат
+COLUMNS_VERSION = 2
+CHUNK_FORMAT = '<iiiI'
+CHUNK_HEADER_SIZE = struct.calcsize(CHUNK_FORMAT)
+
+# флаг: индексы цветов хранятся в uint16 (цветов в палитре больше 256,
+# до версии 3)
+FLAG_WIDE_INDEX = 1
+# флаг: у элементов палитры есть номера материалов
+FLAG_MATERIALS = 2
+
+# допустимый диапазон координат при записи столбцами
+COORD_MIN = np.iinfo(np.int16).min
+COORD_MAX = np.iinfo(np.int16).max
+
+# Функция проверки, записан ли файл в новом бинарном формате
+def isBinaryMap(filename):
+    with open(filename, 'rb') as fin:
+        return fin.read(len(MAGIC)) == MAGIC
+
+
+# Функция сохранения карты в бинарный файл. Аргументы:
+#  filename - имя файла
+#  positions - массив (n, 3) целочисленных координат блоков
+#  colors - массив (n, 4) цветов блоков (RGBA от 0 до 1)
+#  materials - массив (n,) номеров материалов блоков (None - все 0)
+@profiled
+def saveMapFile(filename, positions, colors, materials=None):
+    colors = np.asarray(colors, dtype=np.float32).reshape(-1, 4)
+
+    # квантуем цвета до байта на канал и строим палитру
+    # из различных пар (цвет, материал)
+    entries = np.zeros((len(colors), 5), dtype=np.uint8)
+    entries[:, :4] = np.clip(np.rint(colors * 255), 0, 255)
+    if materials is not None:
+        entries[:, 4] = materials
+    palette, indices = np.unique(entries, axis=0, return_inverse=True)
+    saveIndexedMapFile(filename, positions, indices.reshape(-1),
+                       palette[:, :4], palette[:, 4])
+
+
+# Функция сохранения карты, блоки которой заданы номерами палитры.
+# Аргументы:
+#  filename - имя файла
+#  positions - массив (n, 3) целочисленных координат блоков
+#  indices - массив (n,) номеров палитры блоков
+#  colors - массив (k, 4) uint8 цветов палитры (RGBA от 0 до 255)
+#  materials - массив (k,) номеров материалов палитры
+# В файл попадают только элементы палитры, которые есть у блоков.
+# Блоки пишутся по чанкам, а редкие разбросанные блоки - столбцами
+# координат, если так файл меньше
+@profiled
+def saveIndexedMapFile(filename, positions, indices, colors, materials):
+    positions = np.asarray(positions, dtype=np.int64).reshape(-1, 3)
+
+    # оставляем только используемые элементы палитры
+    used, indices = np.unique(np.asarray(indices), return_inverse=True)
+    palette = np.zeros((len(used), 5), dtype=np.uint8)
+    palette[:, :4] = np.asarray(colors)[used]
+    palette[:, 4] = np.asarray(materials)[used]
+    # номер серии - номер цвета плюс один (0 - пусто)
+    indices = indices.reshape(-1) + 1
+    if len(palette) >= 1 << 16:
+        raise ValueError('too many colors for one map file')
+    flags = 0
+    if palette[:, 4].any():
+        flags |= FLAG_MATERIALS
+
+    chunks = groupRows(positions // CHUNK_SIZE)
+    blocks = [struct.pack('<I', len(chunks))]
+    for key, rows in chunks.items():
+        grid = np.zeros(CHUNK_SHAPE, dtype=np.uint16)
+        local = positions[rows] % CHUNK_SIZE
+        grid[local[:, 0], local[:, 1], local[:, 2]] = indices[rows]
+        data = encodeRuns(grid)
+        blocks.append(struct.pack(CHUNK_FORMAT, key[0], key[1], key[2],
+                                  len(data) // 4))
+        blocks.append(data)
+    blocks = b''.join(blocks)
+    version = VERSION
+
+    # редкие блоки меньше занимают столбцами координат и индексов
+    index_type = np.uint8 if len(palette) <= 256 else np.dtype('<u2')
+    if (len(positions) and
+            len(positions) * (6 + np.dtype(index_type).itemsize) < len(blocks)
+            and positions.min() >= COORD_MIN
+            and positions.max() <= COORD_MAX):
+        version = COLUMNS_VERSION
+        if index_type != np.uint8:
+            flags |= FLAG_WIDE_INDEX
+        # координаты храним по столбцам
+        coords = np.ascontiguousarray(positions.T, dtype='<i2')
+        blocks = (coords.tobytes() +
+                  (indices - 1).astype(index_type).tobytes())
+
+    with open(filename, 'wb') as fout:
+        fout.write(struct.pack(HEADER_FORMAT, MAGIC, version, flags,
+                               len(positions), len(palette)))
+        fout.write(np.ascontiguousarray(palette[:, :4]).tobytes())
+        if flags & FLAG_MATERIALS:
+            fout.write(np.ascontiguousarray(palette[:, 4]).tobytes())
+        fout.write(blocks)
+
+
+# Функция загрузки карты из файла любого формата.
+# Возвращает (координаты (n, 3) int, цвета (n, 4) float32,
+# материалы (n,) uint8)
+def loadMapFile(filename):
+    if isBinaryMap(filename):
+        return loadBinaryMap(filename)
+    return importLegacyMap(filename)
+
+
+# Функция загрузки карты из бинарного файла.
+# Файл отображается в память; массивы координат файлов до версии 3
+# являются представлениями этой памяти без копирования.
+@profiled
+def loadBinaryMap(filename):
+    with open(filename, 'rb') as fin:
+        data = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(data)
+
+    magic, version, flags, count, palette_size = struct.unpack_from(
+        HEADER_FORMAT, view)
+    if magic != MAGIC:
+        raise ValueError('%s is not a binary map file' % filename)
+    if version > VERSION:
+        raise ValueError('unsupported map format version %d' % version)
+
+    offset = HEADER_SIZE
+    palette = np.frombuffer(view, dtype=np.uint8, count=palette_size * 4,
+                            offset=offset).reshape(-1, 4)
+    offset += palette.nbytes
+    if flags & FLAG_MATERIALS:
+        palette_materials = np.frombuffer(view, dtype=np.uint8,
+                                          count=palette_size, offset=offset)
+        offset += palette_materials.nbytes
+    else:
+        palette_materials = np.zeros(palette_size, dtype=np.uint8)
+    if version >= 3:
+        positions, indices = readChunks(view, offset)
+    else:
+        coords = np.frombuffer(view, dtype='<i2', count=count * 3,
+                               offset=offset).reshape(3, -1)
+        offset += coords.nbytes
+        index_type = '<u2' if flags & FLAG_WIDE_INDEX else np.uint8
+        indices = np.frombuffer(view, dtype=index_type, count=count,
+                                offset=offset)
+        positions = coords.T
+
+    # палитра маленькая - переводим её в float один раз
+    colors = (palette.astype(np.float32) / 255)[indices]
+    return positions, colors, palette_materials[indices]
+
+
+# Функция чтения блоков по чанкам (с версии 3) из буфера view,
+# начиная со смещения offset.
+# Возвращает (координаты (n, 3) int32, номера цветов палитры (n,))
+def readChunks(view, offset):
+    chunk_count, = struct.unpack_from('<I', view, offset)
+    offset += 4
+    positions = [np.empty((0, 3), dtype=np.int32)]
+    indices = [np.empty(0, dtype=np.intp)]
+    for _ in range(chunk_count):
+        x, y, z, runs = struct.unpack_from(CHUNK_FORMAT, view, offset)
+        offset += CHUNK_HEADER_SIZE
+        flat = decodeRuns(view[offset:offset + runs * 4]).reshape(-1)
+        offset += runs * 4
+        cells = np.flatnonzero(flat)
+        positions.append(CHUNK_CELLS[cells] +
+                         np.array((x, y, z), dtype=np.int32) * CHUNK_SIZE)
+        indices.append(flat[cells].astype(np.intp) - 1)
+    return np.concatenate(positions), np.concatenate(indices)
+
+
+# Функция импорта карты старого формата
+# (последовательность записей pickle: количество, затем позиция и цвет
+# каждого блока). Для чтения нужны классы Panda3D (LPoint3f).
+@profiled
+def importLegacyMap(filename):
+    with open(filename, 'rb') as fin:
+        # считываем количество блоков
+        lenght = pickle.load(fin)
+        positions = np.empty((lenght, 3), dtype=np.int32)
+        colors = np.empty((lenght, 4), dtype=np.float32)
+        for i in range(lenght):
+            # считываем позицию
+            positions[i] = np.rint(tuple(pickle.load(fin)))
+            # считываем цвет
+            colors[i] = pickle.load(fin)
+    return positions, colors, np.zeros(lenght, dtype=np.uint8)
+
+
+# Функция потокового чтения текстового файла слоёв карты.
+# Формат: каждая строка - ряд блоков по Y, каждый символ - блок по X,
+# слои по Z разделяются пустой строкой (как вложенный список createMap).
+# Строки, начинающиеся с '#', пропускаются.
+# Файл читается по одному слою: функция-генератор выдаёт для каждого
+# слоя массив (ряды, символы) кодов символов uint8. Короткие ряды
+# дополняются пробелами.
+def readLayerFile(filename):
+    with open(filename, 'rb') as fin:
+        rows = []
+        for line in fin:
+            line = line.rstrip(b'\r\n')
+            if line.startswith(b'#'):
+                continue
+            if line.strip():
+                rows.append(line)
+            elif rows:
+                yield layerToArray(rows)
+                rows = []
+        if rows:
+            yield layerToArray(rows)
+
+
+# Функция перевода рядов слоя (строк bytes) в массив кодов uint8
+def layerToArray(rows):
+    width = max(len(row) for row in rows)
+    data = b''.join(row.ljust(width) for row in rows)
+    return np.frombuffer(data, dtype=np.uint8).reshape(len(rows), width)
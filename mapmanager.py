@@ -1,14 +1,116 @@
 from direct.showbase.ShowBase import ShowBase
-from panda3d.core import LPoint3f
-from random import randint, random
-import pickle
+from panda3d.core import LPoint3f, BoundingVolume
+from random import randint
+import os
+import gc
+from collections.abc import Mapping
+from contextlib import contextmanager
+import numpy as np
 from block import Block
+from selection import SelectionBox
+from palette import palette, quantizeColors, randomColors
+from history import EditHistory
+from materials import MATERIALS
+from profiler import profiled
+import mapformat
+import editlog
+import worldstream
+from chunkrenderer import (ChunkRenderer, CHUNK_SIZE, buildChunkArrays,
+                           buildChunkLods, chunkOf, packKeys, unpackKey)
+from chunkstore import ChunkStore
+from raycast import voxelRaycast
+from lighting import LightEngine
+from spatial import OccupancyIndex
+import regions
+
+# период сжатия чанков, которые не менялись и не читались (секунд)
+COMPRESS_PERIOD = 10
 
 # Функция получения случайного цвета
+# (из ограниченного набора, чтобы не переполнять палитру)
 def getRandomColor():
-    return (random()*0.3+0.7,
-            random()*0.3+0.7,
-            random()*0.3+0.7, 1)
+    return tuple(randomColors(1)[0].tolist())
+
+# Функция получения целочисленных координат вокселя по позиции блока
+def toVoxel(position):
+    return (int(round(position[0])),
+            int(round(position[1])),
+            int(round(position[2])))
+
+# Функция приостановки сборщика мусора (внутри блока with).
+# Блоки и индексы карты не образуют циклов ссылок, а при создании
+# множества объектов сборщик иначе много раз обходит все объекты
+@contextmanager
+def pausedCollection():
+    collect = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if collect:
+            gc.enable()
+
+# Функция получения блоков по трёхмерной сетке обозначений. Аргументы:
+#  colors - палитра: словарь обозначение - цвет или список цветов,
+#           индексы которого - числа сетки (None - блока нет)
+#  grid - массив обозначений (символы или целые числа),
+#         индексы - [z][y][x]
+#  shift - сдвиг всех координат
+# Координата Y инвертируется, как в createMap.
+# Возвращает (координаты (n, 3), цвета (n, 4))
+def gridToBlocks(colors, grid, shift):
+    grid = np.asarray(grid)
+    # каждое обозначение ищем в палитре один раз
+    values, inverse = np.unique(grid, return_inverse=True)
+    inverse = inverse.reshape(grid.shape)
+    palette = []
+    for value in values.tolist():
+        # байтовые обозначения (dtype 'S', как у np.chararray)
+        # ищем в палитре строками
+        if isinstance(value, bytes):
+            value = value.decode()
+        if isinstance(colors, dict):
+            color = colors.get(value)
+        elif isinstance(value, int) and 0 <= value < len(colors):
+            color = colors[value]
+        else:
+            color = None
+        palette.append(color if color is not None and len(color) else None)
+
+    present = np.array([color is not None for color in palette])
+    table = np.array([(0, 0, 0, 0) if color is None else color
+                      for color in palette],
+                     dtype=np.float32).reshape(-1, 4)
+    mask = present[inverse]
+    z, y, x = np.nonzero(mask)
+    positions = np.column_stack((x + shift[0], -y - shift[1], z + shift[2]))
+    return positions, table[inverse[mask]]
+
+# Функция перевода вложенного списка в массив обозначений [z][y][x].
+# Ряды могут быть строками; короткие ряды и слои дополняются
+# пустыми обозначениями ('' или -1)
+def matrixToGrid(matrix):
+    if isinstance(matrix, np.ndarray):
+        return matrix
+    try:
+        grid = np.array(matrix)
+        # строки целиком (ряды-строки) разбираем ниже по символам
+        if grid.ndim == 3 and not (grid.dtype.kind == 'U' and
+                                   grid.dtype.itemsize > 4):
+            return grid
+    except ValueError:
+        pass
+    rows = [row for layer in matrix for row in layer]
+    width = max([len(row) for row in rows] or [0])
+    height = max([len(layer) for layer in matrix] or [0])
+    empty = '' if any(isinstance(row, str) or
+                      any(isinstance(key, str) for key in row)
+                      for row in rows) else -1
+    grid = np.full((len(matrix), height, width), empty, dtype=object)
+    for z, layer in enumerate(matrix):
+        for y, row in enumerate(layer):
+            grid[z, y, :len(row)] = list(row)
+    return grid
 
 # Функция получения цвета выделения для заданного цвета блока
 def getSelectColor(color):
@@ -21,26 +123,113 @@ def getSelectColor(color):
                 color[2]*0.4, 0.9)
 
 
+# Класс представления блоков карты словарём: ключ - воксель (x, y, z),
+# значение - блок. Блоки хранятся номерами палитры в хранилище чанков,
+# а объекты Block создаются при обращении (кроме блоков с узлами)
+class BlockMap(Mapping):
+    # Конструктор. Аргументы:
+    #  map_manager - менеджер карты
+    def __init__(self, map_manager):
+        self.map_manager = map_manager
+
+    # Метод получения блока в вокселе voxel
+    def __getitem__(self, voxel):
+        block = self.map_manager.node_blocks.get(voxel)
+        if block is not None:
+            return block
+        index = self.map_manager.store.get(voxel)
+        if not index:
+            raise KeyError(voxel)
+        return Block(voxel, index, with_node=False)
+
+    # Метод проверки, есть ли блок в вокселе voxel
+    def __contains__(self, voxel):
+        return self.map_manager.store.get(voxel) != 0
+
+    # Метод перебора вокселей всех блоков
+    def __iter__(self):
+        positions = self.map_manager.store.getBlocks()[0]
+        return map(tuple, positions.tolist())
+
+    # Метод получения количества блоков
+    def __len__(self):
+        return len(self.map_manager.store)
+
+
 # Класс менеджера карты
 class MapManager():
-    # Конструктор
-    def __init__(self):
-        # список с блоками
-        self.blocks = list()
+    # Конструктор. Аргументы:
+    #  use_chunks - отрисовывать блоки чанками (ChunkRenderer),
+    #               а не отдельным узлом на каждый блок
+    #  collisions - создавать ли геометрию столкновения блоков
+    #               (выделение блоков работает и без неё)
+    #  lighting - освещать ли чанки (солнечный свет и затенение углов)
+    def __init__(self, use_chunks=True, collisions=True, lighting=True):
+        # хранилище блоков: номер палитры каждого вокселя по чанкам
+        self.store = ChunkStore()
+        # блоки карты словарём (ключ - воксель (x, y, z), значение - блок)
+        self.blocks = BlockMap(self)
+        # блоки с собственными узлами (только без отрисовщика чанков):
+        # ключ - воксель, значение - блок
+        self.node_blocks = dict()
+        # битовые маски занятых вокселей по чанкам (для запросов по области)
+        self.occupancy = OccupancyIndex()
         # выделенный блок
         self.selected_block = None
         # текущий цвет для новых блоков
         self.color = None
+        # текущий материал для новых блоков
+        self.material = 0
         # получаем текущий цвет выделения
         self.selected_color = getSelectColor(self.color)
+        # рамка выделения (одна на всю карту)
+        self.selection = SelectionBox(self.selected_color)
+        # отрисовщик чанков (None - у каждого блока свой узел)
+        self.collisions = collisions
+        self.renderer = (ChunkRenderer(self, collisions)
+                         if use_chunks else None)
+        if self.renderer and lighting:
+            self.renderer.setLighting(LightEngine())
+        # без отрисовщика чанков узлы блоков группируются по чанкам,
+        # чтобы Panda3D отсекал по пирамиде видимости целые чанки
+        self.block_root = (None if use_chunks else
+                           render.attachNewNode('blocks'))
+        # словарь родительских узлов блоков: ключ чанка - узел
+        self.chunk_nodes = dict()
+        # потоковая загрузка мира по регионам (None - вся карта в памяти)
+        self.streamer = None
+        # палитра цветов блоков (общая палитра мира)
+        # и журнал отмены изменений
+        self.palette = palette
+        self.history = EditHistory()
+        # журнал правок файла карты (None - карта не связана с файлом)
+        self.edit_log = None
+        # номер версии карты: увеличивается при каждом изменении блоков
+        # (по нему, например, редактор узнаёт, что выделение устарело)
+        self.revision = 0
+        # чанки, которые не менялись и не читались, периодически сжимаются
+        taskMgr.doMethodLater(COMPRESS_PERIOD, self.compressTask,
+                              'chunk-compress-task')
+
+    # Задача сжатия неиспользуемых чанков хранилища
+    def compressTask(self, task):
+        self.store.compressIdle()
+        return task.again
 
-    # Метод добавления нового блока цвета color в позицию position
-    def addBlock(self, position, color=None):
+    # Метод отметки изменения карты (новая версия карты)
+    def touch(self):
+        self.revision += 1
+
+    # Метод добавления нового блока цвета color и материала material
+    # в позицию position (None - текущие цвет и материал)
+    @profiled
+    def addBlock(self, position, color=None, material=None):
+        # координаты вокселя для новой позиции
+        voxel = toVoxel(position)
         # проверяем, есть ли в этой позиции другой блок
-        for block in self.blocks:
+        if self.store.get(voxel):
             # если есть - выходим
-            if block.getPos() == position:
-                return
+            return
 
         # если цвет не задан
         if color is None:
@@ -51,186 +240,783 @@ class MapManager():
             else:
                 # устанавливаем текущий цвет
                 color = self.color
+        if material is None:
+            material = self.material
+        index = self.palette.indexOf(color, material)
+
+        # записываем блок в хранилище
+        self.store.set(voxel, index)
+        # без отрисовщика чанков у блока свой узел
+        if self.renderer is None:
+            self.node_blocks[voxel] = Block(voxel, index, True,
+                                            self.collisions,
+                                            self.getChunkNode(voxel))
+        self.occupancy.setVoxel(voxel, True)
+        self.touch()
+        # помечаем чанк блока для перестройки
+        if self.renderer:
+            self.renderer.blockAdded(voxel)
+        # записываем изменение в журнал
+        self.recordEdits([voxel], [0], [index])
+
+    # Метод добавления множества блоков за один проход. Аргументы:
+    #  positions - массив (n, 3) координат блоков
+    #  colors - массив (n, 4) цветов блоков
+    #           (None - текущий цвет или случайные цвета)
+    #  materials - массив (n,) номеров материалов (None - текущий материал)
+    # Повторяющиеся и уже занятые позиции пропускаются.
+    # Возвращает количество добавленных блоков
+    @profiled
+    def addBlocks(self, positions, colors=None, materials=None):
+        positions = np.asarray(positions, dtype=np.float64)
+        if not positions.size:
+            return 0
+        if positions.ndim != 2 or positions.shape[1] != 3:
+            raise ValueError('positions must be an (n, 3) array')
+        if not np.isfinite(positions).all():
+            raise ValueError('positions must be finite')
+        if len(positions) and np.abs(positions).max() >= 1 << 20:
+            raise ValueError('positions are out of the map range')
+        positions = np.rint(positions).astype(np.int32)
+
+        if colors is None:
+            if self.color is None:
+                # случайные цвета как у getRandomColor
+                colors = randomColors(len(positions))
+            else:
+                colors = np.tile(np.asarray(self.color, dtype=np.float64),
+                                 (len(positions), 1))
+        else:
+            colors = np.asarray(colors, dtype=np.float64)
+            if colors.shape != (len(positions), 4):
+                raise ValueError('colors must be an (n, 4) array '
+                                 'matching positions')
+        if materials is None:
+            materials = np.full(len(positions), self.material, dtype=np.uint8)
+        else:
+            materials = np.asarray(materials)
+            if materials.shape != (len(positions),):
+                raise ValueError('materials must be an (n,) array '
+                                 'matching positions')
+            if len(materials) and (materials.min() < 0 or
+                                   materials.max() >= len(MATERIALS)):
+                raise ValueError('unknown material')
+            materials = materials.astype(np.uint8)
+
+        # убираем повторы (остаётся первое вхождение)
+        _, first = np.unique(packKeys(positions), return_index=True)
+        if len(first) < len(positions):
+            first.sort()
+            positions = positions[first]
+            colors = colors[first]
+            materials = materials[first]
+        # и позиции, которые уже заняты
+        free = ~self.occupancy.occupied(positions)
+        if not free.all():
+            positions = positions[free]
+            colors = colors[free]
+            materials = materials[free]
+        if not len(positions):
+            return 0
+
+        # блоки хранят номера палитры
+        indices = self.palette.indicesOf(colors, materials)
+        with pausedCollection(), self.batch():
+            self.store.setMany(positions, indices)
+            if self.renderer is None:
+                for voxel, index in zip(map(tuple, positions.tolist()),
+                                        indices.tolist()):
+                    self.node_blocks[voxel] = Block(
+                        voxel, index, True, self.collisions,
+                        self.getChunkNode(voxel))
+            self.occupancy.add(positions)
+            self.touch()
+            if self.renderer:
+                self.renderer.blocksAdded(
+                    positions, self.palette.getColors(indices)[:, 3] >= 1.0)
+            self.recordEdits(positions, 0, indices)
+        return len(positions)
+
+    # Метод удаления множества блоков за один проход.
+    # positions - массив (n, 3) координат блоков (свободные пропускаются)
+    # Возвращает количество удалённых блоков
+    @profiled
+    def removeBlocks(self, positions):
+        positions = np.asarray(positions)
+        if positions.ndim != 2 or positions.shape[1] != 3:
+            raise ValueError('positions must be an (n, 3) array')
+        positions = np.rint(positions).astype(np.int32)
+        positions = positions[self.occupancy.occupied(positions)]
+        # убираем повторы (остаётся первое вхождение)
+        _, first = np.unique(packKeys(positions), return_index=True)
+        positions = positions[np.sort(first)]
+        if not len(positions):
+            return 0
+
+        with pausedCollection(), self.batch():
+            old = self.store.setMany(positions, 0)
+            if self.node_blocks:
+                for voxel in map(tuple, positions.tolist()):
+                    self.node_blocks.pop(voxel).remove()
+            self.dropStaleSelection()
+            self.occupancy.remove(positions)
+            self.touch()
+            if self.renderer:
+                self.renderer.blocksRemoved(positions)
+            self.recordEdits(positions, old, 0)
+        return len(positions)
+
+    # Метод удаления блоков параллелепипеда с углами low и high
+    # (включительно). Возвращает количество удалённых блоков
+    @profiled
+    def removeBox(self, low, high):
+        return self.removeBlocks(self.blocksInBox(low, high))
+
+    # Метод снятия выделения, если выделенного блока больше нет
+    def dropStaleSelection(self):
+        if (self.selected_block is not None and
+                not self.store.get(self.selected_block.position)):
+            self.deselectAllBlocks()
+
+    # Метод пакетного изменения карты: внутри блока with
+    # перестройка геометрии откладывается и выполняется один раз в конце,
+    # а все изменения попадают в журнал одной записью
+    @contextmanager
+    def batch(self):
+        if self.renderer:
+            self.renderer.suspend()
+        self.history.begin()
+        try:
+            yield self
+        finally:
+            self.history.end()
+            if self.renderer:
+                self.renderer.resume()
+
+    # Метод получения родительского узла для узла блока в вокселе voxel
+    # (None, если блоки рисуются отрисовщиком чанков)
+    def getChunkNode(self, voxel):
+        if self.block_root is None:
+            return None
+        key = chunkOf(voxel)
+        node = self.chunk_nodes.get(key)
+        if node is None:
+            node = self.block_root.attachNewNode('chunk_%d_%d_%d' % key)
+            # границы чанка окончательные: если чанк виден,
+            # блоки внутри него по отдельности не проверяются
+            node.node().setFinal(True)
+            node.node().setBoundsType(BoundingVolume.BT_box)
+            self.chunk_nodes[key] = node
+        return node
+
+    # Метод записи изменений вокселей в журнал отмены и в журнал правок
+    # файла карты. Аргументы:
+    #  positions - координаты (n, 3) изменённых вокселей
+    #  old, new - номера палитры (цвет и материал) до и после
+    #             (0 - блока нет)
+    def recordEdits(self, positions, old, new):
+        self.history.record(positions, old, new)
+        if self.edit_log:
+            positions = np.asarray(positions).reshape(-1, 3)
+            new = np.broadcast_to(np.asarray(new, dtype=np.uint32),
+                                  (len(positions),))
+            filled = new != 0
+            if not filled.all():
+                self.edit_log.append(positions[~filled])
+            if filled.any():
+                self.edit_log.append(positions[filled],
+                                     self.palette.getColors(new[filled]),
+                                     self.palette.getMaterials(new[filled]))
+
+    # Метод привязки журнала правок к файлу карты filename:
+    # дальше все изменения дописываются в журнал рядом с картой
+    def openEditLog(self, filename):
+        self.closeEditLog()
+        self.edit_log = editlog.EditLog(filename)
+
+    # Метод отвязки журнала правок (накопленные правки записываются)
+    def closeEditLog(self):
+        if self.edit_log:
+            self.edit_log.close()
+            self.edit_log = None
+
+    # Метод приведения вокселей positions к номерам палитры indices
+    # (0 - блока нет) одним пакетом, без записи в журнал
+    @profiled
+    def applyEdits(self, positions, indices):
+        occupied = self.occupancy.occupied(positions)
+        filled = indices != 0
+        with self.history.pause(), self.batch():
+            self.removeBlocks(positions[occupied])
+            self.addBlocks(positions[filled],
+                           self.palette.getColors(indices[filled]),
+                           self.palette.getMaterials(indices[filled]))
+
+    # Метод отмены последнего изменения карты.
+    # Возвращает True, если было что отменять
+    @profiled
+    def undo(self):
+        edits = self.history.undo()
+        if edits is None:
+            return False
+        self.applyEdits(*edits)
+        return True
+
+    # Метод повтора последнего отменённого изменения
+    @profiled
+    def redo(self):
+        edits = self.history.redo()
+        if edits is None:
+            return False
+        self.applyEdits(*edits)
+        return True
+
+    # Метод уведомления отрисовщика об изменении цвета блока
+    def updateBlock(self, block):
+        self.touch()
+        if self.renderer:
+            self.renderer.blockChanged(block.position)
+
+    # Метод добавления целого чанка key с готовой геометрией. Аргументы:
+    #  positions - массив (n, 3) координат блоков чанка
+    #  colors - массив (n, 4) цветов блоков
+    #  mesh - геометрия чанка (результат buildChunkArrays,
+    #         None - строится отрисовщиком)
+    #  lods - геометрия уровней детализации (результат buildChunkLods,
+    #         None - строится отрисовщиком)
+    #  materials - массив (n,) номеров материалов блоков (None - все 0)
+    @profiled
+    def addChunk(self, key, positions, colors, mesh, lods=None,
+                 materials=None):
+        indices = self.palette.indicesOf(colors, materials)
+        # блоки, уже добавленные в этот чанк (например, редактором),
+        # остаются на месте
+        existing = key in self.store.chunks
+        free = ~self.occupancy.occupied(positions)
+        self.store.setMany(positions[free], indices[free])
+        self.occupancy.add(positions)
+        self.touch()
+        self.renderer.setChunkMesh(key, mesh, self.store.getChunk(key)[0],
+                                   lods)
+        # готовая геометрия не учитывает уже добавленные блоки
+        if existing:
+            self.renderer.dirty.add(key)
+
+    # Метод добавления блоков из массивов сразу целыми чанками
+    # (геометрия каждого чанка строится один раз). Аргументы:
+    #  positions - массив (n, 3) целочисленных координат блоков
+    #  colors - массив (n, 4) цветов блоков
+    #  materials - массив (n,) номеров материалов (None - все 0)
+    @profiled
+    def addChunkArrays(self, positions, colors, materials=None):
+        if materials is None:
+            materials = np.zeros(len(positions), dtype=np.uint8)
+        # без отрисовщика чанков добавляем блоки обычным пакетом
+        if not self.renderer:
+            self.addBlocks(positions, colors, materials)
+            return
+
+        # в журнал попадают только блоки на свободных местах
+        # (занятые addChunk пропускает)
+        free = ~self.occupancy.occupied(positions)
+        self.recordEdits(np.asarray(positions)[free], 0,
+                         self.palette.indicesOf(np.asarray(colors)[free],
+                                                np.asarray(materials)[free]))
+
+        chunks = worldstream.groupBlocks(positions, colors, CHUNK_SIZE,
+                                         materials)
+        for key, (chunk_positions, chunk_colors,
+                  chunk_materials) in chunks.items():
+            # с освещением геометрия строится перестройкой чанков
+            # (когда освещение всех чанков уже рассчитано)
+            if self.renderer.lighting:
+                self.addChunk(key, chunk_positions, chunk_colors, None, None,
+                              chunk_materials)
+                continue
+            origin = np.array(key, dtype=np.int32) * CHUNK_SIZE
+            mesh = buildChunkArrays(origin, chunk_positions, chunk_colors,
+                                    worldstream.getBorderSolids(chunks, key),
+                                    self.renderer.greedy, chunk_materials)
+            lods = buildChunkLods(origin, chunk_positions, chunk_colors,
+                                  self.renderer.lod_levels,
+                                  self.renderer.greedy, chunk_materials)
+            self.addChunk(key, chunk_positions, chunk_colors, mesh, lods,
+                          chunk_materials)
+
+    # Метод удаления целого чанка key
+    @profiled
+    def removeChunk(self, key):
+        positions = self.store.getChunk(key)[0]
+        self.store.removeChunk(key)
+        self.dropStaleSelection()
+        self.occupancy.remove(positions)
+        self.touch()
+        self.renderer.removeChunk(key)
+
+    # Метод получения массивов координат, цветов и материалов
+    # блоков чанка key
+    def getChunkArrays(self, key):
+        positions, indices = self.store.getChunk(key)
+        return (positions, self.palette.getColors(indices).astype(np.float32),
+                self.palette.getMaterials(indices))
+
+    # Метод получения блока в позиции position (или None)
+    def getBlock(self, position):
+        return self.blocks.get(toVoxel(position))
+
+    # Метод поиска первого блока на луче. Аргументы:
+    #  origin - начало луча
+    #  direction - направление луча
+    #  max_distance - наибольшая длина луча
+    # Возвращает (воксель, нормаль грани, расстояние) или None
+    def raycast(self, origin, direction, max_distance=100):
+        return voxelRaycast(origin, direction, self.store.get, max_distance)
+
+    # Метод проверки, занята ли позиция position блоком
+    def isOccupied(self, position):
+        return self.store.get(toVoxel(position)) != 0
+
+    # Метод получения координат блоков в параллелепипеде
+    # с углами low и high (включительно, углы округляются до вокселей).
+    # Возвращает массив (n, 3) int32
+    def blocksInBox(self, low, high):
+        low = np.rint(np.asarray(low, dtype=np.float64))
+        high = np.rint(np.asarray(high, dtype=np.float64))
+        return self.occupancy.box(np.minimum(low, high),
+                                  np.maximum(low, high))
+
+    # Метод получения координат блоков, центры которых лежат в шаре
+    # с центром center и радиусом radius. Возвращает массив (n, 3) int32
+    def blocksInSphere(self, center, radius):
+        return self.occupancy.sphere(center, radius)
+
+    # Метод получения координат блоков, соседних с позицией position
+    # (diagonal - считать и соседей по рёбрам и углам).
+    # Возвращает массив (n, 3) int32
+    def neighbors(self, position, diagonal=False):
+        return self.occupancy.neighbors(toVoxel(position), diagonal)
+
+    # Метод получения высоты самого верхнего блока в столбце (x, y)
+    # (below - искать только ниже этой высоты). Возвращает z или None
+    def columnTop(self, x, y, below=None):
+        return self.occupancy.columnTop(int(round(x)), int(round(y)), below)
+
+    # Метод поиска первого блока на луче (как raycast).
+    # Возвращает (воксель, нормаль грани - массивы int32, расстояние)
+    # или None
+    def firstHit(self, origin, direction, max_distance=100):
+        hit = self.raycast(origin, direction, max_distance)
+        if hit is None:
+            return None
+        return (np.array(hit[0], dtype=np.int32),
+                np.array(hit[1], dtype=np.int32), hit[2])
 
-        # создаём блок
-        block = Block(position, color)
-        # добавляем его в список
-        self.blocks.append(block)
+    # Метод заполнения блоками вокселей positions (массив (n, 3))
+    # цветом color и материалом material (None - текущие).
+    # Занятые позиции не меняются. Возвращает количество новых блоков
+    def fillCells(self, positions, color=None, material=None):
+        colors = materials = None
+        if color is not None:
+            colors = np.tile(np.asarray(color, dtype=np.float64),
+                             (len(positions), 1))
+        if material is not None:
+            materials = np.full(len(positions), material, dtype=np.uint8)
+        return self.addBlocks(positions, colors, materials)
 
-    # Метод установки текущего цвета для новых блоков
+    # Метод заполнения параллелепипеда с углами low и high
+    # (включительно). hollow - только стенки толщиной в блок.
+    # Возвращает количество новых блоков
+    @profiled
+    def fillBox(self, low, high, color=None, material=None, hollow=False):
+        return self.fillCells(regions.boxCells(low, high, hollow),
+                              color, material)
+
+    # Метод заполнения шара с центром center и радиусом radius.
+    # hollow - только поверхность толщиной в блок.
+    # Возвращает количество новых блоков
+    @profiled
+    def fillSphere(self, center, radius, color=None, material=None,
+                   hollow=False):
+        return self.fillCells(regions.sphereCells(center, radius, hollow),
+                              color, material)
+
+    # Метод получения массива (n,) номеров палитры блоков
+    # в позициях positions (0 - позиция свободна)
+    def getIndices(self, positions):
+        return self.store.getMany(positions)
+
+    # Метод получения массивов цветов (n, 4) и материалов (n,)
+    # блоков в позициях positions (все позиции должны быть заняты)
+    def getBlockArrays(self, positions):
+        indices = self.getIndices(positions)
+        return (self.palette.getColors(indices),
+                self.palette.getMaterials(indices))
+
+    # Метод замены цвета old_color на color (None - текущий цвет)
+    # у блоков в параллелепипеде с углами low и high.
+    # material - новый материал (None - материал блоков не меняется).
+    # Возвращает количество изменённых блоков
+    @profiled
+    def replaceColor(self, low, high, old_color, color=None,
+                     material=None):
+        positions = self.blocksInBox(low, high)
+        colors, materials = self.getBlockArrays(positions)
+        # цвета сравниваются квантованными, как в палитре
+        found = (quantizeColors(colors) ==
+                 quantizeColors(old_color)).all(axis=1)
+        positions = positions[found]
+        if not len(positions):
+            return 0
+        if color is None:
+            color = self.color
+        colors = None
+        if color is not None:
+            colors = np.tile(np.asarray(color, dtype=np.float64),
+                             (len(positions), 1))
+        if material is None:
+            materials = materials[found]
+        else:
+            materials = np.full(len(positions), material, dtype=np.uint8)
+        # блоки пересоздаются новым цветом одной записью журнала
+        with self.batch():
+            self.removeBlocks(positions)
+            self.addBlocks(positions, colors, materials)
+        return len(positions)
+
+    # Метод копирования блоков параллелепипеда с углами low и high
+    # в буфер обмена. Возвращает regions.Clipboard
+    @profiled
+    def copyRegion(self, low, high):
+        positions = self.blocksInBox(low, high)
+        colors, materials = self.getBlockArrays(positions)
+        return regions.Clipboard.fromBlocks(low, high, positions,
+                                            colors, materials)
+
+    # Метод вставки буфера обмена clipboard меньшим углом в точку origin.
+    # replace - заменять уже стоящие блоки (иначе они остаются).
+    # Возвращает количество вставленных блоков
+    @profiled
+    def pasteRegion(self, clipboard, origin, replace=True):
+        positions, colors, materials = clipboard.getBlocks(origin)
+        with self.batch():
+            if replace:
+                self.removeBlocks(positions)
+            return self.addBlocks(positions, colors, materials)
+
+    # Метод получения блока по ключу (или None)
+    def getBlockByKey(self, key):
+        if key is None:
+            return None
+        return self.blocks.get(unpackKey(key))
+
+    # Метод установки текущего цвета для новых блоков: номер элемента
+    # палитры мира или цвет (квантуется и добавляется в палитру),
+    # None - случайные цвета
     def setColor(self, color):
-        self.color = color
+        if isinstance(color, (int, np.integer)):
+            if not 0 < color < len(self.palette):
+                raise ValueError('no palette entry %r' % color)
+        elif color is not None:
+            color = self.palette.indexOf(color)
+        self.color = (None if color is None
+                      else self.palette.getColor(color))
         # получаем текущий цвет выделения
         self.selected_color = getSelectColor(self.color)
 
-        # если есть выделенный блок
-        if self.selected_block:
-            # обновляем его цвет
-            self.selected_block.updateColor(self.selected_color)
+        # обновляем цвет рамки выделения
+        self.selection.setColor(self.selected_color)
+
+    # Метод изменения цвета элемента палитры index на color:
+    # перекрашиваются все блоки с этим номером.
+    # Возвращает количество перекрашенных блоков
+    @profiled
+    def setPaletteColor(self, index, color):
+        was_opaque = self.palette.getColor(index)[3] >= 1.0
+        self.palette.setEntryColor(index, color)
+        opaque = self.palette.getColor(index)[3] >= 1.0
+        positions = self.store.find(index)
+        if not len(positions):
+            return 0
+        self.touch()
+        if self.renderer:
+            self.renderer.blocksChanged(
+                positions, None if opaque == was_opaque
+                else np.full(len(positions), opaque))
+        else:
+            for voxel in map(tuple, positions.tolist()):
+                self.node_blocks[voxel].updateNode()
+        # в журнал отмены не попадает (номера блоков не меняются),
+        # а файл карты получает новые цвета блоков
+        if self.edit_log:
+            indices = np.full(len(positions), index)
+            self.edit_log.append(positions, self.palette.getColors(indices),
+                                 self.palette.getMaterials(indices))
+        return len(positions)
+
+    # Метод установки текущего материала для новых блоков
+    # (номер из materials.MATERIALS)
+    def setMaterial(self, material):
+        if not 0 <= material < len(MATERIALS):
+            raise ValueError('unknown material %r' % material)
+        self.material = material
+
+    # Метод включения/выключения освещения чанков
+    def setLighting(self, enabled):
+        if self.renderer:
+            self.renderer.setLighting(LightEngine() if enabled else None)
+
+    # Метод проверки, включено ли освещение чанков
+    def hasLighting(self):
+        return bool(self.renderer and self.renderer.lighting)
 
     # Метод создания базовой карты - квадрата
+    @profiled
     def basicMap(self):
-        # удаляем все блоки
-        self.clearAll()
+        # удаляем все блоки (замена карты отменяется одной записью)
+        with self.batch():
+            self.clearAll()
 
-        for i in range(-7,8):
-            for j in range(-7,8):
-                pos = (i, j, -2)
-                self.addBlock(pos, (1,1,1,1))
+            positions = [(i, j, -2) for i in range(-7,8) for j in range(-7,8)]
+            self.addBlocks(positions, np.ones((len(positions), 4)))
 
     # Метод генерации новой случайной карты
+    @profiled
     def generateRandomMap(self):
-        # удаляем все блоки
-        self.clearAll()
+        # удаляем все блоки (замена карты отменяется одной записью)
+        with self.batch():
+            self.clearAll()
+
+            positions = []
+            # Блоки в нижней части карты
+            for i in range(-8,9):
+                for j in range(-8,9):
+                    positions.append((i, j, randint(-4,-2)))
+
+            # Блоки по краям карты
+            for i in range(-8,9):
+                for j in range(-8,9):
+                    if -5 < i < 5 and -5 < j < 5:
+                        continue
+                    positions.append((i, j, randint(-1,6)))
+
+            self.addBlocks(positions)
 
-        # Блоки в нижней части карты
-        for i in range(-8,9):
-            for j in range(-8,9):
-                pos = (i, j, randint(-4,-2))
-                self.addBlock(pos)
+    # Метод генерации ландшафта. Аргументы:
+    #  generator - генератор ландшафта (TerrainGenerator)
+    #  origin - координаты угла области
+    #  shape - размеры области в блоках
+    @profiled
+    def generateTerrain(self, generator, origin=(-32, -32, -16),
+                        shape=(64, 64, 32)):
+        # удаляем все блоки (замена карты отменяется одной записью)
+        with self.batch():
+            self.clearAll()
 
-        # Блоки по краям карты
-        for i in range(-8,9):
-            for j in range(-8,9):
-                if -5 < i < 5 and -5 < j < 5:
-                    continue
-                pos = (i, j, randint(-1,6))
-                self.addBlock(pos)
+            # генерируем все блоки области массивами
+            positions, colors = generator.generate(origin, shape)
+            # и добавляем их целыми чанками
+            self.addChunkArrays(positions, colors)
 
     # Метод создания карты, аргументы
     # colors - словарь цветов,
     #   ключ - символ цвета,
     #   значение - цвет
+    #   (для сетки целых чисел - список цветов палитры)
     # matrix - трёхмерный вложенный список цветов
+    #   или массив NumPy (символы или uint8), индексы - [z][y][x]
     #   значения - символы цвета
     # shift - сдвиг всех координат
+    @profiled
     def createMap(self, colors, matrix, shift):
-        # удаляем все блоки
-        self.clearAll()
+        # удаляем все блоки (замена карты отменяется одной записью)
+        with self.batch():
+            self.clearAll()
+
+            # Рассчитываем позиции всех блоков сразу
+            # Координата Y инвертируется !!!
+            positions, block_colors = gridToBlocks(
+                colors, matrixToGrid(matrix), shift)
+            # добавляем все блоки одним пакетом
+            self.addBlocks(positions, block_colors)
 
-        # проходимся по всем трём координатам
-        for z in range(len(matrix)):
-            for y in range(len(matrix[z])):
-                for x in range(len(matrix[z][y])):
-                    # Получаем цвет блока
-                    key = matrix[z][y][x]
-                    # если такой цвет есть в словаре цветов
-                    if key in colors and colors[key]:
-                        # Рассчитываем позицию
-                        # Координата Y инвертируется !!!
-                        pos = (x + shift[0],
-                               - y - shift[1],
-                               z + shift[2])
-                        # добавляем новый блок
-                        self.addBlock(pos, colors[key])
+    # Метод загрузки карты из текстового файла слоёв
+    # (формат - см. mapformat.readLayerFile). Аргументы:
+    #  filename - имя файла
+    #  colors - словарь цветов, ключ - символ цвета
+    #  shift - сдвиг всех координат
+    # Файл разбирается по одному слою, вложенный список не строится
+    @profiled
+    def loadLayerFile(self, filename, colors, shift):
+        # слои читаются как коды символов - переводим ключи палитры
+        codes = {ord(key): color for key, color in colors.items()}
+        # удаляем все блоки (замена карты отменяется одной записью)
+        with self.batch():
+            self.clearAll()
+            for z, layer in enumerate(mapformat.readLayerFile(filename)):
+                positions, layer_colors = gridToBlocks(
+                    codes, layer[None], (shift[0], shift[1], shift[2] + z))
+                self.addBlocks(positions, layer_colors)
+
+        print("load layers from", filename)
 
     # Метод снятия выделения со всех блоков
     def deselectAllBlocks(self):
-        for block in self.blocks:
-            block.setSelected(False)
-
-    # Метод выбора блока по заданному ключу блока
-    def selectBlock(self, key):
-        # сбрасываем текущий выделенный блок
+        # выделенным может быть только один блок - прячем рамку
         self.selected_block = None
+        self.selection.hide()
 
-        for block in self.blocks:
-            # если ключ совпал
-            if block.getKey() == key:
-                # устанавливаем новый выделенный блок
-                self.selected_block = block
-                # устанавливаем в нём флаг и цвет выделения
-                block.setSelected(True, self.selected_color)
-            else:
-                # сбрасываем выделение на этом блоке
-                block.setSelected(False)
-
-        # если выделенный блок найден
+    # Метод выбора блока по заданному ключу блока.
+    # Возвращает выделенный блок (None, если блока нет); при отрисовке
+    # чанками у блока нет своего узла, поэтому возвращается сам блок
+    def selectBlock(self, key):
+        # ищем блок по ключу в индексе
+        self.selected_block = self.getBlockByKey(key)
+        # если блок найден - переносим на него рамку выделения
         if self.selected_block:
-            # возвращаем его узел
-            return self.selected_block.getNode()
+            self.selection.show(self.selected_block.position)
         else:
-            return None
+            self.selection.hide()
+
+        return self.selected_block
 
     # Метод удаления выделенного блока
+    @profiled
     def deleteSelectedBlock(self):
         # если есть выделенный блок
         if self.selected_block:
+            block = self.selected_block
             # сбрасываем текущий выделенный блок
-            self.selected_block = None
-
-            # ищем выделенный узел в списке
-            for i in range(len(self.blocks)):
-                if self.blocks[i].getSelected():
-                    # удаляем его из Panda3D
-                    self.blocks[i].remove()
-                    # удаляем его из памяти
-                    del self.blocks[i]
-                    # прерываем цикл
-                    break
+            self.deselectAllBlocks()
+
+            # удаляем его узел из Panda3D (если есть)
+            voxel = block.position
+            node_block = self.node_blocks.pop(voxel, None)
+            if node_block is not None:
+                node_block.remove()
+            # удаляем его из хранилища
+            old = self.store.set(voxel, 0)
+            self.occupancy.setVoxel(voxel, False)
+            self.touch()
+            # помечаем чанк блока для перестройки
+            if self.renderer:
+                self.renderer.blockRemoved(voxel)
+            # записываем изменение в журнал
+            self.recordEdits([voxel], [old], [0])
 
     # Метод очистки карты - удаления всех блоков
+    @profiled
     def clearAll(self):
+        # останавливаем потоковую загрузку мира
+        # (изменённые чанки записываются в файлы регионов)
+        if self.streamer:
+            self.streamer.stop()
+            self.streamer = None
+
         # сбрасываем текущий выделенный блок
-        self.selected_block = None
+        self.deselectAllBlocks()
+        # карта больше не совпадает с файлом - отвязываем журнал правок
+        self.closeEditLog()
+
+        # записываем удаление всех блоков в журнал
+        if len(self.store) and not self.history.paused:
+            self.history.record(*self.store.getBlocks(), 0)
 
-        # удаляем блоки из Panda3D
-        for block in self.blocks:
+        # удаляем узлы блоков из Panda3D
+        for block in self.node_blocks.values():
             block.remove()
+        self.node_blocks.clear()
 
         # удаляем блоки из памяти
-        self.blocks.clear()
+        self.store.clear()
+        self.occupancy.clear()
+        self.touch()
+        if self.renderer:
+            self.renderer.clear()
+        for node in self.chunk_nodes.values():
+            node.removeNode()
+        self.chunk_nodes.clear()
 
     # Метод сохранения карты в файл
     # filename - имя файла
+    # Если карта уже связана с этим файлом, дописываются только правки
+    @profiled
     def saveMap(self, filename):
-        # если нет блоков
-        if not self.blocks:
+        # карта связана с файлом - записываем накопленные правки
+        if self.edit_log and self.edit_log.filename == filename:
+            self.edit_log.flush(wait=True)
+            print("save edits to", editlog.logPath(filename))
             return
 
-        # открываем бинарный файл на запись
-        fout = open(filename, 'wb')
-
-        # сохраняем в начало файла количество блоков
-        pickle.dump(len(self.blocks), fout)
+        # если нет блоков
+        if not len(self.store):
+            return
 
-        # обходим все блоки
-        for block in self.blocks:
-            # сохраняем позицию
-            pickle.dump(block.getPos(), fout)
-            # сохраняем цвет
-            pickle.dump(block.getColor(), fout)
+        # координаты и номера палитры блоков по чанкам хранилища
+        positions, indices = self.store.getBlocks()
 
-        # закрываем файл
-        fout.close()
+        # записываем их одним блоком в бинарный файл вместе с палитрой
+        self.closeEditLog()
+        mapformat.saveIndexedMapFile(filename, positions, indices,
+                                     *self.palette.getTables())
+        # старые журналы правок относятся к прежнему снимку
+        for path in (editlog.compactingLogPath(filename),
+                     editlog.logPath(filename)):
+            if os.path.exists(path):
+                os.remove(path)
+        # дальнейшие изменения дописываются в журнал
+        self.openEditLog(filename)
 
         print("save map to", filename)
 
     # Метод загрузки карты из файла
     # filename - имя файла
+    @profiled
     def loadMap(self, filename):
-        # удаляем все блоки
-        self.clearAll()
+        # удаляем все блоки (замена карты отменяется одной записью)
+        with self.batch():
+            self.clearAll()
 
-        # открываем бинарный файл на чтение
-        fin = open(filename, 'rb')
+            # считываем массивы координат, цветов и материалов
+            # (файлы старого формата pickle импортируются)
+            # и применяем к ним журнал правок
+            positions, colors, materials = editlog.loadMapWithLog(filename)
 
-        # считываем количество блоков
-        lenght = pickle.load(fin)
+            # и добавляем все блоки одним пакетом
+            self.addBlocks(positions, colors, materials)
 
-        for i in range(lenght):
-            # считываем позицию
-            pos = pickle.load(fin)
-            # считываем цвет
-            color = pickle.load(fin)
+        # дальнейшие изменения дописываются в журнал
+        self.openEditLog(filename)
 
-            # создаём новый блок
-            self.addBlock(pos, color)
+        print("load map from", filename)
 
-        # закрываем файл
-        fin.close()
+    # Метод сохранения мира в папку с файлами регионов
+    # dirname - имя папки
+    @profiled
+    def saveWorld(self, dirname):
+        # при потоковой загрузке записываем только изменённые чанки
+        if self.streamer:
+            self.streamer.save()
+        else:
+            positions, indices = self.store.getBlocks()
+            worldstream.saveWorld(dirname, positions,
+                                  self.palette.getColors(indices),
+                                  self.palette.getMaterials(indices))
 
-        print("load map from", filename)
+        print("save world to", dirname)
+
+    # Метод потоковой загрузки мира из папки с файлами регионов. Аргументы:
+    #  dirname - имя папки
+    #  camera - узел, вокруг которого загружаются чанки
+    @profiled
+    def streamWorld(self, dirname, camera):
+        # удаляем все блоки
+        self.clearAll()
+        # изменения прежней карты к потоковому миру не относятся
+        self.history.clear()
+
+        self.streamer = worldstream.WorldStreamer(self, dirname, camera)
+
+        print("stream world from", dirname)
 
 
 if __name__ == '__main__':
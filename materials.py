@@ -0,0 +1,183 @@
+import json
+import os
+from panda3d.core import PNMImage, Texture, SamplerState, Shader, Filename
+
+# материалы блоков: (имя, файл текстуры). Номер материала - индекс
+# в списке; номера хранятся в файлах карт, поэтому новые материалы
+# добавляются только в конец списка
+MATERIALS = (('block', 'block.png'),
+             ('bricks', 'tex_bricks.png'),
+             ('metal', 'tex_metal.png'),
+             ('rocks', 'tex_rocks.png'),
+             ('wood', 'tex_wood.png'))
+
+# размер клетки атласа в пикселях (текстуры материалов приводятся к нему)
+TILE_SIZE = 128
+# папка кэша собранного атласа
+ATLAS_CACHE_DIR = 'cache'
+ATLAS_IMAGE = 'materials_atlas.png'
+ATLAS_INFO = 'materials_atlas.json'
+
+# шейдер чанков: текстурные координаты вершины повторяются на каждом
+# блоке грани (fract), а клетка атласа выбирается по номеру материала.
+# Отступ в полтекселя от краёв клетки не даёт соседним клеткам
+# просвечивать на стыках блоков
+VERTEX_SHADER = '''#version 120
+uniform mat4 p3d_ModelViewProjectionMatrix;
+attribute vec4 p3d_Vertex;
+attribute vec4 p3d_Color;
+attribute vec2 p3d_MultiTexCoord0;
+attribute float material;
+varying vec4 v_color;
+varying vec2 v_texcoord;
+varying float v_material;
+
+void main() {
+    gl_Position = p3d_ModelViewProjectionMatrix * p3d_Vertex;
+    v_color = p3d_Color;
+    v_texcoord = p3d_MultiTexCoord0;
+    v_material = material;
+}
+'''
+
+FRAGMENT_SHADER = '''#version 120
+uniform sampler2D p3d_Texture0;
+uniform vec4 p3d_ColorScale;
+uniform vec2 atlas_grid;
+uniform float atlas_inset;
+varying vec4 v_color;
+varying vec2 v_texcoord;
+varying float v_material;
+
+void main() {
+    float index = floor(v_material + 0.5);
+    vec2 tile = vec2(mod(index, atlas_grid.x), floor(index / atlas_grid.x));
+    vec2 local = atlas_inset + fract(v_texcoord) * (1.0 - 2.0 * atlas_inset);
+    vec4 texel = texture2D(p3d_Texture0, (tile + local) / atlas_grid);
+    gl_FragColor = texel * v_color * p3d_ColorScale;
+}
+'''
+
+
+# Функция получения номера материала по имени
+def getMaterialId(name):
+    for material, (material_name, filename) in enumerate(MATERIALS):
+        if material_name == name:
+            return material
+    raise KeyError('unknown material %r' % name)
+
+
+# Функция получения имени материала по номеру
+def getMaterialName(material):
+    return MATERIALS[material][0]
+
+
+# Функция загрузки отдельной текстуры материала
+# (для блоков с собственными узлами)
+def loadMaterialTexture(material):
+    return loader.loadTexture(MATERIALS[material][1])
+
+
+# Функция получения размеров сетки атласа для count клеток
+# (степени двойки, чтобы Panda3D не масштабировал текстуру)
+def getAtlasGrid(count):
+    cols = 1
+    while cols * cols < count:
+        cols *= 2
+    rows = 1
+    while rows * cols < count:
+        rows *= 2
+    return cols, rows
+
+
+# Класс атласа материалов: текстуры всех материалов в одной текстуре,
+# чтобы чанк с любыми материалами рисовался одним вызовом отрисовки.
+# Собранный атлас кэшируется на диск и пересобирается только
+# при изменении файлов текстур
+class MaterialAtlas():
+    # Конструктор. Аргументы:
+    #  cache_dir - папка кэша атласа (None - без кэша)
+    #  tile_size - размер клетки атласа в пикселях
+    def __init__(self, cache_dir=ATLAS_CACHE_DIR, tile_size=TILE_SIZE):
+        self.tile_size = tile_size
+        self.grid = getAtlasGrid(len(MATERIALS))
+        self.cache_dir = cache_dir
+
+        image = self.loadCache()
+        if image is None:
+            image = self.build()
+            self.saveCache(image)
+
+        self.texture = Texture('materials_atlas')
+        self.texture.load(image)
+        self.texture.setWrapU(SamplerState.WM_clamp)
+        self.texture.setWrapV(SamplerState.WM_clamp)
+        self.shader = Shader.make(Shader.SL_GLSL, VERTEX_SHADER,
+                                  FRAGMENT_SHADER)
+
+    # Метод получения описания исходных файлов (для проверки кэша)
+    def getSources(self):
+        sources = []
+        for name, filename in MATERIALS:
+            stat = os.stat(filename)
+            sources.append([filename, stat.st_mtime_ns, stat.st_size])
+        return {'tile_size': self.tile_size, 'grid': list(self.grid),
+                'sources': sources}
+
+    # Метод сборки атласа из текстур материалов
+    def build(self):
+        cols, rows = self.grid
+        size = self.tile_size
+        image = PNMImage(cols * size, rows * size, 4)
+        image.fill(1, 1, 1)
+        image.alphaFill(1)
+        for material, (name, filename) in enumerate(MATERIALS):
+            source = PNMImage(Filename(filename))
+            tile = PNMImage(size, size, 4)
+            tile.alphaFill(1)
+            tile.quickFilterFrom(source)
+            # клетка (col, row) отсчитывается снизу, как координата V
+            col = material % cols
+            row = material // cols
+            image.copySubImage(tile, col * size, (rows - 1 - row) * size)
+        return image
+
+    # Метод загрузки атласа из кэша (None - кэша нет или он устарел)
+    def loadCache(self):
+        if self.cache_dir is None:
+            return None
+        info_path = os.path.join(self.cache_dir, ATLAS_INFO)
+        image_path = os.path.join(self.cache_dir, ATLAS_IMAGE)
+        try:
+            with open(info_path) as fin:
+                info = json.load(fin)
+            if info != self.getSources():
+                return None
+            image = PNMImage()
+            if not image.read(Filename.fromOsSpecific(image_path)):
+                return None
+            return image
+        except (OSError, ValueError):
+            return None
+
+    # Метод записи атласа в кэш
+    def saveCache(self, image):
+        if self.cache_dir is None:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            image.write(Filename.fromOsSpecific(
+                os.path.join(self.cache_dir, ATLAS_IMAGE)))
+            with open(os.path.join(self.cache_dir, ATLAS_INFO), 'w') as fout:
+                json.dump(self.getSources(), fout)
+        except OSError:
+            # без кэша атлас просто собирается при каждом запуске
+            pass
+
+    # Метод установки атласа и шейдера на узел node
+    # (у вершин геометрии должна быть колонка материала)
+    def apply(self, node):
+        node.setTexture(self.texture)
+        node.setShader(self.shader)
+        node.setShaderInput('atlas_grid', self.grid)
+        node.setShaderInput('atlas_inset', 0.5 / self.tile_size)
@@ -0,0 +1,165 @@
+import numpy as np
+
+# наибольшее количество элементов палитры (вместе с пустым):
+# номер элемента помещается в uint16
+MAX_ENTRIES = 1 << 16
+# количество уровней каждого канала случайных цветов
+# (всего RANDOM_LEVELS ** 3 различных случайных цветов)
+RANDOM_LEVELS = 6
+# цвета первых элементов палитры мира (выбираются цифровыми клавишами)
+DEFAULT_COLORS = [(1, 0.5, 1, 1),
+                  (0, 0.5, 1, 1),
+                  (1, 1, 1, 1),
+                  (0.5, 0.5, 0.5, 1),
+                  (0.5, 0.5, 0, 1),
+                  (1, 0.5, 0.5, 1),
+                  (0.1, 0.5, 0.7, 1),
+                  (0, 0, 1, 1)]
+
+
+# Функция квантования массива цветов (n, 4) (RGBA от 0 до 1)
+# до байта на канал. Возвращает массив (n, 4) uint8
+def quantizeColors(colors):
+    colors = np.asarray(colors, dtype=np.float64).reshape(-1, 4)
+    return np.clip(np.rint(colors * 255), 0, 255).astype(np.uint8)
+
+
+# Функция получения массива (count, 4) случайных светлых цветов
+# (квантованных до RANDOM_LEVELS уровней на канал)
+def randomColors(count):
+    colors = np.ones((count, 4), dtype=np.float64)
+    levels = np.random.randint(0, RANDOM_LEVELS, (count, 3))
+    colors[:, :3] = 0.7 + 0.3 * levels / (RANDOM_LEVELS - 1)
+    return colors
+
+
+# Класс палитры блоков: каждой паре (цвет, материал) соответствует номер.
+# Номер 0 зарезервирован за пустым вокселем (блока нет).
+# Цвета квантуются до байта на канал; когда палитра заполнена,
+# новый цвет заменяется ближайшим цветом палитры с тем же материалом
+class Palette():
+    # Конструктор. Аргументы:
+    #  max_entries - наибольшее количество элементов (вместе с пустым)
+    #  colors - начальные цвета (материал 0)
+    def __init__(self, max_entries=MAX_ENTRIES, colors=()):
+        self.max_entries = max_entries
+        # списки цветов (кортежи float) и материалов, индекс - номер
+        self.colors = [None]
+        self.materials = [0]
+        # цвета элементов байтами (для поиска ближайшего и сохранения)
+        self.rgba = [(0, 0, 0, 0)]
+        # словарь: (цвет байтами, материал) - номер
+        self.indices = dict()
+        # массивы цветов и материалов для getColors и getMaterials
+        # (None - перестраиваются при следующем обращении)
+        self.table = None
+        self.material_table = None
+        for color in colors:
+            self.indexOf(color)
+
+    # Метод получения номера пары (цвет, материал)
+    # (новая пара добавляется в палитру)
+    def indexOf(self, color, material=0):
+        if color is None:
+            return 0
+        rgba = tuple(quantizeColors(color)[0].tolist())
+        return self.indexOfBytes(rgba, int(material))
+
+    # Метод получения номера пары (цвет rgba - кортеж байтов, материал)
+    def indexOfBytes(self, rgba, material):
+        entry = (rgba, material)
+        index = self.indices.get(entry)
+        if index is not None:
+            return index
+        if len(self.colors) >= self.max_entries:
+            return self.nearest(rgba, material)
+        index = len(self.colors)
+        self.colors.append(tuple(channel / 255 for channel in rgba))
+        self.materials.append(material)
+        self.rgba.append(rgba)
+        self.indices[entry] = index
+        self.table = self.material_table = None
+        return index
+
+    # Метод поиска номера ближайшего к rgba цвета с материалом material
+    # (если такого материала в палитре нет - ближайшего любого)
+    def nearest(self, rgba, material):
+        table = np.array(self.rgba[1:], dtype=np.int32)
+        distance = ((table - rgba) ** 2).sum(axis=1)
+        other = np.array(self.materials[1:]) != material
+        if not other.all():
+            distance[other] = np.iinfo(np.int32).max
+        return int(np.argmin(distance)) + 1
+
+    # Метод получения номеров для массива цветов (n, 4)
+    # и массива материалов (n,) (None - все 0).
+    # Возвращает массив uint32
+    def indicesOf(self, colors, materials=None):
+        colors = np.asarray(colors, dtype=np.float64).reshape(-1, 4)
+        if not len(colors):
+            return np.empty(0, dtype=np.uint32)
+        entries = np.zeros((len(colors), 5), dtype=np.uint8)
+        entries[:, :4] = quantizeColors(colors)
+        if materials is not None:
+            entries[:, 4] = materials
+        # каждую различную пару ищем в палитре один раз
+        # (строки сравниваются как байты - это быстрее unique по оси)
+        rows = entries.view(np.dtype((np.void, 5))).reshape(-1)
+        _, first, inverse = np.unique(rows, return_index=True,
+                                      return_inverse=True)
+        table = np.array([self.indexOfBytes(tuple(entry[:4]), entry[4])
+                          for entry in entries[first].tolist()],
+                         dtype=np.uint32)
+        return table[inverse.reshape(-1)]
+
+    # Метод изменения цвета элемента index на color (материал прежний).
+    # Все блоки с этим номером меняют цвет
+    def setEntryColor(self, index, color):
+        if not 0 < index < len(self.colors):
+            raise ValueError('no palette entry %r' % index)
+        rgba = tuple(quantizeColors(color)[0].tolist())
+        material = self.materials[index]
+        old = (self.rgba[index], material)
+        if self.indices.get(old) == index:
+            del self.indices[old]
+        # если такая пара уже есть, новые блоки получают прежний номер
+        self.indices.setdefault((rgba, material), index)
+        self.colors[index] = tuple(channel / 255 for channel in rgba)
+        self.rgba[index] = rgba
+        self.table = None
+
+    # Метод получения цвета по номеру (None для пустого вокселя)
+    def getColor(self, index):
+        return self.colors[index]
+
+    # Метод получения материала по номеру
+    def getMaterial(self, index):
+        return self.materials[index]
+
+    # Метод получения массива цветов (n, 4) по массиву номеров
+    # (для номера 0 - прозрачный чёрный)
+    def getColors(self, indices):
+        if self.table is None:
+            self.table = np.array([(0, 0, 0, 0)] + self.colors[1:],
+                                  dtype=np.float64)
+        return self.table[np.asarray(indices, dtype=np.intp)]
+
+    # Метод получения массива материалов (n,) uint8 по массиву номеров
+    def getMaterials(self, indices):
+        if self.material_table is None:
+            self.material_table = np.array(self.materials, dtype=np.uint8)
+        return self.material_table[np.asarray(indices, dtype=np.intp)]
+
+    # Метод получения таблиц палитры: цвета (k, 4) uint8
+    # и материалы (k,) uint8, строка - номер элемента
+    def getTables(self):
+        return (np.array(self.rgba, dtype=np.uint8),
+                np.array(self.materials, dtype=np.uint8))
+
+    # Метод получения количества цветов (вместе с пустым)
+    def __len__(self):
+        return len(self.colors)
+
+
+# общая палитра мира (номера блоков карты - номера её элементов)
+palette = Palette(colors=DEFAULT_COLORS)
@@ -0,0 +1,139 @@
+from math import floor, ceil
+
+# зазор между телом и поверхностью блока
+SKIN = 0.001
+
+
+# Функция получения номера вокселя, в который попадает координата
+# (блок с координатой v занимает отрезок от v-0.5 до v+0.5)
+def cellStart(coord):
+    return floor(coord + 0.5)
+
+
+# Функция получения номера последнего вокселя, который задевает отрезок,
+# заканчивающийся в coord (касание границы не считается)
+def cellEnd(coord):
+    return ceil(coord + 0.5) - 1
+
+
+# Класс тела игрока - прямоугольного параллелепипеда (AABB),
+# сталкивающегося только с занятыми вокселями вокруг себя
+class VoxelBody():
+    # Конструктор. Аргументы:
+    #  isSolid - функция проверки вокселя (x, y, z) на занятость
+    #  half_width - половина ширины тела по X и Y
+    #  eye_height - высота глаз (камеры) над ногами
+    #  head_height - высота макушки над глазами
+    #  step_height - высота уступа, на который тело шагает само
+    def __init__(self, isSolid, half_width=0.3, eye_height=1.5,
+                 head_height=0.2, step_height=0.0):
+        self.isSolid = isSolid
+        self.half_width = half_width
+        self.eye_height = eye_height
+        self.head_height = head_height
+        self.step_height = step_height
+
+    # Метод получения углов тела (min, max) для позиции глаз position
+    def getBox(self, position):
+        x, y, z = position
+        return ([x - self.half_width, y - self.half_width,
+                 z - self.eye_height],
+                [x + self.half_width, y + self.half_width,
+                 z + self.head_height])
+
+    # Метод проверки, есть ли занятые воксели в слое axis = layer
+    # в пределах сечения тела
+    def isLayerSolid(self, low, high, axis, layer):
+        ranges = []
+        for other in range(3):
+            if other == axis:
+                ranges.append((layer, layer))
+            else:
+                ranges.append((cellStart(low[other]), cellEnd(high[other])))
+        for x in range(ranges[0][0], ranges[0][1] + 1):
+            for y in range(ranges[1][0], ranges[1][1] + 1):
+                for z in range(ranges[2][0], ranges[2][1] + 1):
+                    if self.isSolid((x, y, z)):
+                        return True
+        return False
+
+    # Метод перемещения тела вдоль одной оси с проверкой столкновений.
+    # Проверяются только слои вокселей, которые тело пересекает.
+    # Возвращает (новая позиция, было ли столкновение)
+    def moveAxis(self, position, axis, delta):
+        position = list(position)
+        if delta == 0:
+            return position, False
+        low, high = self.getBox(position)
+        if delta > 0:
+            for layer in range(cellEnd(high[axis]) + 1,
+                               cellEnd(high[axis] + delta) + 1):
+                if self.isLayerSolid(low, high, axis, layer):
+                    # упираемся в нижнюю границу слоя
+                    position[axis] += max(0.0, layer - 0.5 - SKIN - high[axis])
+                    return position, True
+        else:
+            for layer in range(cellStart(low[axis]) - 1,
+                               cellStart(low[axis] + delta) - 1, -1):
+                if self.isLayerSolid(low, high, axis, layer):
+                    # упираемся в верхнюю границу слоя
+                    position[axis] -= max(0.0, low[axis] - (layer + 0.5 + SKIN))
+                    return position, True
+        position[axis] += delta
+        return position, False
+
+    # Метод горизонтального перемещения (по X, затем по Y) с подъёмом
+    # на уступ не выше step_height. Возвращает новую позицию
+    def moveHorizontal(self, position, dx, dy, on_ground):
+        moved, blocked_x = self.moveAxis(position, 0, dx)
+        moved, blocked_y = self.moveAxis(moved, 1, dy)
+        if (blocked_x or blocked_y) and on_ground and self.step_height > 0:
+            # пробуем то же движение, поднявшись на уступ
+            raised, blocked = self.moveAxis(position, 2, self.step_height)
+            if not blocked:
+                stepped, _ = self.moveAxis(raised, 0, dx)
+                stepped, _ = self.moveAxis(stepped, 1, dy)
+                stepped, _ = self.moveAxis(stepped, 2, -self.step_height)
+                # шаг на уступ принимаем, если он продвинул тело дальше
+                if ((stepped[0] - position[0]) ** 2 +
+                        (stepped[1] - position[1]) ** 2 >
+                        (moved[0] - position[0]) ** 2 +
+                        (moved[1] - position[1]) ** 2):
+                    return stepped
+        return moved
+
+    # Метод проверки, стоит ли тело на блоке
+    def isOnGround(self, position):
+        low, high = self.getBox(position)
+        layer = cellStart(low[2] - 2 * SKIN)
+        if layer == cellStart(low[2]):
+            return False
+        return self.isLayerSolid(low, high, 2, layer)
+
+
+# Класс фиксированного шага моделирования: копит прошедшее время
+# и выдаёт, сколько шагов длиной step нужно сделать
+class FixedTimestep():
+    # Конструктор. Аргументы:
+    #  step - длина шага моделирования, секунд
+    #  max_steps - наибольшее число шагов за один вызов
+    #              (чтобы не отставать бесконечно при долгом кадре)
+    def __init__(self, step=0.02, max_steps=5):
+        self.step = step
+        self.max_steps = max_steps
+        self.accumulator = 0.0
+
+    # Метод добавления прошедшего времени dt.
+    # Возвращает число шагов моделирования
+    def advance(self, dt):
+        self.accumulator += dt
+        steps = int(self.accumulator / self.step)
+        self.accumulator -= steps * self.step
+        if steps > self.max_steps:
+            steps = self.max_steps
+            self.accumulator = 0.0
+        return steps
+
+    # Метод сброса накопленного времени
+    def reset(self):
+        self.accumulator = 0.0
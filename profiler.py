@@ -0,0 +1,258 @@
+import csv
+import json
+import threading
+import time
+from collections import deque
+from functools import wraps
+import numpy as np
+from panda3d.core import PStatClient, PStatCollector, TextNode
+
+# количество последних замеров участка для скользящей статистики
+WINDOW = 300
+# перцентили в статистике и в отчётах
+PERCENTILES = (50, 90, 99)
+# период обновления панели профилировщика, секунд
+OVERLAY_PERIOD = 0.5
+
+
+# Класс участка кода с замером времени (для блока with).
+# При выключенном профилировщике вход и выход ничего не замеряют
+class Scope():
+    __slots__ = ('profiler', 'name', 'start')
+
+    # Конструктор. Аргументы:
+    #  profiler - профилировщик, в который пишутся замеры
+    #  name - имя участка
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        if self.profiler.enabled:
+            self.profiler.begin(self.name)
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start is not None:
+            self.profiler.end(self.name, time.perf_counter() - self.start)
+            self.start = None
+        return False
+
+
+# Класс профилировщика: именованные участки кода, скользящие
+# перцентили времени по последним замерам и выгрузка в CSV/JSON.
+# Выключенный профилировщик стоит одной проверки флага на вызов.
+# Если к игре подключён клиент PStats, участки видны и в нём
+class Profiler():
+    # Конструктор. Аргументы:
+    #  window - количество последних замеров участка для статистики
+    def __init__(self, window=WINDOW):
+        self.enabled = False
+        self.window = window
+        # словарь: имя участка - последние замеры (секунд)
+        self.samples = dict()
+        # словарь: имя участка - [число вызовов, суммарное время]
+        self.totals = dict()
+        # словарь: имя участка - сборщик PStats
+        self.collectors = dict()
+        # передавать ли замеры в PStats
+        self.pstats = False
+        # время конца предыдущего кадра (для участка 'frame')
+        self.last_frame = None
+        # замеры пишут и фоновые потоки (сборка мешей, журнал правок)
+        self.lock = threading.Lock()
+
+    # Метод включения/выключения замеров
+    def setEnabled(self, enabled):
+        if self.enabled == enabled:
+            return
+        self.enabled = enabled
+        self.pstats = enabled and PStatClient.isConnected()
+        self.last_frame = None
+        # время кадра замеряет задача в конце каждого кадра
+        if enabled:
+            taskMgr.add(self.frameTask, 'profiler-frame-task', sort=1000)
+        else:
+            taskMgr.remove('profiler-frame-task')
+
+    # Задача замера времени кадра
+    def frameTask(self, task):
+        now = time.perf_counter()
+        if self.last_frame is not None:
+            self.record('frame', now - self.last_frame)
+        self.last_frame = now
+        return task.cont
+
+    # Метод получения участка кода name для блока with
+    def scope(self, name):
+        return Scope(self, name)
+
+    # Метод проверки, передавать ли замер в PStats
+    # (сборщики PStats ведутся только для главного потока)
+    def usePStats(self):
+        return (self.pstats and
+                threading.current_thread() is threading.main_thread())
+
+    # Метод начала участка name (только для PStats)
+    def begin(self, name):
+        if self.usePStats():
+            self.getCollector(name).start()
+
+    # Метод окончания участка name длительностью seconds
+    def end(self, name, seconds):
+        if self.usePStats():
+            self.getCollector(name).stop()
+        self.record(name, seconds)
+
+    # Метод получения сборщика PStats для участка name
+    def getCollector(self, name):
+        collector = self.collectors.get(name)
+        if collector is None:
+            collector = PStatCollector('Game:' + name)
+            self.collectors[name] = collector
+        return collector
+
+    # Метод записи замера seconds участка name
+    def record(self, name, seconds):
+        with self.lock:
+            samples = self.samples.get(name)
+            if samples is None:
+                samples = self.samples[name] = deque(maxlen=self.window)
+                self.totals[name] = [0, 0.0]
+            samples.append(seconds)
+            total = self.totals[name]
+            total[0] += 1
+            total[1] += seconds
+
+    # Метод вызова func с замером времени участка name
+    def call(self, name, func, args, kwargs):
+        self.begin(name)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.end(name, time.perf_counter() - start)
+
+    # Метод сброса всех замеров
+    def clear(self):
+        with self.lock:
+            self.samples.clear()
+            self.totals.clear()
+        self.last_frame = None
+
+    # Метод получения статистики участков (времена в секундах).
+    # Возвращает словарь: имя участка - словарь показателей
+    # (count и total - за всё время, остальные - по последним замерам)
+    def getStats(self):
+        # копия замеров, чтобы не держать блокировку во время расчёта
+        with self.lock:
+            scopes = [(name, list(samples), tuple(self.totals[name]))
+                      for name, samples in self.samples.items()]
+        stats = dict()
+        for name, samples, (count, total) in scopes:
+            values = np.array(samples, dtype=np.float64)
+            item = {'count': count, 'total': total,
+                    'mean': float(values.mean()),
+                    'max': float(values.max())}
+            for percentile, value in zip(
+                    PERCENTILES, np.percentile(values, PERCENTILES)):
+                item['p%d' % percentile] = float(value)
+            stats[name] = item
+        return stats
+
+    # Метод получения названий колонок отчёта
+    def getColumns(self):
+        return (['count', 'total', 'mean'] +
+                ['p%d' % percentile for percentile in PERCENTILES] +
+                ['max'])
+
+    # Метод выгрузки статистики в файл JSON
+    def exportJSON(self, filename):
+        with open(filename, 'w') as fout:
+            json.dump({'window': self.window, 'scopes': self.getStats()},
+                      fout, indent=2, sort_keys=True)
+
+    # Метод выгрузки статистики в файл CSV (времена в секундах)
+    def exportCSV(self, filename):
+        columns = self.getColumns()
+        with open(filename, 'w', newline='') as fout:
+            writer = csv.writer(fout)
+            writer.writerow(['scope'] + columns)
+            for name, item in sorted(self.getStats().items()):
+                writer.writerow([name] + [item[column]
+                                          for column in columns])
+
+    # Метод получения текста отчёта (времена в миллисекундах),
+    # самые долгие по p90 участки - сверху
+    def formatStats(self):
+        columns = ['mean'] + ['p%d' % percentile
+                              for percentile in PERCENTILES] + ['max']
+        lines = ['%-32s %7s' % ('scope', 'count') +
+                 ''.join('%8s' % column for column in columns)]
+        stats = self.getStats()
+        for name in sorted(stats, key=lambda name: -stats[name]['p90']):
+            item = stats[name]
+            lines.append('%-32s %7d' % (name[-32:], item['count']) +
+                         ''.join('%8.3f' % (item[column] * 1000)
+                                 for column in columns))
+        return '\n'.join(lines)
+
+
+# общий профилировщик игры
+profiler = Profiler()
+
+
+# Декоратор замера времени функции или метода
+# (имя участка - полное имя функции, например 'MapManager.addBlock')
+def profiled(func):
+    name = func.__qualname__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not profiler.enabled:
+            return func(*args, **kwargs)
+        return profiler.call(name, func, args, kwargs)
+    return wrapper
+
+
+# Класс панели профилировщика на экране: таблица участков
+# с перцентилями, обновляемая раз в OVERLAY_PERIOD секунд
+class ProfilerOverlay():
+    # Конструктор. Аргументы:
+    #  profiler - профилировщик, статистика которого показывается
+    def __init__(self, profiler=profiler):
+        self.profiler = profiler
+        self.text = TextNode('profiler')
+        # моноширинный шрифт, чтобы колонки не разъезжались
+        self.text.setFont(loader.loadFont('cmtt12'))
+        self.text.setTextColor(1, 1, 1, 1)
+        self.text.setCardColor(0, 0, 0, 0.6)
+        self.text.setCardAsMargin(0.5, 0.5, 0.3, 0.3)
+        self.node = base.a2dTopLeft.attachNewNode(self.text)
+        self.node.setScale(0.04)
+        self.node.setPos(0.05, 0, -0.1)
+        self.node.hide()
+
+    # Метод показа/скрытия панели (вместе с ней включаются замеры)
+    def toggle(self):
+        if self.node.isHidden():
+            self.profiler.setEnabled(True)
+            self.node.show()
+            self.update()
+            taskMgr.doMethodLater(OVERLAY_PERIOD, self.updateTask,
+                                  'profiler-overlay-task')
+        else:
+            taskMgr.remove('profiler-overlay-task')
+            self.node.hide()
+            self.profiler.setEnabled(False)
+
+    # Задача обновления панели
+    def updateTask(self, task):
+        self.update()
+        return task.again
+
+    # Метод обновления текста панели
+    def update(self):
+        self.text.setText(self.profiler.formatStats())
@@ -0,0 +1,50 @@
+from math import floor, inf
+
+
+# Функция поиска первого занятого вокселя на луче
+# (обход сетки по алгоритму Amanatides-Woo). Аргументы:
+#  origin - начало луча (x, y, z)
+#  direction - направление луча (x, y, z), длина не важна
+#  isSolid - функция проверки вокселя (x, y, z) на занятость
+#  max_distance - наибольшая длина луча (в длинах direction)
+# Блок с координатами (x, y, z) занимает куб от x-0.5 до x+0.5 и т. д.
+# Возвращает (воксель, нормаль грани, через которую вошёл луч,
+# расстояние до грани) или None. Воксель, в котором начинается луч,
+# не проверяется. Стоимость пропорциональна длине луча.
+def voxelRaycast(origin, direction, isSolid, max_distance):
+    voxel = [0, 0, 0]
+    step = [0, 0, 0]
+    t_max = [inf, inf, inf]
+    t_delta = [inf, inf, inf]
+    for axis in range(3):
+        # сдвигаем на полблока, чтобы границы вокселей были целыми
+        start = origin[axis] + 0.5
+        voxel[axis] = floor(start)
+        if direction[axis] > 0:
+            step[axis] = 1
+            t_max[axis] = (voxel[axis] + 1 - start) / direction[axis]
+            t_delta[axis] = 1 / direction[axis]
+        elif direction[axis] < 0:
+            step[axis] = -1
+            t_max[axis] = (voxel[axis] - start) / direction[axis]
+            t_delta[axis] = -1 / direction[axis]
+
+    if step == [0, 0, 0]:
+        return None
+
+    while True:
+        # переходим через ближайшую границу вокселя
+        if t_max[0] < t_max[1]:
+            axis = 0 if t_max[0] < t_max[2] else 2
+        else:
+            axis = 1 if t_max[1] < t_max[2] else 2
+        distance = t_max[axis]
+        if distance > max_distance:
+            return None
+        voxel[axis] += step[axis]
+        t_max[axis] += t_delta[axis]
+
+        if isSolid((voxel[0], voxel[1], voxel[2])):
+            normal = [0, 0, 0]
+            normal[axis] = -step[axis]
+            return (voxel[0], voxel[1], voxel[2]), tuple(normal), distance
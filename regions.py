@@ -0,0 +1,133 @@
+import numpy as np
+
+# наибольшее количество вокселей области одного инструмента
+# (защита от случайной заливки огромной области)
+MAX_REGION_CELLS = 1 << 24
+
+
+# Функция получения целочисленных углов параллелепипеда по двум
+# произвольным углам low и high (округляются до вокселей).
+# Возвращает (меньший угол, больший угол) - массивы int64
+def boxCorners(low, high):
+    low = np.rint(np.asarray(low, dtype=np.float64)).astype(np.int64)
+    high = np.rint(np.asarray(high, dtype=np.float64)).astype(np.int64)
+    return np.minimum(low, high), np.maximum(low, high)
+
+
+# Функция проверки размера области shape (размеры по осям)
+def checkShape(shape):
+    if np.prod(np.asarray(shape, dtype=np.float64)) > MAX_REGION_CELLS:
+        raise ValueError('region is too large (more than %d voxels)' %
+                         MAX_REGION_CELLS)
+
+
+# Функция получения оболочки фигуры: вокселей маски inside
+# (трёхмерный массив bool), у которых хотя бы один сосед по грани
+# лежит вне фигуры. Возвращает маску той же формы
+def shellOf(inside):
+    padded = np.pad(inside, 1)
+    core = inside.copy()
+    for axis in range(3):
+        for shift in (-1, 1):
+            core &= np.roll(padded, shift, axis=axis)[1:-1, 1:-1, 1:-1]
+    return inside & ~core
+
+
+# Функция получения вокселей параллелепипеда с углами low и high
+# (включительно). hollow - только оболочка (стенки толщиной в блок).
+# Возвращает массив (n, 3) int32
+def boxCells(low, high, hollow=False):
+    low, high = boxCorners(low, high)
+    shape = high - low + 1
+    checkShape(shape)
+    inside = np.ones(shape, dtype=bool)
+    if hollow:
+        inside = shellOf(inside)
+    return (np.argwhere(inside) + low).astype(np.int32)
+
+
+# Функция получения вокселей шара с центром center и радиусом radius
+# (воксели, центры которых лежат в шаре).
+# hollow - только оболочка (поверхность толщиной в блок).
+# Возвращает массив (n, 3) int32
+def sphereCells(center, radius, hollow=False):
+    center = np.asarray(center, dtype=np.float64)
+    low = np.ceil(center - radius).astype(np.int64)
+    high = np.floor(center + radius).astype(np.int64)
+    if radius < 0 or (low > high).any():
+        return np.empty((0, 3), dtype=np.int32)
+    shape = high - low + 1
+    checkShape(shape)
+    # квадраты расстояний по осям складываем с расширением размерностей
+    axes = [(np.arange(low[i], high[i] + 1) - center[i]) ** 2
+            for i in range(3)]
+    inside = (axes[0][:, None, None] + axes[1][None, :, None] +
+              axes[2][None, None, :]) <= radius * radius
+    if hollow:
+        inside = shellOf(inside)
+    return (np.argwhere(inside) + low).astype(np.int32)
+
+
+# Класс буфера обмена области карты: плотный массив номеров
+# собственной палитры буфера (0 - пусто) и таблицы цветов и материалов.
+# Тип массива - наименьший, в который помещаются номера
+class Clipboard():
+    # Конструктор. Аргументы:
+    #  grid - массив (sx, sy, sz) номеров палитры, индексы - [x][y][z]
+    #  colors - массив (k, 4) цветов палитры (номер i - строка i - 1)
+    #  materials - массив (k,) номеров материалов палитры
+    def __init__(self, grid, colors, materials):
+        self.grid = grid
+        self.colors = colors
+        self.materials = materials
+        # количество блоков в буфере
+        self.count = int(np.count_nonzero(grid))
+
+    # Метод создания буфера из блоков. Аргументы:
+    #  low, high - углы копируемой области (включительно)
+    #  positions - массив (n, 3) координат блоков внутри области
+    #  colors - массив (n, 4) цветов блоков
+    #  materials - массив (n,) номеров материалов блоков
+    @classmethod
+    def fromBlocks(cls, low, high, positions, colors, materials):
+        low, high = boxCorners(low, high)
+        shape = high - low + 1
+        checkShape(shape)
+        entries = np.zeros((len(positions), 5), dtype=np.float64)
+        entries[:, :4] = colors
+        entries[:, 4] = materials
+        # различные пары (цвет, материал) ищем, сравнивая строки как байты
+        rows = entries.view(
+            np.dtype((np.void, entries.itemsize * 5))).reshape(-1)
+        _, first, inverse = np.unique(rows, return_index=True,
+                                      return_inverse=True)
+        table = entries[first]
+        if len(table) < 0xff:
+            dtype = np.uint8
+        elif len(table) < 0xffff:
+            dtype = np.uint16
+        else:
+            dtype = np.uint32
+        grid = np.zeros(shape, dtype=dtype)
+        cells = np.asarray(positions, dtype=np.int64) - low
+        grid[cells[:, 0], cells[:, 1], cells[:, 2]] = \
+            inverse.reshape(-1) + 1
+        return cls(grid, table[:, :4].copy(), table[:, 4].astype(np.uint8))
+
+    # Метод получения блоков буфера, вставленного углом в точку origin.
+    # Возвращает (координаты (n, 3) int32, цвета (n, 4), материалы (n,))
+    def getBlocks(self, origin):
+        cells = np.argwhere(self.grid)
+        indices = self.grid[cells[:, 0], cells[:, 1], cells[:, 2]]
+        indices = indices.astype(np.intp) - 1
+        positions = cells + np.rint(np.asarray(origin)).astype(np.int64)
+        return (positions.astype(np.int32), self.colors[indices],
+                self.materials[indices])
+
+    # Метод получения размеров области буфера
+    def getShape(self):
+        return self.grid.shape
+
+    # Метод получения объёма памяти буфера (байт)
+    def getBytes(self):
+        return self.grid.nbytes + self.colors.nbytes + self.materials.nbytes
@@ -0,0 +1,226 @@
+import time
+import numpy as np
+
+from physics import FixedTimestep
+from profiler import profiler
+
+# длина шага моделирования (такта), секунд
+TICK_STEP = 0.02
+# наибольшее число тактов за кадр (при долгом кадре время отбрасывается)
+MAX_TICKS = 5
+# время на фоновые работы в одном кадре, секунд
+FRAME_BUDGET = 0.004
+
+
+# Класс очереди фоновых работ одного вида (например, перестройки чанков).
+# Работа - ключ и точка в мире; выполняется вызовом handler(ключ).
+# Повторная постановка работы с тем же ключом не создаёт новую работу
+class JobQueue():
+    # Конструктор. Аргументы:
+    #  name - имя очереди (для статистики)
+    #  handler - функция выполнения работы по её ключу
+    def __init__(self, name, handler):
+        self.name = name
+        self.handler = handler
+        # словарь: ключ работы - точка (x, y, z) или None (срочная работа)
+        self.jobs = dict()
+        # количество выполненных работ
+        self.done = 0
+        # суммарное время выполнения работ, секунд
+        self.time = 0.0
+        # количество кадров, в конце которых работы оставались в очереди
+        self.deferred_frames = 0
+        # наибольшая длина очереди в конце кадра
+        self.max_pending = 0
+
+    # Метод постановки работы key в очередь. Аргументы:
+    #  position - точка в мире, по расстоянию от которой до камеры
+    #             выбирается порядок работ (None - выполнить первой)
+    def submit(self, key, position=None):
+        self.jobs[key] = position
+
+    # Метод отмены работы key
+    def cancel(self, key):
+        self.jobs.pop(key, None)
+
+    # Метод отмены всех работ
+    def clear(self):
+        self.jobs.clear()
+
+    # Метод немедленного выполнения всех работ очереди
+    def flush(self):
+        while self.jobs:
+            key, position = self.jobs.popitem()
+            self.run(key)
+
+    # Метод выполнения работы key (уже снятой с очереди)
+    def run(self, key):
+        start = time.perf_counter()
+        with profiler.scope('jobs:' + self.name):
+            self.handler(key)
+        self.time += time.perf_counter() - start
+        self.done += 1
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def __contains__(self, key):
+        return key in self.jobs
+
+
+# Класс планировщика кадра: такты моделирования фиксированной длины
+# и фоновые работы в пределах бюджета времени кадра.
+# Работы выполняются по возрастанию расстояния до камеры; что не успело
+# выполниться, переносится на следующие кадры (хотя бы одна работа
+# выполняется в каждом кадре, чтобы очередь не стояла)
+class Scheduler():
+    # Конструктор. Аргументы:
+    #  step - длина такта моделирования, секунд
+    #  budget - время на фоновые работы в одном кадре, секунд
+    #  max_ticks - наибольшее число тактов за кадр
+    def __init__(self, step=TICK_STEP, budget=FRAME_BUDGET,
+                 max_ticks=MAX_TICKS):
+        self.timestep = FixedTimestep(step, max_ticks)
+        self.budget = budget
+        # функции такта моделирования: вызываются с длиной такта
+        self.ticks = []
+        # очереди фоновых работ
+        self.queues = []
+        # время предыдущего кадра (None - первый кадр)
+        self.last_time = None
+        # запущена ли задача планировщика
+        self.started = False
+        # количество кадров, тактов и кадров с превышением бюджета
+        self.frames = 0
+        self.tick_count = 0
+        self.over_budget = 0
+
+    # Метод запуска задачи планировщика (при первом использовании)
+    def start(self):
+        if not self.started:
+            self.started = True
+            taskMgr.add(self.frameTask, 'scheduler-task', sort=45)
+
+    # Метод добавления функции такта моделирования callback(step)
+    def addTick(self, callback):
+        self.start()
+        if callback not in self.ticks:
+            self.ticks.append(callback)
+
+    # Метод удаления функции такта моделирования
+    def removeTick(self, callback):
+        if callback in self.ticks:
+            self.ticks.remove(callback)
+
+    # Метод сброса накопленного времени моделирования
+    # (например, после смены режима хождения)
+    def resetTicks(self):
+        self.timestep.reset()
+        self.last_time = None
+
+    # Метод создания очереди фоновых работ. Аргументы:
+    #  name - имя очереди
+    #  handler - функция выполнения работы по её ключу
+    def createQueue(self, name, handler):
+        self.start()
+        queue = JobQueue(name, handler)
+        self.queues.append(queue)
+        return queue
+
+    # Метод удаления очереди (её работы отменяются)
+    def removeQueue(self, queue):
+        queue.clear()
+        if queue in self.queues:
+            self.queues.remove(queue)
+
+    # Задача планировщика (раз в кадр)
+    def frameTask(self, task):
+        now = time.perf_counter()
+        if self.last_time is not None:
+            self.runTicks(now - self.last_time)
+        self.last_time = now
+        self.runJobs(self.budget)
+        return task.cont
+
+    # Метод выполнения тактов моделирования за прошедшее время dt
+    def runTicks(self, dt):
+        step = self.timestep.step
+        for i in range(self.timestep.advance(dt)):
+            self.tick_count += 1
+            for callback in list(self.ticks):
+                callback(step)
+
+    # Метод получения точки, от которой считается расстояние до работ
+    def getViewPoint(self):
+        camera = getattr(base, 'camera', None)
+        if camera is None:
+            return np.zeros(3)
+        return np.array(camera.getPos(render))
+
+    # Метод выполнения работ всех очередей в пределах времени budget.
+    # Возвращает количество выполненных работ
+    def runJobs(self, budget):
+        self.frames += 1
+        if not any(queue.jobs for queue in self.queues):
+            return 0
+        # выбор порядка работ тоже входит в бюджет
+        start = time.perf_counter()
+        pending = [(queue, key, position) for queue in self.queues
+                   for key, position in queue.jobs.items()]
+
+        # порядок работ - по расстоянию до камеры, срочные - первыми
+        points = np.array([position if position is not None
+                           else (np.nan, np.nan, np.nan)
+                           for queue, key, position in pending],
+                          dtype=np.float64)
+        distance = ((points - self.getViewPoint()) ** 2).sum(axis=1)
+        distance[np.isnan(distance)] = -1
+        done = 0
+        for index in np.argsort(distance, kind='stable').tolist():
+            if done and time.perf_counter() - start >= budget:
+                break
+            queue, key, position = pending[index]
+            # работа могла быть отменена или выполнена другой работой
+            if key not in queue.jobs:
+                continue
+            del queue.jobs[key]
+            queue.run(key)
+            done += 1
+
+        if time.perf_counter() - start > budget:
+            self.over_budget += 1
+        for queue in self.queues:
+            if queue.jobs:
+                queue.deferred_frames += 1
+                queue.max_pending = max(queue.max_pending, len(queue.jobs))
+        return done
+
+    # Метод получения статистики планировщика и отложенных работ
+    def getStats(self):
+        return {'frames': self.frames,
+                'ticks': self.tick_count,
+                'over_budget_frames': self.over_budget,
+                'budget': self.budget,
+                'queues': {queue.name: {'pending': len(queue.jobs),
+                                        'done': queue.done,
+                                        'time': queue.time,
+                                        'deferred_frames':
+                                            queue.deferred_frames,
+                                        'max_pending': queue.max_pending}
+                           for queue in self.queues}}
+
+    # Метод вывода статистики планировщика
+    def printStats(self):
+        stats = self.getStats()
+        print('frames', stats['frames'], 'ticks', stats['ticks'],
+              'over budget', stats['over_budget_frames'])
+        for name, item in sorted(stats['queues'].items()):
+            print('  %-16s pending %6d  done %7d  %8.1f ms  '
+                  'deferred frames %6d  max pending %6d' % (
+                      name, item['pending'], item['done'],
+                      item['time'] * 1000, item['deferred_frames'],
+                      item['max_pending']))
+
+
+# общий планировщик игры
+scheduler = Scheduler()
@@ -0,0 +1,66 @@
+from panda3d.core import LineSegs
+from panda3d.core import TransparencyAttrib
+
+# половина размера рамки выделения (чуть больше блока,
+# чтобы линии не сливались с его гранями)
+HALF_SIZE = 0.505
+
+
+# Класс рамки выделения - одного каркасного куба поверх выделенного блока.
+# Смена выделения только переносит рамку: геометрия и цвета блоков
+# не меняются, а чанки не перестраиваются
+class SelectionBox():
+    # Конструктор. Аргументы:
+    #  color - цвет рамки
+    #  thickness - толщина линий в пикселях
+    def __init__(self, color=(0, 0, 1, 1), thickness=2):
+        lines = LineSegs('selection')
+        lines.setThickness(thickness)
+        corners = [(x, y, z)
+                   for x in (-HALF_SIZE, HALF_SIZE)
+                   for y in (-HALF_SIZE, HALF_SIZE)
+                   for z in (-HALF_SIZE, HALF_SIZE)]
+        # рёбра куба - пары углов, отличающиеся одной координатой
+        for i, a in enumerate(corners):
+            for b in corners[i + 1:]:
+                if sum(p != q for p, q in zip(a, b)) == 1:
+                    lines.moveTo(*a)
+                    lines.drawTo(*b)
+
+        self.node = render.attachNewNode(lines.create())
+        self.node.setLightOff()
+        self.node.setTextureOff(1)
+        self.node.setTransparency(TransparencyAttrib.MAlpha)
+        self.node.hide()
+        self.setColor(color)
+        # воксель, на котором стоит рамка (None - рамка скрыта)
+        self.voxel = None
+
+    # Метод установки цвета рамки
+    def setColor(self, color):
+        self.node.setColor(color, 1)
+
+    # Метод показа рамки на вокселе voxel
+    def show(self, voxel):
+        if voxel != self.voxel:
+            self.voxel = voxel
+            self.node.setPos(voxel[0], voxel[1], voxel[2])
+            self.node.setScale(1)
+        self.node.show()
+
+    # Метод показа рамки вокруг параллелепипеда вокселей
+    # с углами low и high (включительно)
+    def showRegion(self, low, high):
+        self.voxel = None
+        self.node.setPos(*((a + b) / 2 for a, b in zip(low, high)))
+        self.node.setScale(*(abs(b - a) + 1 for a, b in zip(low, high)))
+        self.node.show()
+
+    # Метод скрытия рамки
+    def hide(self):
+        self.voxel = None
+        self.node.hide()
+
+    # Метод удаления рамки из сцены
+    def remove(self):
+        self.node.removeNode()
@@ -0,0 +1,178 @@
+import numpy as np
+
+from chunkrenderer import CHUNK_SIZE, groupRows
+
+# тип битовой маски столбца чанка: бит z - занят ли воксель (x, y, z)
+MASK_DTYPE = {8: np.uint8, 16: np.uint16,
+              32: np.uint32, 64: np.uint64}[CHUNK_SIZE]
+# биты слоёв столбца
+BITS = (np.ones(CHUNK_SIZE, dtype=MASK_DTYPE) <<
+        np.arange(CHUNK_SIZE, dtype=MASK_DTYPE))
+
+# смещения соседей вокселя: по граням и все 26 (с рёбрами и углами)
+FACE_OFFSETS = np.array([(1, 0, 0), (-1, 0, 0), (0, 1, 0),
+                         (0, -1, 0), (0, 0, 1), (0, 0, -1)], dtype=np.int32)
+ALL_OFFSETS = np.array([offset for offset in np.ndindex(3, 3, 3)
+                        if offset != (1, 1, 1)], dtype=np.int32) - 1
+
+
+# Класс индекса занятых вокселей: на каждый чанк - битовая маска
+# (CHUNK_SIZE, CHUNK_SIZE) столбцов, бит z которой - занятость вокселя.
+# Запросы по области перебирают только пересекающие её чанки
+# и возвращают массивы NumPy координат вокселей
+class OccupancyIndex():
+    # Конструктор
+    def __init__(self):
+        # словарь: ключ чанка - маска занятых вокселей
+        # (только непустые чанки)
+        self.masks = dict()
+        # словарь: ключ столбца чанков (x, y) - множество номеров z
+        # его непустых чанков
+        self.columns = dict()
+
+    # Метод удаления всех вокселей
+    def clear(self):
+        self.masks.clear()
+        self.columns.clear()
+
+    # Метод получения (создания) маски чанка key
+    def getMask(self, key):
+        mask = self.masks.get(key)
+        if mask is None:
+            mask = np.zeros((CHUNK_SIZE, CHUNK_SIZE), dtype=MASK_DTYPE)
+            self.masks[key] = mask
+            self.columns.setdefault(key[:2], set()).add(key[2])
+        return mask
+
+    # Метод удаления маски чанка key, если в ней не осталось вокселей
+    def dropEmpty(self, key, mask):
+        if not mask.any():
+            del self.masks[key]
+            levels = self.columns[key[:2]]
+            levels.discard(key[2])
+            if not levels:
+                del self.columns[key[:2]]
+
+    # Метод установки занятости одного вокселя voxel (x, y, z)
+    def setVoxel(self, voxel, occupied):
+        key = (voxel[0] // CHUNK_SIZE, voxel[1] // CHUNK_SIZE,
+               voxel[2] // CHUNK_SIZE)
+        x, y, z = (voxel[0] % CHUNK_SIZE, voxel[1] % CHUNK_SIZE,
+                   voxel[2] % CHUNK_SIZE)
+        if occupied:
+            self.getMask(key)[x, y] |= BITS[z]
+        else:
+            mask = self.masks.get(key)
+            if mask is not None:
+                mask[x, y] &= ~BITS[z]
+                self.dropEmpty(key, mask)
+
+    # Метод пометки занятыми вокселей positions (массив (n, 3))
+    def add(self, positions):
+        positions = np.asarray(positions, dtype=np.int64).reshape(-1, 3)
+        for key, rows in groupRows(positions // CHUNK_SIZE).items():
+            local = positions[rows] % CHUNK_SIZE
+            np.bitwise_or.at(self.getMask(key), (local[:, 0], local[:, 1]),
+                             BITS[local[:, 2]])
+
+    # Метод пометки свободными вокселей positions (массив (n, 3))
+    def remove(self, positions):
+        positions = np.asarray(positions, dtype=np.int64).reshape(-1, 3)
+        for key, rows in groupRows(positions // CHUNK_SIZE).items():
+            mask = self.masks.get(key)
+            if mask is None:
+                continue
+            local = positions[rows] % CHUNK_SIZE
+            np.bitwise_and.at(mask, (local[:, 0], local[:, 1]),
+                              ~BITS[local[:, 2]])
+            self.dropEmpty(key, mask)
+
+    # Метод проверки занятости вокселей positions (массив (n, 3)).
+    # Возвращает массив (n,) bool
+    def occupied(self, positions):
+        positions = np.asarray(positions, dtype=np.int64).reshape(-1, 3)
+        result = np.zeros(len(positions), dtype=bool)
+        for key, rows in groupRows(positions // CHUNK_SIZE).items():
+            mask = self.masks.get(key)
+            if mask is None:
+                continue
+            local = positions[rows] % CHUNK_SIZE
+            result[rows] = (mask[local[:, 0], local[:, 1]] &
+                            BITS[local[:, 2]]) != 0
+        return result
+
+    # Метод получения занятых вокселей в параллелепипеде от low
+    # до high (включительно). Возвращает массив (n, 3) int32
+    # (воксели упорядочены по чанкам)
+    def box(self, low, high):
+        low = np.floor(np.asarray(low, dtype=np.float64)).astype(np.int64)
+        high = np.floor(np.asarray(high, dtype=np.float64)).astype(np.int64)
+        if (low > high).any():
+            return np.empty((0, 3), dtype=np.int32)
+        first = low // CHUNK_SIZE
+        last = high // CHUNK_SIZE
+        # перебираем либо чанки области, либо все непустые - что меньше
+        if np.prod(last - first + 1) <= len(self.masks):
+            keys = [tuple((first + offset).tolist())
+                    for offset in np.ndindex(*(last - first + 1))]
+        else:
+            keys = [key for key in self.masks
+                    if all(first[i] <= key[i] <= last[i] for i in range(3))]
+
+        parts = []
+        for key in keys:
+            mask = self.masks.get(key)
+            if mask is None:
+                continue
+            origin = np.array(key, dtype=np.int64) * CHUNK_SIZE
+            start = np.maximum(low - origin, 0)
+            end = np.minimum(high - origin, CHUNK_SIZE - 1) + 1
+            columns = mask[start[0]:end[0], start[1]:end[1]]
+            cells = np.argwhere(columns[:, :, None] &
+                                BITS[None, None, start[2]:end[2]])
+            if len(cells):
+                parts.append(cells + origin + start)
+        if not parts:
+            return np.empty((0, 3), dtype=np.int32)
+        return np.concatenate(parts).astype(np.int32)
+
+    # Метод получения занятых вокселей, центры которых лежат в шаре
+    # с центром center и радиусом radius. Возвращает массив (n, 3) int32
+    def sphere(self, center, radius):
+        center = np.asarray(center, dtype=np.float64)
+        cells = self.box(np.ceil(center - radius), np.floor(center + radius))
+        inside = ((cells - center) ** 2).sum(axis=1) <= radius * radius
+        return cells[inside]
+
+    # Метод получения занятых соседей вокселя voxel
+    # (diagonal - считать и соседей по рёбрам и углам).
+    # Возвращает массив (n, 3) int32
+    def neighbors(self, voxel, diagonal=False):
+        cells = (np.asarray(voxel, dtype=np.int32) +
+                 (ALL_OFFSETS if diagonal else FACE_OFFSETS))
+        return cells[self.occupied(cells)]
+
+    # Метод получения высоты самого верхнего занятого вокселя
+    # столбца (x, y) ниже below (None - без ограничения).
+    # Возвращает z или None, если в столбце нет занятых вокселей
+    def columnTop(self, x, y, below=None):
+        column = (x // CHUNK_SIZE, y // CHUNK_SIZE)
+        levels = self.columns.get(column)
+        if not levels:
+            return None
+        local_x = x % CHUNK_SIZE
+        local_y = y % CHUNK_SIZE
+        for level in sorted(levels, reverse=True):
+            if below is not None and level * CHUNK_SIZE >= below:
+                continue
+            bits = int(self.masks[column + (level,)][local_x, local_y])
+            if below is not None and below < (level + 1) * CHUNK_SIZE:
+                # оставляем только слои ниже below
+                bits &= (1 << (below - level * CHUNK_SIZE)) - 1
+            if bits:
+                return level * CHUNK_SIZE + bits.bit_length() - 1
+        return None
+
+    # Метод получения объёма памяти масок (байт)
+    def getBytes(self):
+        return sum(mask.nbytes for mask in self.masks.values())
@@ -0,0 +1,198 @@
+import numpy as np
+
+# цвета слоёв ландшафта (RGBA), номер слоя - индекс в палитре
+TERRAIN_PALETTE = np.array([
+    (0.45, 0.45, 0.50, 1.0),   # 0 - камень
+    (0.55, 0.40, 0.25, 1.0),   # 1 - земля
+    (0.35, 0.70, 0.30, 1.0),   # 2 - трава
+    (0.90, 0.85, 0.60, 1.0),   # 3 - песок
+    (0.95, 0.95, 1.00, 1.0),   # 4 - снег
+    (0.20, 0.40, 0.90, 0.6),   # 5 - вода
+    (0.15, 0.15, 0.15, 1.0),   # 6 - коренная порода
+], dtype=np.float32)
+
+STONE, DIRT, GRASS, SAND, SNOW, WATER, BEDROCK = range(7)
+
+
+# Функция целочисленного хеша точек решётки (векторная).
+# Аргументы - массивы целых координат одинаковой формы и зерно seed.
+# Возвращает массив uint32
+def hashLattice(seed, *coords):
+    h = (seed * 0x9E3779B1 + 0x7F4A7C15) & 0xFFFFFFFF
+    h = np.full(np.broadcast(*coords).shape, h, dtype=np.uint32)
+    for coord, prime in zip(coords, (0x8DA6B343, 0xD8163841, 0xCB1AB31F)):
+        h ^= np.asarray(coord).astype(np.uint32) * np.uint32(prime)
+        h ^= h >> np.uint32(13)
+        h *= np.uint32(0x5BD1E995)
+        h ^= h >> np.uint32(15)
+    return h
+
+
+# Функция сглаживания (6t^5 - 15t^4 + 10t^3)
+def fade(t):
+    return t * t * t * (t * (t * 6 - 15) + 10)
+
+
+# Функция двумерного шума Перлина (векторная).
+# x, y - массивы координат одной формы; результат примерно от -1 до 1
+def perlin2(x, y, seed):
+    x0 = np.floor(x)
+    y0 = np.floor(y)
+    fx = x - x0
+    fy = y - y0
+    ix = x0.astype(np.int64)
+    iy = y0.astype(np.int64)
+
+    # скалярное произведение градиента угла решётки и смещения точки
+    def corner(dx, dy):
+        angle = hashLattice(seed, ix + dx, iy + dy) * (2 * np.pi / 2 ** 32)
+        return np.cos(angle) * (fx - dx) + np.sin(angle) * (fy - dy)
+
+    u = fade(fx)
+    v = fade(fy)
+    bottom = corner(0, 0) + u * (corner(1, 0) - corner(0, 0))
+    top = corner(0, 1) + u * (corner(1, 1) - corner(0, 1))
+    return (bottom + v * (top - bottom)) * np.sqrt(2)
+
+
+# Функция двумерного фрактального шума (сумма октав шума Перлина)
+def fractal2(x, y, seed, octaves=4, persistence=0.5, lacunarity=2.0):
+    total = np.zeros(np.broadcast(x, y).shape, dtype=np.float64)
+    amplitude = 1.0
+    frequency = 1.0
+    norm = 0.0
+    for octave in range(octaves):
+        total += amplitude * perlin2(x * frequency, y * frequency,
+                                     seed + octave)
+        norm += amplitude
+        amplitude *= persistence
+        frequency *= lacunarity
+    return total / norm
+
+
+# Функция трёхмерного шума значений на регулярной сетке вокселей.
+# Значения задаются в узлах решётки с шагом spacing и сглаженно
+# интерполируются по осям по очереди, поэтому стоимость - несколько
+# проходов по сетке. Аргументы:
+#  origin - координаты первого вокселя сетки
+#  shape - размеры сетки
+#  spacing - шаг решётки в вокселях
+# Результат от -1 до 1, одинаковый на стыках соседних сеток
+def valueNoiseGrid3(origin, shape, spacing, seed):
+    starts = []
+    weights = []
+    offsets = []
+    for axis in range(3):
+        coord = (origin[axis] + np.arange(shape[axis])) / spacing
+        cell = np.floor(coord).astype(np.int64)
+        starts.append(cell[0])
+        offsets.append(cell - cell[0])
+        weights.append(fade(coord - cell).astype(np.float32))
+
+    # значения в узлах решётки
+    lattice_shape = [int(offsets[axis][-1]) + 2 for axis in range(3)]
+    grids = np.meshgrid(*[starts[axis] + np.arange(lattice_shape[axis])
+                          for axis in range(3)], indexing='ij')
+    values = (hashLattice(seed, *grids) * (2.0 / 2 ** 32) -
+              1.0).astype(np.float32)
+
+    # интерполируем по каждой оси
+    for axis in range(3):
+        low = np.take(values, offsets[axis], axis=axis)
+        high = np.take(values, offsets[axis] + 1, axis=axis)
+        weight_shape = [1, 1, 1]
+        weight_shape[axis] = -1
+        weight = weights[axis].reshape(weight_shape)
+        values = low + (high - low) * weight
+    return values
+
+
+# Класс генератора ландшафта: карта высот, пещеры и цветные слои.
+# Для одного зерна seed результат всегда одинаковый.
+class TerrainGenerator():
+    # Конструктор. Аргументы:
+    #  seed - зерно генератора
+    #  base_height - средняя высота поверхности
+    #  amplitude - размах высот
+    #  scale - размер холмов в блоках
+    #  sea_level - уровень воды (None - без воды)
+    #  snow_line - высота, выше которой лежит снег
+    #  caves - прорезать ли пещеры
+    #  cave_threshold - порог шума пещер (больше - меньше пещер)
+    #  bedrock - высота слоя коренной породы (None - без неё)
+    def __init__(self, seed=0, base_height=0, amplitude=12, scale=48.0,
+                 sea_level=-4, snow_line=9, caves=True,
+                 cave_threshold=0.45, bedrock=None):
+        self.seed = seed
+        self.base_height = base_height
+        self.amplitude = amplitude
+        self.scale = scale
+        self.sea_level = sea_level
+        self.snow_line = snow_line
+        self.caves = caves
+        self.cave_threshold = cave_threshold
+        self.bedrock = bedrock
+
+    # Метод построения карты высот для области (x0, y0, size_x, size_y).
+    # Возвращает целочисленный массив (size_x, size_y)
+    def heightmap(self, x0, y0, size_x, size_y):
+        x = (x0 + np.arange(size_x))[:, None] / self.scale
+        y = (y0 + np.arange(size_y))[None, :] / self.scale
+        noise = fractal2(x, y, self.seed)
+        return np.rint(self.base_height +
+                       noise * self.amplitude).astype(np.int32)
+
+    # Метод построения сетки типов вокселей для области.
+    # Аргументы:
+    #  origin - координаты угла области (x, y, z)
+    #  shape - размеры области (size_x, size_y, size_z)
+    # Возвращает массив uint8 формы shape: номер слоя + 1 (0 - пусто)
+    def generateGrid(self, origin, shape):
+        x0, y0, z0 = origin
+        heights = self.heightmap(x0, y0, shape[0], shape[1])[:, :, None]
+        z = (z0 + np.arange(shape[2], dtype=np.int32))[None, None, :]
+        depth = heights - z
+
+        # слои по глубине под поверхностью
+        grid = np.full(shape, STONE + 1, dtype=np.uint8)
+        grid[depth <= 3] = DIRT + 1
+        surface = depth == 0
+        grid[surface] = GRASS + 1
+        if self.sea_level is not None:
+            grid[surface & (heights <= self.sea_level + 1)] = SAND + 1
+        grid[surface & (heights >= self.snow_line)] = SNOW + 1
+        # над поверхностью - пусто
+        grid[depth < 0] = 0
+
+        # пещеры под поверхностью (шум нужен только до самой высокой точки)
+        top = min(shape[2], int(heights.max()) - z0)
+        if self.caves and top > 0:
+            cave_shape = (shape[0], shape[1], top)
+            noise = valueNoiseGrid3(origin, cave_shape, 12, self.seed + 101)
+            noise += 0.5 * valueNoiseGrid3(origin, cave_shape, 6,
+                                           self.seed + 102)
+            caves = ((noise > 1.5 * self.cave_threshold) &
+                     (depth[:, :, :top] > 0))
+            grid[:, :, :top][caves] = 0
+
+        # вода ниже уровня моря над поверхностью
+        if self.sea_level is not None:
+            grid[(depth < 0) & (z <= self.sea_level)] = WATER + 1
+
+        # коренная порода
+        if self.bedrock is not None:
+            grid[(z <= self.bedrock) & (depth >= 0)] = BEDROCK + 1
+        return grid
+
+    # Метод генерации блоков области. Аргументы:
+    #  origin - координаты угла области (x, y, z)
+    #  shape - размеры области (size_x, size_y, size_z)
+    # Возвращает (координаты (n, 3) int32, цвета (n, 4) float32)
+    def generate(self, origin, shape):
+        grid = self.generateGrid(origin, shape)
+        local = np.nonzero(grid)
+        positions = np.empty((len(local[0]), 3), dtype=np.int32)
+        for axis in range(3):
+            positions[:, axis] = local[axis] + origin[axis]
+        colors = TERRAIN_PALETTE[grid[local] - 1]
+        return positions, colors
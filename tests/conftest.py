@@ -0,0 +1,14 @@
+import builtins
+import os
+import sys
+
+# корень репозитория: модули игры и её ресурсы лежат там
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+# Panda3D запускается без окна один раз на все тесты
+# (модулям игры нужны глобальные base, render, loader и taskMgr)
+if not hasattr(builtins, 'base'):
+    from benchmarks.run import startPanda
+    startPanda('none')
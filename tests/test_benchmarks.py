@@ -0,0 +1,13 @@
+from benchmarks.run import compare
+
+
+# Замедления пишутся в миллисекундах, а рост памяти - в байтах
+def test_compare_units():
+    results = {'loadMap': {'1000': 0.2}, 'mapBytes': {'1000': 12.0},
+               'saveMap': {'1000': 0.1}}
+    baseline = {'loadMap': {'1000': 0.1}, 'mapBytes': {'1000': 6.0},
+                'saveMap': {'1000': 0.1}}
+    regressions = compare(results, baseline, 0.25)
+    assert regressions == [
+        'loadMap[1000]: 100.000 ms -> 200.000 ms (x2.00)',
+        'mapBytes[1000]: 6.000 bytes -> 12.000 bytes (x2.00)']
@@ -0,0 +1,33 @@
+from controller import Controller
+from mapmanager import MapManager
+from scheduler import scheduler
+
+
+# Игрок в режиме хождения сам поднимается на уступ высотой в блок
+def test_walk_up_one_block_ledge():
+    map_manager = MapManager(collisions=False)
+    controller = Controller(map_manager)
+    try:
+        # пол на z = 0 и уступ на z = 1 начиная с y = 3
+        map_manager.fillBox((-2, -2, 0), (2, 8, 0), (0.5, 0.5, 0.5, 1))
+        map_manager.fillBox((-2, 3, 1), (2, 8, 1), (0.5, 0.5, 0.5, 1))
+        controller.setEditMode(False)
+        base.camera.setPos(0, 0, 2.5)
+        # приземляемся на пол
+        for _ in range(60):
+            controller.simulate(0)
+        assert controller.ground
+        assert abs(base.camera.getZ() - 2.001) < 0.01
+
+        # идём вперёд на уступ
+        controller.setKey('w', 1)
+        for _ in range(60):
+            controller.simulate(0)
+        controller.setKey('w', 0)
+        assert base.camera.getY() > 4
+        assert abs(base.camera.getZ() - 3.001) < 0.01
+        assert controller.ground
+    finally:
+        taskMgr.remove('camera-task')
+        scheduler.removeTick(controller.simulate)
+        map_manager.clearAll()
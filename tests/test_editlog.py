@@ -0,0 +1,54 @@
+import os
+import numpy as np
+
+import editlog
+import mapformat
+
+
+# Функция получения множества координат блоков
+def positionSet(positions):
+    return set(map(tuple, np.asarray(positions).tolist()))
+
+
+# Сбой сворачивания журнала не теряет правок: несвёрнутый журнал
+# не затирается следующим поворотом и сворачивается при повторе
+def test_failed_compaction_keeps_edits(tmp_path, monkeypatch):
+    filename = str(tmp_path / 'map.dat')
+    old_path = editlog.compactingLogPath(filename)
+    first = np.array([(x, 0, 0) for x in range(10)])
+    second = np.array([(0, y, 1) for y in range(10)])
+
+    save = mapformat.saveMapFile
+    calls = []
+
+    # первая попытка сохранить снимок завершается ошибкой
+    def failOnce(*args):
+        calls.append(args[0])
+        if len(calls) == 1:
+            raise OSError('disk full')
+        save(*args)
+
+    monkeypatch.setattr(mapformat, 'saveMapFile', failOnce)
+    log = editlog.EditLog(filename, compact_size=64)
+    try:
+        log.append(first, np.ones((len(first), 4)))
+        log.flush(wait=True)
+        log.waitCompaction()
+        assert os.path.exists(old_path)
+        assert not os.path.exists(filename)
+
+        # следующий поворот сворачивает оставшийся журнал
+        log.append(first[:5])
+        log.append(second, np.ones((len(second), 4)))
+        log.flush(wait=True)
+        log.waitCompaction()
+    finally:
+        log.close()
+
+    assert len(calls) == 2
+    assert not os.path.exists(old_path)
+    snapshot = mapformat.loadMapFile(filename)[0]
+    assert positionSet(snapshot) == positionSet(first)
+    positions = editlog.loadMapWithLog(filename)[0]
+    assert positionSet(positions) == positionSet(first[5:]) | \
+        positionSet(second)
@@ -0,0 +1,21 @@
+from mapmanager import MapManager
+
+
+# Отмена и повтор записи о двух вокселях не трогают блоки между ними
+def test_undo_redo_two_voxels():
+    map_manager = MapManager(collisions=False)
+    try:
+        map_manager.fillBox((0, 0, 0), (4, 0, 0), (1, 1, 1, 1))
+        # запись журнала отмены о двух вокселях по краям ряда
+        map_manager.removeBlocks([(0, 0, 0), (4, 0, 0)])
+        assert len(map_manager.blocks) == 3
+
+        assert map_manager.undo()
+        assert len(map_manager.blocks) == 5
+        assert map_manager.redo()
+        assert sorted(map_manager.blocks) == [(1, 0, 0), (2, 0, 0),
+                                              (3, 0, 0)]
+        assert map_manager.undo()
+        assert len(map_manager.blocks) == 5
+    finally:
+        map_manager.clearAll()
@@ -0,0 +1,42 @@
+import numpy as np
+
+import mapformat
+
+
+# Пустая карта сохраняется и загружается без ошибок
+def test_empty_map_round_trip(tmp_path):
+    filename = str(tmp_path / 'empty.dat')
+    mapformat.saveMapFile(filename, np.empty((0, 3), dtype=np.int32),
+                          np.empty((0, 4)))
+    positions, colors, materials = mapformat.loadMapFile(filename)
+    assert positions.shape == (0, 3)
+    assert colors.shape == (0, 4)
+    assert materials.shape == (0,)
+
+
+# Плотные блоки пишутся по чанкам, редкие - столбцами координат;
+# в обоих случаях блоки загружаются без изменений
+def test_dense_and_sparse_round_trip(tmp_path):
+    dense = np.argwhere(np.ones((20, 20, 20), dtype=bool)) - 10
+    sparse = np.array([(0, 0, 0), (100, -200, 50), (-300, 7, 9)])
+    for name, positions, version in (('dense', dense, mapformat.VERSION),
+                                     ('sparse', sparse,
+                                      mapformat.COLUMNS_VERSION)):
+        colors = np.zeros((len(positions), 4))
+        colors[:, 0] = positions[:, 2] % 2
+        colors[:, 3] = 1
+        materials = (positions[:, 0] % 3).astype(np.uint8)
+        filename = str(tmp_path / (name + '.dat'))
+        mapformat.saveMapFile(filename, positions, colors, materials)
+        with open(filename, 'rb') as fin:
+            header = fin.read(mapformat.HEADER_SIZE)
+        assert mapformat.struct.unpack(mapformat.HEADER_FORMAT,
+                                       header)[1] == version
+
+        loaded, loaded_colors, loaded_materials = \
+            mapformat.loadMapFile(filename)
+        order = np.lexsort(positions.T)
+        loaded_order = np.lexsort(np.asarray(loaded).T)
+        assert (np.asarray(loaded)[loaded_order] == positions[order]).all()
+        assert np.allclose(loaded_colors[loaded_order], colors[order])
+        assert (loaded_materials[loaded_order] == materials[order]).all()
@@ -0,0 +1,67 @@
+import numpy as np
+
+from mapmanager import MapManager
+
+
+# Функция создания менеджера карты с рядом из count блоков вдоль X
+def makeRow(count):
+    map_manager = MapManager(collisions=False)
+    map_manager.fillBox((0, 0, 0), (count - 1, 0, 0), (1, 1, 1, 1))
+    return map_manager
+
+
+# Две позиции - это два блока, а не углы параллелепипеда
+def test_remove_two_positions():
+    map_manager = makeRow(5)
+    try:
+        assert map_manager.removeBlocks(np.array([(0, 0, 0),
+                                                  (4, 0, 0)])) == 2
+        assert len(map_manager.blocks) == 3
+        assert map_manager.isOccupied((2, 0, 0))
+    finally:
+        map_manager.clearAll()
+
+
+# Параллелепипед удаляется отдельным методом
+def test_remove_box():
+    map_manager = makeRow(5)
+    try:
+        assert map_manager.removeBox((1, 0, 0), (3, 0, 0)) == 3
+        assert sorted(map_manager.blocks) == [(0, 0, 0), (4, 0, 0)]
+    finally:
+        map_manager.clearAll()
+
+
+# Выбор блока при отрисовке чанками (у блоков нет своих узлов)
+# возвращает сам блок
+def test_select_block_returns_block():
+    map_manager = MapManager(collisions=False)
+    try:
+        map_manager.addBlock((1, 2, 3), (1, 1, 1, 1))
+        key = map_manager.getBlock((1, 2, 3)).getKey()
+        block = map_manager.selectBlock(key)
+        assert block is not None
+        assert tuple(block.position) == (1, 2, 3)
+        assert block is map_manager.selected_block
+        assert map_manager.selectBlock(None) is None
+    finally:
+        map_manager.clearAll()
+
+
+# Сетка байтовых обозначений (как у np.chararray) строит ту же карту,
+# что и вложенный список строк
+def test_create_map_from_bytes_grid():
+    colors = {'R': (1, 0, 0, 1), 'G': (0, 1, 0, 1)}
+    matrix = [[['R', 'G', '.'], ['.', 'R', 'G']],
+              [['G', '.', '.'], ['.', '.', 'R']]]
+    map_manager = MapManager(collisions=False)
+    try:
+        map_manager.createMap(colors, matrix, (0, 0, 0))
+        expected = sorted(map_manager.blocks)
+        assert len(expected) == 6
+        for grid in (np.array(matrix, dtype='S1'),
+                     np.char.array(matrix, unicode=False)):
+            map_manager.createMap(colors, grid, (0, 0, 0))
+            assert sorted(map_manager.blocks) == expected
+    finally:
+        map_manager.clearAll()
@@ -0,0 +1,32 @@
+import threading
+
+from profiler import Profiler
+
+
+# Замеры из нескольких потоков не теряются и не мешают статистике
+def test_record_from_threads():
+    profiler = Profiler(window=50)
+
+    # поток записи замеров по нескольким участкам
+    def worker(index):
+        for step in range(2000):
+            profiler.record('scope%d' % (step % 20), 0.001)
+        profiler.record('worker%d' % index, 0.001)
+
+    threads = [threading.Thread(target=worker, args=(index,))
+               for index in range(4)]
+    for thread in threads:
+        thread.start()
+    # статистика читается, пока потоки пишут замеры
+    while any(thread.is_alive() for thread in threads):
+        profiler.getStats()
+    for thread in threads:
+        thread.join()
+
+    stats = profiler.getStats()
+    assert sum(stats['scope%d' % index]['count']
+               for index in range(20)) == 8000
+    assert all(stats['worker%d' % index]['count'] == 1
+               for index in range(4))
+    profiler.clear()
+    assert profiler.getStats() == {}
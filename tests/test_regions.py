@@ -0,0 +1,43 @@
+import numpy as np
+
+from mapmanager import MapManager
+
+RED = (1, 0, 0, 1)
+WHITE = (1, 1, 1, 1)
+
+
+# Функция получения цвета блока в позиции position (RGBA от 0 до 1)
+def colorAt(map_manager, position):
+    return tuple(np.round(map_manager.blocks[position].getColor(), 2))
+
+
+# Замена цвета двух блоков не удаляет блоки между ними
+def test_replace_color_of_two_blocks():
+    map_manager = MapManager(collisions=False)
+    try:
+        map_manager.fillBox((0, 0, 0), (5, 5, 0), WHITE)
+        map_manager.removeBlocks([(0, 0, 0), (5, 5, 0)])
+        map_manager.addBlocks([(0, 0, 0), (5, 5, 0)], [RED, RED])
+        count = map_manager.replaceColor((0, 0, 0), (5, 5, 0), RED,
+                                         (0, 0, 1, 1))
+        assert count == 2
+        assert len(map_manager.blocks) == 36
+        assert colorAt(map_manager, (5, 5, 0)) == (0, 0, 1, 1)
+        assert colorAt(map_manager, (2, 2, 0)) == WHITE
+    finally:
+        map_manager.clearAll()
+
+
+# Вставка двух блоков с заменой не удаляет блоки между ними
+def test_paste_two_blocks_with_replace():
+    map_manager = MapManager(collisions=False)
+    try:
+        map_manager.addBlocks([(0, 0, 0), (3, 3, 0)], [RED, RED])
+        clipboard = map_manager.copyRegion((0, 0, 0), (3, 3, 0))
+        map_manager.fillBox((10, 0, 0), (13, 3, 0), WHITE)
+        assert map_manager.pasteRegion(clipboard, (10, 0, 0)) == 2
+        assert len(map_manager.blocks) == 18
+        assert colorAt(map_manager, (13, 3, 0)) == RED
+        assert colorAt(map_manager, (11, 1, 0)) == WHITE
+    finally:
+        map_manager.clearAll()
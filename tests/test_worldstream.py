@@ -0,0 +1,66 @@
+import numpy as np
+
+import worldstream
+from mapmanager import MapManager
+
+
+# Функция получения блоков плиты 16x16x1 чанка (cx, 0, 0)
+def slab(cx):
+    x, y = np.meshgrid(np.arange(16), np.arange(16), indexing='ij')
+    positions = np.column_stack((x.reshape(-1) + cx * 16, y.reshape(-1),
+                                 np.zeros(256, dtype=int)))
+    return positions, np.ones((256, 4))
+
+
+# Грани на границе регионов отсекаются соседним чанком
+# из соседнего региона
+def test_border_faces_across_regions(tmp_path):
+    # чанки 3 и 4 по X лежат в разных регионах
+    assert (worldstream.regionOf((3, 0, 0)) !=
+            worldstream.regionOf((4, 0, 0)))
+    first, second = slab(3), slab(4)
+    world_dir = str(tmp_path / 'world')
+    worldstream.saveWorld(world_dir, np.concatenate([first[0], second[0]]),
+                          np.concatenate([first[1], second[1]]))
+
+    map_manager = MapManager(collisions=False)
+    streamer = worldstream.WorldStreamer(map_manager, world_dir, base.camera)
+    try:
+        _, data = streamer.loadChunk((3, 0, 0), False, [])
+        faces = data[3][3]
+        # верх и низ плиты, три открытые стороны; сторона +X закрыта
+        assert faces == 256 * 2 + 16 * 3
+    finally:
+        streamer.stop()
+        map_manager.clearAll()
+
+
+# Правки загруженных чанков записываются в регионы при очистке карты
+def test_clear_all_saves_streamed_edits(tmp_path):
+    positions, colors = slab(0)
+    world_dir = str(tmp_path / 'world')
+    worldstream.saveWorld(world_dir, positions, colors)
+
+    map_manager = MapManager(collisions=False)
+    base.camera.setPos(8, 8, 0)
+    map_manager.streamWorld(world_dir, base.camera)
+    try:
+        for _ in range(500):
+            if (0, 0, 0) in map_manager.streamer.loaded:
+                break
+            taskMgr.step()
+        assert (0, 0, 0) in map_manager.streamer.loaded
+        map_manager.addBlock((3, 3, 1), (1, 0, 0, 1))
+        map_manager.removeBlocks([(5, 5, 0)])
+    finally:
+        map_manager.clearAll()
+
+    saved = worldstream.WorldStreamer(map_manager, world_dir, base.camera)
+    try:
+        stored = saved.readRegion((0, 0, 0))[(0, 0, 0)][0]
+    finally:
+        saved.stop()
+    stored = set(map(tuple, stored.tolist()))
+    assert (3, 3, 1) in stored
+    assert (5, 5, 0) not in stored
+    assert len(stored) == 256
@@ -0,0 +1,382 @@
+import os
+import glob
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+import mapformat
+from chunkrenderer import (CHUNK_SIZE, buildChunkArrays, buildChunkLods,
+                           chunkOf)
+from scheduler import scheduler
+
+# размер региона (группы чанков, хранимой в одном файле) в чанках по оси
+REGION_SIZE = 4
+# размер региона в блоках по оси
+REGION_BLOCKS = REGION_SIZE * CHUNK_SIZE
+# шаблон имени файла региона
+REGION_NAME = 'r.%d.%d.%d.vxr'
+
+# примерный расход памяти на один загруженный блок (номер палитры
+# в хранилище чанков, маски занятости и освещение), байт
+BLOCK_BYTES = 16
+
+
+# Функция получения ключа региона для чанка
+def regionOf(chunk):
+    return (chunk[0] // REGION_SIZE,
+            chunk[1] // REGION_SIZE,
+            chunk[2] // REGION_SIZE)
+
+
+# Функция получения имени файла региона
+def regionPath(world_dir, region):
+    return os.path.join(world_dir, REGION_NAME % region)
+
+
+# Функция получения ключей всех регионов мира
+def listRegions(world_dir):
+    regions = set()
+    for path in glob.glob(os.path.join(world_dir, 'r.*.*.*.vxr')):
+        parts = os.path.basename(path).split('.')
+        regions.add((int(parts[1]), int(parts[2]), int(parts[3])))
+    return regions
+
+
+# Функция группировки блоков по ключам (ключ = координаты // size).
+# materials - номера материалов блоков (None - все 0).
+# Возвращает словарь: ключ - (координаты, цвета, материалы)
+def groupBlocks(positions, colors, size, materials=None):
+    positions = np.asarray(positions, dtype=np.int32).reshape(-1, 3)
+    colors = np.asarray(colors, dtype=np.float32).reshape(-1, 4)
+    if materials is None:
+        materials = np.zeros(len(positions), dtype=np.uint8)
+    materials = np.asarray(materials, dtype=np.uint8).reshape(-1)
+    if not len(positions):
+        return dict()
+    keys, inverse = np.unique(positions // size, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.searchsorted(inverse[order], np.arange(len(keys) + 1))
+    groups = dict()
+    for i, key in enumerate(keys.tolist()):
+        part = order[bounds[i]:bounds[i + 1]]
+        groups[tuple(key)] = (positions[part], colors[part],
+                              materials[part])
+    return groups
+
+
+# Функция сбора непрозрачных блоков соседних чанков,
+# прилегающих к границе чанка key. Аргументы:
+#  chunks - словарь: ключ чанка - (координаты, цвета, материалы)
+def getBorderSolids(chunks, key):
+    origin = np.array(key, dtype=np.int32) * CHUNK_SIZE
+    border = []
+    for axis in range(3):
+        for step, plane in ((-1, origin[axis] - 1),
+                            (1, origin[axis] + CHUNK_SIZE)):
+            neighbour = list(key)
+            neighbour[axis] += step
+            data = chunks.get(tuple(neighbour))
+            if data is None:
+                continue
+            positions, colors = data[:2]
+            mask = (positions[:, axis] == plane) & (colors[:, 3] >= 1.0)
+            border.append(positions[mask])
+    if not border:
+        return np.empty((0, 3), dtype=np.int32)
+    return np.concatenate(border)
+
+
+# Функция сохранения региона: блоки всех его чанков в одном файле
+def saveRegion(world_dir, region, chunks):
+    path = regionPath(world_dir, region)
+    chunks = [data for data in chunks.values() if len(data[0])]
+    if not chunks:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    positions = np.concatenate([data[0] for data in chunks])
+    colors = np.concatenate([data[1] for data in chunks])
+    materials = np.concatenate([data[2] for data in chunks])
+    # пишем во временный файл и подменяем, чтобы не испортить регион
+    mapformat.saveMapFile(path + '.tmp', positions, colors, materials)
+    os.replace(path + '.tmp', path)
+
+
+# Функция сохранения всего мира в файлы регионов
+def saveWorld(world_dir, positions, colors, materials=None):
+    os.makedirs(world_dir, exist_ok=True)
+    regions = groupBlocks(positions, colors, REGION_BLOCKS, materials)
+    for region, data in regions.items():
+        saveRegion(world_dir, region, {region: data})
+    # удаляем регионы, в которых больше нет блоков
+    for region in listRegions(world_dir) - set(regions):
+        os.remove(regionPath(world_dir, region))
+
+
+# Класс потоковой загрузки мира по регионам:
+# чанки рядом с камерой загружаются и строятся в фоновых потоках,
+# а дальние выгружаются
+class WorldStreamer():
+    # Конструктор. Аргументы:
+    #  map_manager - менеджер карты, в который загружаются чанки
+    #  world_dir - папка с файлами регионов
+    #  camera - узел, относительно которого считается расстояние
+    #  load_radius - радиус загрузки чанков (в чанках)
+    #  unload_radius - радиус, за которым чанки выгружаются (в чанках)
+    #  memory_limit - жёсткий предел памяти загруженных чанков (байт)
+    #  workers - количество фоновых потоков
+    def __init__(self, map_manager, world_dir, camera,
+                 load_radius=4, unload_radius=6,
+                 memory_limit=256 * 1024 * 1024, workers=2):
+        self.map_manager = map_manager
+        self.world_dir = world_dir
+        self.camera = camera
+        self.load_radius = load_radius
+        self.unload_radius = max(unload_radius, load_radius)
+        self.memory_limit = memory_limit
+
+        # регионы, существующие на диске
+        self.regions = listRegions(world_dir)
+        # кэш прочитанных регионов (общий для фоновых потоков)
+        self.region_cache = OrderedDict()
+        self.region_cache_size = 8
+        self.region_lock = threading.Lock()
+        # запись регионов выполняется по одной
+        self.write_lock = threading.Lock()
+
+        # загруженные чанки: ключ - оценка занимаемой памяти
+        self.loaded = dict()
+        # чанки, загрузка которых уже запущена: ключ - задача
+        self.pending = dict()
+        # чанки, которых нет в файлах регионов
+        self.empty = set()
+        # очередь готовых чанков от фоновых потоков
+        self.ready = queue.Queue()
+        # готовые чанки, ждущие добавления в карту: ключ - данные чанка
+        self.arrived = dict()
+        # добавление готовых чанков - работы планировщика в пределах
+        # бюджета кадра, ближние к камере - первыми
+        self.accept_jobs = scheduler.createQueue('chunk-load',
+                                                 self.acceptArrived)
+        # незавершённые задачи записи регионов
+        self.writes = list()
+
+        # чанк, в котором находится камера
+        self.center = None
+
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        taskMgr.add(self.updateTask, 'world-stream-task', sort=40)
+
+    # Метод получения текущей памяти загруженных чанков
+    def getMemory(self):
+        return sum(self.loaded.values())
+
+    # Метод получения квадрата расстояния от чанка до камеры (в чанках)
+    def getDistance2(self, key):
+        return sum((a - b) ** 2 for a, b in zip(key, self.center))
+
+    # Задача потоковой загрузки (раз в кадр)
+    def updateTask(self, task):
+        position = self.camera.getPos(render)
+        center = chunkOf((int(round(position[0])), int(round(position[1])),
+                          int(round(position[2]))))
+        # при переходе камеры в другой чанк пересчитываем нужные чанки
+        if center != self.center:
+            self.center = center
+            self.unloadFar()
+            self.requestNear()
+        self.acceptReady()
+        return task.cont
+
+    # Метод запуска загрузки недостающих чанков в радиусе загрузки
+    def requestNear(self):
+        radius = self.load_radius
+        wanted = []
+        for dx in range(-radius, radius + 1):
+            for dy in range(-radius, radius + 1):
+                for dz in range(-radius, radius + 1):
+                    if dx * dx + dy * dy + dz * dz > radius * radius:
+                        continue
+                    key = (self.center[0] + dx, self.center[1] + dy,
+                           self.center[2] + dz)
+                    if (key in self.loaded or key in self.pending or
+                            key in self.arrived or key in self.empty or
+                            regionOf(key) not in self.regions):
+                        continue
+                    wanted.append(key)
+        # ближние чанки загружаем первыми
+        wanted.sort(key=self.getDistance2)
+        greedy = self.map_manager.renderer.greedy
+        levels = self.map_manager.renderer.lod_levels
+        for key in wanted:
+            future = self.executor.submit(self.loadChunk, key, greedy,
+                                          levels)
+            self.pending[key] = future
+            future.add_done_callback(self.ready.put)
+
+    # Метод выгрузки чанков за радиусом выгрузки
+    def unloadFar(self):
+        limit = self.unload_radius * self.unload_radius
+        for key in list(self.map_manager.renderer.chunks):
+            if self.getDistance2(key) > limit:
+                self.unloadChunk(key)
+
+    # Метод приёма готовых чанков от фоновых потоков:
+    # чанки ставятся в очередь добавления планировщика
+    def acceptReady(self):
+        half = (CHUNK_SIZE - 1) / 2
+        while True:
+            try:
+                future = self.ready.get_nowait()
+            except queue.Empty:
+                break
+            if future.cancelled():
+                continue
+            key, data = future.result()
+            self.pending.pop(key, None)
+            if data is None:
+                self.empty.add(key)
+                continue
+            self.arrived[key] = data
+            self.accept_jobs.submit(key, (key[0] * CHUNK_SIZE + half,
+                                          key[1] * CHUNK_SIZE + half,
+                                          key[2] * CHUNK_SIZE + half))
+
+    # Работа планировщика: добавление готового чанка key в карту
+    def acceptArrived(self, key):
+        data = self.arrived.pop(key, None)
+        if data is None:
+            return
+        # камера могла уйти, пока чанк загружался
+        limit = self.unload_radius * self.unload_radius
+        if self.center is not None and self.getDistance2(key) > limit:
+            return
+        self.acceptChunk(key, data)
+
+    # Метод добавления загруженного чанка в менеджер карты
+    def acceptChunk(self, key, data):
+        positions, colors, materials, mesh, lods = data
+        memory = len(positions) * BLOCK_BYTES + sum(
+            array.nbytes for part in [mesh] + lods for array in part[:3])
+        # соблюдаем предел памяти: выгружаем самые дальние чанки,
+        # но только если они дальше нового
+        distance = self.getDistance2(key)
+        while self.getMemory() + memory > self.memory_limit:
+            if not self.loaded:
+                return
+            farthest = max(self.loaded, key=self.getDistance2)
+            if self.getDistance2(farthest) <= distance:
+                return
+            self.unloadChunk(farthest)
+        self.map_manager.addChunk(key, positions, colors, mesh, lods,
+                                  materials)
+        self.loaded[key] = memory
+
+    # Метод выгрузки чанка (изменённый чанк записывается в регион)
+    def unloadChunk(self, key):
+        renderer = self.map_manager.renderer
+        if key in renderer.edited:
+            self.writeChunks({key: self.map_manager.getChunkArrays(key)})
+        self.map_manager.removeChunk(key)
+        self.loaded.pop(key, None)
+
+    # Метод фоновой записи чанков в файлы регионов. Аргументы:
+    #  chunks - словарь: ключ чанка - (координаты, цвета, материалы)
+    def writeChunks(self, chunks):
+        by_region = dict()
+        for key, data in chunks.items():
+            by_region.setdefault(regionOf(key), dict())[key] = data
+            self.empty.discard(key)
+        for region, region_chunks in by_region.items():
+            self.regions.add(region)
+            self.writes.append(self.executor.submit(
+                self.writeRegion, region, region_chunks))
+        self.writes = [future for future in self.writes if not future.done()]
+
+    # Метод сохранения всех изменённых загруженных чанков
+    def save(self):
+        renderer = self.map_manager.renderer
+        self.writeChunks({key: self.map_manager.getChunkArrays(key)
+                          for key in renderer.edited})
+        renderer.edited.clear()
+        for future in self.writes:
+            future.result()
+        self.writes.clear()
+
+    # Метод остановки загрузки: изменённые загруженные чанки
+    # записываются в регионы (ожидает завершения записи)
+    def stop(self):
+        taskMgr.remove('world-stream-task')
+        scheduler.removeQueue(self.accept_jobs)
+        self.arrived.clear()
+        # отменяем ещё не начатые загрузки
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+        # правки загруженных чанков иначе пропадут
+        self.save()
+        self.executor.shutdown(wait=True)
+
+    # Метод чтения региона (выполняется в фоновом потоке).
+    # Возвращает словарь: ключ чанка - (координаты, цвета, материалы)
+    def readRegion(self, region):
+        with self.region_lock:
+            if region in self.region_cache:
+                self.region_cache.move_to_end(region)
+                return self.region_cache[region]
+            path = regionPath(self.world_dir, region)
+            if os.path.exists(path):
+                positions, colors, materials = mapformat.loadBinaryMap(path)
+                chunks = groupBlocks(positions, colors, CHUNK_SIZE,
+                                     materials)
+            else:
+                chunks = dict()
+            self.region_cache[region] = chunks
+            if len(self.region_cache) > self.region_cache_size:
+                self.region_cache.popitem(last=False)
+            return chunks
+
+    # Метод записи чанков в файл региона (выполняется в фоновом потоке)
+    def writeRegion(self, region, chunks):
+        with self.write_lock:
+            stored = dict(self.readRegion(region))
+            stored.update(chunks)
+            saveRegion(self.world_dir, region, stored)
+            with self.region_lock:
+                self.region_cache[region] = stored
+
+    # Метод чтения соседних по граням чанков key из файлов регионов
+    # (соседи на границе региона лежат в соседних регионах).
+    # Возвращает словарь: ключ чанка - (координаты, цвета, материалы)
+    def readNeighbours(self, key):
+        chunks = dict()
+        for axis in range(3):
+            for step in (-1, 1):
+                neighbour = list(key)
+                neighbour[axis] += step
+                neighbour = tuple(neighbour)
+                region = regionOf(neighbour)
+                if region not in self.regions:
+                    continue
+                data = self.readRegion(region).get(neighbour)
+                if data is not None:
+                    chunks[neighbour] = data
+        return chunks
+
+    # Метод загрузки и построения геометрии чанка и его уровней
+    # детализации levels (выполняется в фоновом потоке)
+    def loadChunk(self, key, greedy, levels):
+        data = self.readRegion(regionOf(key)).get(key)
+        if data is None or not len(data[0]):
+            return key, None
+        positions, colors, materials = data
+        origin = np.array(key, dtype=np.int32) * CHUNK_SIZE
+        border = getBorderSolids(self.readNeighbours(key), key)
+        mesh = buildChunkArrays(origin, positions, colors, border, greedy,
+                                materials)
+        lods = buildChunkLods(origin, positions, colors, levels, greedy,
+                              materials)
+        return key, (positions, colors, materials, mesh, lods)